@@ -11,11 +11,9 @@ env = Environment(
     region="us-west-2"
 )
 
+# API keys are not passed in: the Lambdas read them from the SteepleCo/ApiKeys
+# secret (backend/config.py)
 context = {
-    'stripe_test_secret_key': os.environ.get('STRIPE_TEST_SECRET_KEY'),
-    'stripe_secret_key': os.environ.get('STRIPE_SECRET_KEY'),
-    'stripe_webhook_secret': os.environ.get('STRIPE_WEBHOOK_SECRET'),
-    'prodigi_sandbox_api_key': os.environ.get('PRODIGI_SANDBOX_API_KEY'),
     'email_sender': os.environ.get('EMAIL_SENDER'),
     'ses_sender_email': os.environ.get('SES_SENDER_EMAIL', 'hello@hansenhome.ai'),
     'success_url': os.environ.get('SUCCESS_URL', 'https://hansenhomeai.github.io/success'),
@@ -0,0 +1,78 @@
+"""
+In-process caches.
+
+LRUCache keeps up to max_entries values for ttl seconds in the container's
+memory. Lambda reuses a container for many invocations, so a value cached by
+one is there for the next ones that land on the same container; nothing is
+shared between containers.
+
+An expired entry is not dropped straight away: get() returns it flagged as
+stale, so the caller can revalidate it cheaply (say, by comparing a version
+number) and put() it back instead of rebuilding it.
+
+Hits, misses and evictions are counted on the cache (stats()) and, when a
+name is given, as <name>Hit / <name>Miss metrics on the current trace.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+import tracing
+
+
+class LRUCache:
+    def __init__(self, max_entries, ttl, name=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.name = name
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+
+    def get(self, key):
+        """(value, fresh) for a cached key, or (None, False)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, False
+            self._entries.move_to_end(key)
+            expires_at, value = entry
+            fresh = time.monotonic() < expires_at
+            if not fresh:
+                self._stats["stale"] += 1
+        return value, fresh
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def hit(self):
+        """Record that a cached value was served (fresh or revalidated)"""
+        self._stats["hits"] += 1
+        if self.name:
+            tracing.count(f"{self.name}Hit")
+
+    def miss(self):
+        """Record that the value had to be rebuilt"""
+        self._stats["misses"] += 1
+        if self.name:
+            tracing.count(f"{self.name}Miss")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
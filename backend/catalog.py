@@ -0,0 +1,54 @@
+"""
+Poster catalog shared by the backend.
+
+Keep in sync with the `products` array in script.js. Orders store only the
+SKU, quantity and price of each line; names and images are resolved here.
+
+An entry with an `edition_size` is a limited edition: checkout reserves its
+prints from the stock table (see stock.py), which tools/seed_stock.py fills
+with that many prints before the drop. Entries without one are printed on
+demand and never touch the stock table.
+
+SHIPPING_COSTS lists the shipping methods offered and what they cost.
+"""
+
+POSTERS = {
+    "1": {
+        "name": "Christ in Gethsemane",
+        "price_cents": 50,
+        "image": "assets/poster1.jpg"
+    },
+    "2": {
+        "name": "The First Vision",
+        "price_cents": 50,
+        "image": "assets/poster2.jpg"
+    },
+    "3": {
+        "name": "The Living Christ",
+        "price_cents": 50,
+        "image": "assets/poster3.jpg"
+    },
+    "4": {
+        "name": "The Restoration",
+        "price_cents": 50,
+        "image": "assets/poster4.jpg"
+    },
+    "5": {
+        "name": "The Plan of Salvation",
+        "price_cents": 50,
+        "image": "assets/poster5.jpg"
+    }
+}
+
+# Shipping prices in cents, matching the options offered in index.html
+SHIPPING_COSTS = {
+    "BUDGET": 0,
+    "STANDARD": 580,
+    "EXPRESS": 1530,
+    "PRIORITY": 2730
+}
+
+
+def get_poster(sku):
+    """Return the catalog entry for a SKU, or None if it is not sold"""
+    return POSTERS.get(str(sku))
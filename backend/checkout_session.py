@@ -2,21 +2,26 @@ import os
 import json
 import stripe
 import uuid
-import logging
 import boto3
 import time
 from decimal import Decimal
 
-# Set up logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+import tracing
+import deadline
+import profiling
+import rate_limit
+import config
+import shared_cache
+import stock
+from catalog import SHIPPING_COSTS, get_poster
+from order_items import InvalidItems, compact_items
+from order_store import now_ms, put_order, put_order_request, with_version
+from structured_logging import get_logger
 
-# Initialize Stripe with your secret key
-stripe_secret_key = os.environ.get("STRIPE_SECRET_KEY", "DEFAULT_NOT_SET")
-# Log the first 8 characters of the secret key (safe to log part of it)
-logger.info(f"Using Stripe secret key: {stripe_secret_key[:8]}...")
+logger = get_logger(__name__)
 
-stripe.api_key = stripe_secret_key
+# The secret key is passed per request from config, so a rotated key is
+# picked up without a redeploy
 # Use a stable API version that matches the frontend
 stripe.api_version = "2025-03-31.basil"
 
@@ -26,7 +31,7 @@ orders_table_name = os.environ.get("ORDERS_TABLE", "SteepleCo-Orders")
 try:
     orders_table = dynamodb.Table(orders_table_name)
 except Exception as e:
-    logger.error(f"Failed to initialize DynamoDB table: {str(e)}")
+    logger.error("Failed to initialize DynamoDB table: %s", e)
     # We'll still continue and handle this later if needed
 
 def decimal_default(obj):
@@ -47,12 +52,16 @@ def create_cors_response(status_code, body):
         'body': json.dumps(body)
     }
 
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted
+@rate_limit.limited("checkout")
 def handler(event, context):
-    logger.info("Received event: %s", json.dumps(event))
+    logger.debug("Received event", event=event)
     
     # Handle CORS preflight request
     if event.get('httpMethod') == 'OPTIONS':
-        logger.info("Handling OPTIONS request")
+        logger.debug("Handling OPTIONS request")
         return {
             'statusCode': 200,
             'headers': {
@@ -67,8 +76,6 @@ def handler(event, context):
 
     try:
         # Log the incoming request details
-        logger.info("Request headers: %s", event.get('headers', {}))
-        logger.info("Request body: %s", event.get('body', '{}'))
 
         body = json.loads(event.get("body", "{}"))
         items = body.get("items", [])
@@ -83,17 +90,27 @@ def handler(event, context):
                 'body': json.dumps({'error': 'No items provided'})
             }
         
+        # Resolve the cart against the catalog into compact order lines
+        try:
+            order_lines = compact_items(items)
+        except InvalidItems as e:
+            return create_cors_response(400, {'error': str(e)})
+        
         # Calculate amount in cents (Stripe requires amount in cents)
-        amount = calculate_amount(items, shipping_details.get('shippingMethod', 'BUDGET'))
+        amount = calculate_amount(order_lines, shipping_details.get('shippingMethod', 'BUDGET'))
         
         # Generate a unique order ID
         order_id = str(uuid.uuid4())
         
+        # Correlation ID carried through payment, fulfillment and shipping
+        correlation_id = uuid.uuid4().hex
+        tracing.annotate(order_id=order_id, correlation_id=correlation_id)
+        
         # Generate a unique job ID to track this checkout session
         job_id = str(uuid.uuid4())
         
         # Log checkout attempt
-        logger.info(f"Creating checkout for email: {customer_email}, amount: {amount}, items: {json.dumps(items)}")
+        logger.info("Creating checkout", amount=amount, line_count=len(order_lines), client_id=client_id)
         
         # Create a temporary order record in DynamoDB
         timestamp = int(time.time())
@@ -103,12 +120,14 @@ def handler(event, context):
             'order_id': order_id,
             'job_id': job_id,
             'client_id': client_id,
+            'correlation_id': correlation_id,
             'status': 'PENDING',
             'customer_email': customer_email,
             'amount': amount,
-            'items': json.dumps(items),
+            'items': order_lines,
             'created_at': timestamp,
             'updated_at': timestamp,
+            'stage_timestamps': {'created': now_ms()},
             'expires_at': timestamp + 900  # 15-minute expiration
         }
         
@@ -116,32 +135,53 @@ def handler(event, context):
         if shipping_details:
             order_item['shipping_details'] = shipping_details
         
-        # Store the order in DynamoDB
-        orders_table.put_item(Item=order_item)
-        
-        # Create a Stripe payment intent
-        payment_intent = stripe.PaymentIntent.create(
-            amount=amount,
-            currency='usd',
-            receipt_email=customer_email,
-            metadata={
-                'order_id': order_id,
-                'job_id': job_id,
-                'client_id': client_id
-            },
-            payment_method_types=['card']
-        )
+        # Store the order in DynamoDB, together with the prints it takes
+        # from any limited edition
+        try:
+            reserve_stock(order_item)
+        except stock.SoldOut as e:
+            name = (get_poster(e.sku) or {}).get('name', e.sku)
+            message = f"Only {e.available} prints of {name} are left" if e.available else f"{name} is sold out"
+            return create_cors_response(409, {'error': message, 'soldOut': e.sku, 'available': e.available})
+        except stock.StockContention as e:
+            logger.warning("Stock reservation kept conflicting: %s", e)
+            return create_cors_response(503, {'error': 'Checkout is busy, please try again', 'retryable': True})
         
-        # Store the payment intent ID in the order
-        orders_table.update_item(
-            Key={'order_id': order_id},
-            UpdateExpression="SET payment_intent_id = :pi",
-            ExpressionAttributeValues={
-                ':pi': payment_intent.id
-            }
-        )
+        try:
+            # Create a Stripe payment intent
+            payment_intent = create_payment_intent(
+                amount=amount,
+                currency='usd',
+                receipt_email=customer_email,
+                metadata={
+                    'order_id': order_id,
+                    'job_id': job_id,
+                    'client_id': client_id,
+                    'correlation_id': correlation_id
+                },
+                payment_method_types=['card']
+            )
+            
+            # Store the payment intent ID in the order
+            expression_attr_names = {}
+            expression_attr_values = {':pi': payment_intent.id}
+            orders_table.update_item(
+                Key={'order_id': order_id},
+                UpdateExpression=with_version(
+                    "SET payment_intent_id = :pi", expression_attr_names, expression_attr_values
+                ),
+                ExpressionAttributeNames=expression_attr_names,
+                ExpressionAttributeValues=expression_attr_values
+            )
+            shared_cache.invalidate_order(order_id)
+        except (Exception, deadline.BudgetExhausted):
+            # The customer can't pay without the payment intent; don't hold
+            # the prints until order_cleanup gets to the order
+            if order_item.get('stock_reservations'):
+                release_stock(order_item)
+            raise
         
-        logger.info(f"Created payment intent: {payment_intent.id} for order: {order_id}")
+        logger.info("Created payment intent", payment_intent_id=payment_intent.id)
         
         # Return the client secret to the frontend
         return create_cors_response(200, {
@@ -152,27 +192,75 @@ def handler(event, context):
         })
         
     except Exception as e:
-        logger.error(f"Error creating checkout session: {str(e)}")
+        logger.exception("Error creating checkout session: %s", e)
         return create_cors_response(500, {'error': f"Failed to create checkout session: {str(e)}"})
 
-def calculate_amount(items, shipping_method):
+def reserve_stock(order_item):
+    """Write the order, taking its limited-edition prints in the same transaction"""
+    demand = stock.limited_demand(order_item['items'])
+    if not demand:
+        put_order(orders_table, order_item)
+        return
+
+    def order_request(reservations):
+        order_item['stock_reservations'] = reservations
+        return put_order_request(orders_table_name, order_item, condition='attribute_not_exists(order_id)')
+
+    # An order that is never paid gives its prints back when order_cleanup expires it
+    stock.reserve(demand, order_request)
+    tracing.annotate(stock_reservations=len(order_item['stock_reservations']))
+
+def release_stock(order_item):
+    """Expire an order whose checkout failed after it was written, giving its prints back"""
+    expression_attr_names = {'#status_attr': 'status'}
+    expression_attr_values = {
+        ':status': 'EXPIRED',
+        ':time': int(time.time()),
+        ':released': True,
+        ':pending': 'PENDING'
+    }
+    update_expression = with_version(
+        "SET #status_attr = :status, updated_at = :time, stock_released = :released",
+        expression_attr_names, expression_attr_values
+    )
+    try:
+        stock.release({'Update': {
+            'TableName': orders_table_name,
+            'Key': {'order_id': order_item['order_id']},
+            'UpdateExpression': update_expression,
+            'ConditionExpression': '#status_attr = :pending AND attribute_not_exists(stock_released)',
+            'ExpressionAttributeNames': expression_attr_names,
+            'ExpressionAttributeValues': expression_attr_values
+        }}, order_item['stock_reservations'])
+    except stock.OrderChanged:
+        logger.info("Order changed before its stock was released, keeping it")
+        return
+    except Exception as e:
+        # order_cleanup releases it when the order expires
+        logger.error("Failed to release stock of a failed checkout: %s", e)
+        return
+    shared_cache.invalidate_order(order_item['order_id'])
+
+def create_payment_intent(**params):
+    api_key = config.require("STRIPE_SECRET_KEY")
+    try:
+        return stripe.PaymentIntent.create(api_key=api_key, **params)
+    except stripe.AuthenticationError:
+        # The cached key may have been rotated out; retry once with a fresh one
+        if not config.refresh() or config.get("STRIPE_SECRET_KEY") == api_key:
+            raise
+        logger.warning("Stripe rejected the cached secret key, retrying with the reloaded one")
+        return stripe.PaymentIntent.create(api_key=config.require("STRIPE_SECRET_KEY"), **params)
+
+def calculate_amount(order_lines, shipping_method):
     """Calculate the total amount in cents for Stripe"""
-    # Calculate subtotal
+    # Calculate subtotal from the catalog prices stored on each line
     subtotal = 0
-    for item in items:
-        subtotal += float(item.get('price', 0)) * int(item.get('quantity', 1))
+    for line in order_lines:
+        subtotal += line['cents'] * line['qty']
     
     # Add shipping cost
-    shipping_cost = 0
-    if shipping_method == 'STANDARD':
-        shipping_cost = 5.80
-    elif shipping_method == 'EXPRESS':
-        shipping_cost = 15.30
-    elif shipping_method == 'PRIORITY':
-        shipping_cost = 27.30
-    
-    # Calculate total (convert to cents for Stripe)
-    total = (subtotal + shipping_cost) * 100
+    shipping_cost = SHIPPING_COSTS.get(shipping_method, 0)
     
-    # Ensure we return an integer (Stripe requires integer amounts)
-    return int(total) 
\ No newline at end of file
+    # Stripe requires integer amounts in cents
+    return subtotal + shipping_cost
\ No newline at end of file
@@ -0,0 +1,27 @@
+"""
+Progress of scheduled jobs that work through a feed a piece at a time.
+
+Each job keeps one item in the checkpoints table, keyed by its name, holding
+whatever it needs to pick up where its last run stopped (a cursor, counts
+from the last run, ...). Jobs that use a checkpoint run with reserved
+concurrency 1, so the item has a single writer.
+"""
+import os
+import time
+import boto3
+
+dynamodb = boto3.resource("dynamodb")
+checkpoints_table_name = os.environ.get("CHECKPOINTS_TABLE", "SteepleCo-Checkpoints")
+checkpoints_table = dynamodb.Table(checkpoints_table_name)
+
+
+def load(job):
+    """The job's last saved checkpoint, or an empty dict"""
+    response = checkpoints_table.get_item(Key={"job": job}, ConsistentRead=True)
+    item = response.get("Item") or {}
+    item.pop("job", None)
+    return item
+
+
+def save(job, **fields):
+    checkpoints_table.put_item(Item=dict(fields, job=job, saved_at=int(time.time())))
@@ -0,0 +1,167 @@
+"""
+Secrets and configuration, fetched once per container and cached.
+
+Values come from, in order of precedence:
+
+    CONFIG_SECRET_ID       a Secrets Manager secret holding a JSON object
+                           ({"STRIPE_SECRET_KEY": "...", ...})
+    CONFIG_PARAMETER_PATH  Parameter Store parameters under a path
+                           (/steepleco/STRIPE_SECRET_KEY, SecureString
+                           values are decrypted)
+    the environment        local runs and anything not set above
+
+Without CONFIG_SECRET_ID or CONFIG_PARAMETER_PATH only the environment is
+used, so the local stack and tools keep working from env vars.
+
+Reads are dictionary lookups. The remote values are reloaded after
+CONFIG_TTL_SECONDS in a background thread while the old ones keep being
+served, so a rotated key is picked up within the TTL without a slow
+invocation. Only when the cache is older than CONFIG_MAX_STALE_SECONDS (or
+was never loaded) does a read wait for the fetch. A failed fetch keeps the
+last good values and is retried after CONFIG_RETRY_SECONDS. When a key is
+rejected upstream, refresh() reloads straight away (at most every
+CONFIG_REFRESH_MIN_SECONDS, so bad requests can't hammer the secret store).
+"""
+import os
+import json
+import time
+import threading
+
+import tracing
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+CONFIG_SECRET_ID = os.environ.get("CONFIG_SECRET_ID")
+CONFIG_PARAMETER_PATH = os.environ.get("CONFIG_PARAMETER_PATH")
+CONFIG_TTL_SECONDS = float(os.environ.get("CONFIG_TTL_SECONDS", "300"))
+CONFIG_MAX_STALE_SECONDS = float(os.environ.get("CONFIG_MAX_STALE_SECONDS", "3600"))
+CONFIG_RETRY_SECONDS = float(os.environ.get("CONFIG_RETRY_SECONDS", "30"))
+# refresh() calls closer together than this reuse the last load
+CONFIG_REFRESH_MIN_SECONDS = float(os.environ.get("CONFIG_REFRESH_MIN_SECONDS", "10"))
+
+
+class ConfigError(Exception):
+    """A required setting is missing"""
+
+
+class ConfigCache:
+    def __init__(self, secret_id=None, parameter_path=None, ttl=CONFIG_TTL_SECONDS,
+                 max_stale=CONFIG_MAX_STALE_SECONDS, retry_after=CONFIG_RETRY_SECONDS):
+        self.secret_id = secret_id
+        self.parameter_path = parameter_path.rstrip("/") + "/" if parameter_path else None
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.retry_after = retry_after
+        self._values = {}
+        self._loaded_at = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._clients = {}
+
+    @property
+    def remote(self):
+        return bool(self.secret_id or self.parameter_path)
+
+    def _client(self, service):
+        client = self._clients.get(service)
+        if client is None:
+            import boto3
+            client = self._clients[service] = boto3.client(service)
+        return client
+
+    def _fetch(self):
+        values = {}
+        if self.parameter_path:
+            paginator = self._client("ssm").get_paginator("get_parameters_by_path")
+            for page in paginator.paginate(Path=self.parameter_path, Recursive=True, WithDecryption=True):
+                for parameter in page["Parameters"]:
+                    values[parameter["Name"][len(self.parameter_path):]] = parameter["Value"]
+        if self.secret_id:
+            secret = self._client("secretsmanager").get_secret_value(SecretId=self.secret_id)
+            values.update(json.loads(secret["SecretString"]))
+        return values
+
+    def _load(self):
+        started = time.monotonic()
+        try:
+            values = self._fetch()
+        except Exception as e:
+            with self._lock:
+                self._failed_at = time.monotonic()
+                self._refreshing = False
+            tracing.count("ConfigRefreshFailed")
+            logger.warning("Failed to load configuration, keeping %d cached values: %s", len(self._values), e)
+            return False
+        with self._lock:
+            self._values = values
+            self._loaded_at = time.monotonic()
+            self._failed_at = None
+            self._refreshing = False
+        logger.info("Loaded configuration", keys=len(values),
+                    duration_ms=round((time.monotonic() - started) * 1000, 1))
+        return True
+
+    def _ensure_fresh(self):
+        if not self.remote:
+            return
+        now = time.monotonic()
+        age = None if self._loaded_at is None else now - self._loaded_at
+        if age is not None and age < self.ttl:
+            return
+        if self._failed_at is not None and now - self._failed_at < self.retry_after:
+            return
+
+        with self._lock:
+            # Someone is already reloading; the cached values will do meanwhile
+            if self._refreshing and age is not None:
+                return
+            self._refreshing = True
+
+        if age is not None and age < self.max_stale:
+            threading.Thread(target=self._load, name="config-refresh", daemon=True).start()
+        else:
+            self._load()
+
+    def get(self, name, default=None):
+        self._ensure_fresh()
+        value = self._values.get(name)
+        if value is None:
+            value = os.environ.get(name)
+        return default if value in (None, "") else value
+
+    def require(self, name):
+        value = self.get(name)
+        if value is None:
+            raise ConfigError(f"{name} is not configured")
+        return value
+
+    def refresh(self):
+        """Reload now, e.g. after a credential was rejected; False if nothing was reloaded"""
+        if not self.remote:
+            return False
+        with self._lock:
+            recent = self._loaded_at is not None and time.monotonic() - self._loaded_at < CONFIG_REFRESH_MIN_SECONDS
+            if recent or self._refreshing:
+                return False
+            self._refreshing = True
+        return self._load()
+
+
+_config = ConfigCache(CONFIG_SECRET_ID, CONFIG_PARAMETER_PATH)
+
+
+def get(name, default=None):
+    """A setting from the secret, Parameter Store or the environment"""
+    return _config.get(name, default)
+
+
+def require(name):
+    """Like get(), raising ConfigError when the setting is missing or empty"""
+    return _config.require(name)
+
+
+def refresh():
+    """Reload the remote settings now; True if they were reloaded"""
+    return _config.refresh()
@@ -0,0 +1,201 @@
+"""
+Per-invocation deadline budget.
+
+A handler decorated with budgeted() gets a budget equal to the Lambda's
+remaining time minus DEADLINE_RESERVE_MS, which is kept back so there is
+always time to answer. Outbound calls draw their timeouts from what is left:
+
+- HTTP through session() (Prodigi) and Stripe's client use the smaller of
+  their own timeout and the remaining budget,
+- boto3 clients get bounded connect/read timeouts and retries, and every
+  attempt first checks the budget.
+
+When too little is left for another call, BudgetExhausted is raised. It is a
+BaseException so the handlers' `except Exception` blocks don't turn it into
+a 500; budgeted() catches it and answers 503 with Retry-After (API handlers,
+whose callers retry) or raises RetryLater so Lambda redelivers the event
+(async and stream handlers). Either way a DeadlineExhausted metric is counted.
+
+Import this module right after tracing, before any boto3 client is created:
+
+    import tracing
+    import deadline
+    ...
+    @tracing.trace_handler
+    @deadline.budgeted
+    def handler(event, context):
+"""
+import os
+import json
+import time
+import functools
+import contextvars
+import boto3
+import requests
+from botocore.config import Config
+
+import tracing
+from structured_logging import get_logger
+
+try:
+    import stripe
+    from stripe import _http_client as stripe_http_client
+except ImportError:
+    stripe = None
+
+logger = get_logger(__name__)
+
+DEADLINE_RESERVE_MS = int(os.environ.get("DEADLINE_RESERVE_MS", "500"))
+# Below this there is no point starting another call
+DEADLINE_MIN_CALL_MS = int(os.environ.get("DEADLINE_MIN_CALL_MS", "100"))
+
+# Caps for a single attempt, whatever the budget
+AWS_CONNECT_TIMEOUT = float(os.environ.get("AWS_CONNECT_TIMEOUT", "2"))
+AWS_READ_TIMEOUT = float(os.environ.get("AWS_READ_TIMEOUT", "5"))
+AWS_MAX_ATTEMPTS = int(os.environ.get("AWS_MAX_ATTEMPTS", "3"))
+STRIPE_TIMEOUT = float(os.environ.get("STRIPE_TIMEOUT", "10"))
+
+RETRY_AFTER_SECONDS = 1
+
+_current_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class BudgetExhausted(BaseException):
+    """Raised instead of starting a call the invocation has no time left for"""
+
+
+class RetryLater(Exception):
+    """Raised out of async and stream handlers so Lambda delivers the event again"""
+
+
+class Deadline:
+    __slots__ = ("expires_at",)
+
+    def __init__(self, budget_ms):
+        self.expires_at = time.monotonic() + budget_ms / 1000.0
+
+    def remaining(self):
+        """Seconds left in the budget"""
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def check(self, operation):
+        remaining = self.remaining()
+        if remaining * 1000 < DEADLINE_MIN_CALL_MS:
+            raise BudgetExhausted(f"{operation}: {remaining * 1000:.0f}ms left")
+        return remaining
+
+    def timeout(self, operation, cap=None):
+        """A requests-style timeout (seconds or (connect, read)) no longer than the budget"""
+        remaining = self.check(operation)
+        if cap is None:
+            return remaining
+        if isinstance(cap, tuple):
+            return tuple(min(part, remaining) for part in cap)
+        return min(cap, remaining)
+
+
+def remaining():
+    """Seconds left for the current invocation, or None outside a budget"""
+    budget = _current_deadline.get()
+    return budget.remaining() if budget is not None else None
+
+
+def call_timeout(operation, cap=None):
+    """Timeout for an outbound call; just the cap outside a budget"""
+    budget = _current_deadline.get()
+    return budget.timeout(operation, cap) if budget is not None else cap
+
+
+def unavailable_response(message):
+    return {
+        "statusCode": 503,
+        "headers": {
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Headers": "*",
+            "Content-Type": "application/json",
+            "Retry-After": str(RETRY_AFTER_SECONDS)
+        },
+        "body": json.dumps({"error": message, "retryable": True})
+    }
+
+
+def budgeted(func=None, retry=False):
+    """
+    Decorate a Lambda handler (under trace_handler) to run it on a deadline
+    budget. Use budgeted(retry=True) for handlers Lambda retries on error.
+    """
+    if func is None:
+        return lambda func: budgeted(func, retry)
+
+    @functools.wraps(func)
+    def wrapper(event, context):
+        # Handlers called from another handler share the caller's budget
+        get_remaining = getattr(context, "get_remaining_time_in_millis", None)
+        if _current_deadline.get() is not None or get_remaining is None:
+            return func(event, context)
+
+        token = _current_deadline.set(Deadline(get_remaining() - DEADLINE_RESERVE_MS))
+        try:
+            return func(event, context)
+        except BudgetExhausted as e:
+            tracing.count("DeadlineExhausted")
+            tracing.annotate(deadline_exhausted=str(e))
+            logger.warning("Deadline budget exhausted, giving up: %s", e)
+            if retry:
+                raise RetryLater(f"Deadline budget exhausted at {e}") from None
+            return unavailable_response("Service busy, please retry")
+        finally:
+            _current_deadline.reset(token)
+
+    return wrapper
+
+
+class DeadlineSession(requests.Session):
+    """A requests session whose timeouts never outlast the invocation's budget"""
+
+    def request(self, method, url, timeout=None, **kwargs):
+        operation = f"{method.upper()} {url.split('?', 1)[0]}"
+        try:
+            return super().request(method, url, timeout=call_timeout(operation, timeout), **kwargs)
+        except requests.Timeout:
+            # Cut short by the budget rather than by the call's own timeout
+            budget = _current_deadline.get()
+            if budget is not None and budget.remaining() * 1000 < DEADLINE_MIN_CALL_MS:
+                raise BudgetExhausted(f"{operation}: timed out at the deadline") from None
+            raise
+
+
+def session():
+    return DeadlineSession()
+
+
+# --- boto3 -----------------------------------------------------------------
+
+def _check_budget(request, **kwargs):
+    budget = _current_deadline.get()
+    if budget is not None:
+        budget.check(f"AWS {request.url.split('://', 1)[-1].split('/', 1)[0]}")
+
+
+boto3.DEFAULT_SESSION or boto3.setup_default_session()
+boto3.DEFAULT_SESSION._session.set_default_client_config(Config(
+    connect_timeout=AWS_CONNECT_TIMEOUT,
+    read_timeout=AWS_READ_TIMEOUT,
+    retries={"mode": "standard", "max_attempts": AWS_MAX_ATTEMPTS}
+))
+# before-send runs for every attempt, so retries also stop when time runs out
+boto3.DEFAULT_SESSION.events.register("before-send", _check_budget, unique_id="deadline-before-send")
+
+
+# --- Stripe ----------------------------------------------------------------
+
+if stripe is not None:
+    _stripe_client = stripe_http_client.RequestsClient(
+        timeout=STRIPE_TIMEOUT, session=DeadlineSession(),
+        verify_ssl_certs=stripe.verify_ssl_certs, proxy=stripe.proxy
+    )
+    # Keep tracing's wrapper (if installed) around the deadline-aware client
+    if isinstance(stripe.default_http_client, tracing.TracedStripeClient):
+        stripe.default_http_client._client = _stripe_client
+    else:
+        stripe.default_http_client = _stripe_client
@@ -0,0 +1,91 @@
+"""
+Run independent side effects of a handler concurrently.
+
+    results = fanout.run([
+        ("email", lambda: send_notification_email(order)),
+        ("status_event", lambda: record_status_event(client_id, order_id, status))
+    ])
+
+Tasks go to a thread pool of FANOUT_MAX_WORKERS threads that lives as long
+as the container, so warm invocations don't pay for starting threads. Each
+task runs in a copy of the caller's context, which carries the current
+trace, log fields and deadline budget into the worker thread.
+
+A task that raises, or does not finish within its timeout (the smaller of
+FANOUT_TASK_TIMEOUT_SECONDS and the invocation's remaining budget), is
+logged and counted (SideEffectFailed, SideEffectTimeout) without affecting
+the others or the caller. A timed-out task cannot be stopped; it finishes in
+the background, and the handler's own response does not wait for it.
+
+Every task is recorded as a SideEffect span, and its outcome and duration
+as the side_effects annotation, so the handler's latency can be compared
+with its slowest side effect.
+"""
+import os
+import time
+import threading
+import contextvars
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import tracing
+import deadline
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+FANOUT_MAX_WORKERS = int(os.environ.get("FANOUT_MAX_WORKERS", "4"))
+FANOUT_TASK_TIMEOUT_SECONDS = float(os.environ.get("FANOUT_TASK_TIMEOUT_SECONDS", "5"))
+
+TaskResult = namedtuple("TaskResult", ["name", "ok", "value", "error", "duration_ms"])
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix="fanout")
+    return _executor
+
+
+def _timed(name, func):
+    started = time.perf_counter()
+    with tracing.span("SideEffect", name):
+        value = func()
+    return value, (time.perf_counter() - started) * 1000
+
+
+def run(tasks, timeout=FANOUT_TASK_TIMEOUT_SECONDS):
+    """Run (name, callable) pairs concurrently; a TaskResult per task, in order"""
+    submitted = time.perf_counter()
+    futures = [
+        (name, _pool().submit(contextvars.copy_context().run, _timed, name, func))
+        for name, func in tasks
+    ]
+
+    budget = deadline.remaining()
+    wait_until = submitted + (timeout if budget is None else min(timeout, budget))
+    results = []
+    for name, future in futures:
+        try:
+            value, duration_ms = future.result(timeout=max(wait_until - time.perf_counter(), 0))
+            results.append(TaskResult(name, True, value, None, duration_ms))
+        except TimeoutError:
+            tracing.count("SideEffectTimeout")
+            logger.warning("Side effect %s did not finish in time", name)
+            results.append(TaskResult(name, False, None, "timeout", (time.perf_counter() - submitted) * 1000))
+        except (Exception, deadline.BudgetExhausted) as e:
+            tracing.count("SideEffectFailed")
+            logger.error("Side effect %s failed: %s", name, e)
+            results.append(TaskResult(name, False, None, str(e), (time.perf_counter() - submitted) * 1000))
+
+    tracing.annotate(side_effects={
+        result.name: {"ok": result.ok, "ms": round(result.duration_ms, 1)} for result in results
+    })
+    logger.debug("Side effects finished", wall_ms=round((time.perf_counter() - submitted) * 1000, 1),
+                 failed=[result.name for result in results if not result.ok])
+    return results
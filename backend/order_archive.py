@@ -0,0 +1,321 @@
+import os
+import io
+import json
+import gzip
+import time
+import uuid
+import boto3
+import hashlib
+from decimal import Decimal
+from datetime import datetime, timezone
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+import tracing
+import deadline
+import profiling
+from order_store import TERMINAL_SHIPPING_STATUSES, unpack_order
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+# Initialize AWS resources
+dynamodb = boto3.resource("dynamodb")
+orders_table_name = os.environ.get("ORDERS_TABLE", "SteepleCo-Orders")
+table = dynamodb.Table(orders_table_name)
+
+# Orders in these states never change again and can leave the hot table
+TERMINAL_STATUSES = ["EXPIRED", "CANCELLED"]
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "90"))
+# Upper bound on orders moved per run, so a backlog is drained over several runs
+ARCHIVE_BATCH_LIMIT = int(os.environ.get("ARCHIVE_BATCH_LIMIT", "5000"))
+
+# The order index is split into 256 small JSON objects by order-ID hash, so a
+# lookup reads one shard instead of a single index that grows forever.
+INDEX_PREFIX = "index"
+SEGMENT_PREFIX = "orders"
+
+
+class S3ObjectStore:
+    """Archive storage in an S3 bucket"""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.client = boto3.client("s3")
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def get(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+    def get_range(self, key, offset, length):
+        response = self.client.get_object(
+            Bucket=self.bucket,
+            Key=key,
+            Range=f"bytes={offset}-{offset + length - 1}"
+        )
+        return response["Body"].read()
+
+    def list(self, prefix):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"]
+
+
+class LocalObjectStore:
+    """Filesystem stand-in for S3, used for local runs and tooling"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get_range(self, key, offset, length):
+        with open(self._path(key), "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def list(self, prefix):
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    yield key
+
+
+# Reused across invocations of a warm container
+_store = None
+
+
+def get_store():
+    """Return the configured archive store, or None when archiving is not set up"""
+    global _store
+    if _store is not None:
+        return _store
+
+    archive_dir = os.environ.get("ARCHIVE_DIR")
+    archive_bucket = os.environ.get("ARCHIVE_BUCKET")
+    if archive_dir:
+        _store = LocalObjectStore(archive_dir)
+    elif archive_bucket:
+        _store = S3ObjectStore(archive_bucket)
+
+    return _store
+
+
+def decimal_default(obj):
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    if isinstance(obj, set):
+        return sorted(obj)
+    raise TypeError("Object of type '%s' is not JSON serializable" % type(obj).__name__)
+
+
+def index_key(order_id):
+    shard = hashlib.md5(order_id.encode("utf-8")).hexdigest()[:2]
+    return f"{INDEX_PREFIX}/{shard}.json"
+
+
+def partition_date(order):
+    created_at = int(order.get("created_at") or order.get("updated_at") or 0)
+    return datetime.fromtimestamp(created_at, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+def is_archivable(order, cutoff):
+    if int(order.get("updated_at") or 0) >= cutoff:
+        return False
+    return (
+        order.get("status") in TERMINAL_STATUSES
+        or order.get("shipping_status") in TERMINAL_SHIPPING_STATUSES
+    )
+
+
+def write_segment(store, day, orders):
+    """
+    Write one date-partitioned segment of gzip-compressed JSON lines.
+    Every order is its own gzip member: the file is still a valid .jsonl.gz,
+    but a single order can be read back with one ranged GET.
+    Returns {order_id: [segment_key, offset, length]}.
+    """
+    segment_key = f"{SEGMENT_PREFIX}/dt={day}/{int(time.time())}-{uuid.uuid4().hex[:8]}.jsonl.gz"
+    buffer = io.BytesIO()
+    locations = {}
+
+    for order in orders:
+        line = json.dumps(order, default=decimal_default, separators=(",", ":")) + "\n"
+        member = gzip.compress(line.encode("utf-8"))
+        locations[order["order_id"]] = [segment_key, buffer.tell(), len(member)]
+        buffer.write(member)
+
+    store.put(segment_key, buffer.getvalue())
+    logger.info("Wrote archive segment", segment=segment_key, order_count=len(orders), size_bytes=buffer.tell())
+    return locations
+
+
+def update_index(store, locations):
+    """Merge new order locations into the index shards they hash to"""
+    shards = {}
+    for order_id, location in locations.items():
+        shards.setdefault(index_key(order_id), {})[order_id] = location
+
+    for key, entries in shards.items():
+        existing = store.get(key)
+        index = json.loads(existing) if existing else {}
+        index.update(entries)
+        store.put(key, json.dumps(index, separators=(",", ":")).encode("utf-8"))
+
+
+def read_segment(store, segment_key):
+    """Yield every order stored in a segment"""
+    data = store.get(segment_key)
+    if not data:
+        return
+    with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def lookup_archived_order(order_id, store=None):
+    """Fetch a single archived order, or None if it was never archived"""
+    store = store or get_store()
+    if store is None:
+        return None
+
+    index = store.get(index_key(order_id))
+    if not index:
+        return None
+
+    location = json.loads(index).get(order_id)
+    if not location:
+        return None
+
+    segment_key, offset, length = location
+    member = store.get_range(segment_key, offset, length)
+    return json.loads(gzip.decompress(member))
+
+
+def find_archivable_orders(table, cutoff, limit):
+    """Scan the orders table for terminal orders last touched before the cutoff"""
+    filter_expression = (
+        (Attr("status").is_in(TERMINAL_STATUSES) | Attr("shipping_status").is_in(TERMINAL_SHIPPING_STATUSES))
+        & Attr("updated_at").lt(cutoff)
+    )
+
+    orders = []
+    scan_kwargs = {"FilterExpression": filter_expression}
+    while len(orders) < limit:
+        response = table.scan(**scan_kwargs)
+        orders.extend(unpack_order(order) for order in response.get("Items", []) if is_archivable(order, cutoff))
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    return orders[:limit]
+
+
+def delete_archived(table, orders):
+    """
+    Delete archived orders from the hot table, each only while it is still
+    the version that was archived. Returns the IDs of the orders that
+    changed since, which stay where they are.
+    """
+    changed = []
+    for order in orders:
+        kwargs = {
+            "Key": {"order_id": order["order_id"]},
+            "ExpressionAttributeNames": {"#order_version": "version"}
+        }
+        if order.get("version") is None:
+            kwargs["ConditionExpression"] = "attribute_not_exists(#order_version)"
+        else:
+            kwargs["ConditionExpression"] = "#order_version = :version"
+            kwargs["ExpressionAttributeValues"] = {":version": order["version"]}
+        try:
+            table.delete_item(**kwargs)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            changed.append(order["order_id"])
+    return changed
+
+
+def archive_orders(table, store, older_than_days=ARCHIVE_AFTER_DAYS, limit=ARCHIVE_BATCH_LIMIT, now=None):
+    """
+    Move old terminal orders from the hot table into the archive.
+    Segments and the index are written before anything is deleted, so a failed
+    run leaves orders in the hot table rather than losing them. An order
+    written to after it was read is not deleted; the table copy is the one
+    readers see, and a later run archives it again.
+    """
+    now = int(now or time.time())
+    cutoff = now - older_than_days * 24 * 60 * 60
+
+    orders = find_archivable_orders(table, cutoff, limit)
+    if not orders:
+        return 0
+
+    partitions = {}
+    for order in orders:
+        partitions.setdefault(partition_date(order), []).append(order)
+
+    locations = {}
+    for day, day_orders in sorted(partitions.items()):
+        locations.update(write_segment(store, day, day_orders))
+
+    update_index(store, locations)
+
+    changed = delete_archived(table, orders)
+    if changed:
+        tracing.count("ArchiveOrderChanged", len(changed))
+        logger.warning("Orders changed while being archived, leaving them in the table", order_count=len(changed))
+
+    archived = len(locations) - len(changed)
+    logger.info("Archived orders", order_count=archived, partition_count=len(partitions))
+    return archived
+
+
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted(retry=True)
+def handler(event, context):
+    """
+    Archives terminal orders older than ARCHIVE_AFTER_DAYS.
+    This function is designed to run on a schedule (e.g., daily)
+    """
+    logger.info("Starting order archival")
+
+    store = get_store()
+    if store is None:
+        logger.error("Neither ARCHIVE_BUCKET nor ARCHIVE_DIR is configured")
+        return {
+            "statusCode": 500,
+            "body": json.dumps({"error": "Archive storage is not configured"})
+        }
+
+    # Errors fail the invocation, so EventBridge retries it and it shows as a Lambda error
+    archived = archive_orders(table, store)
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"message": f"Archived {archived} orders"})
+    }
@@ -2,39 +2,66 @@ import os
 import json
 import boto3
 import time
-import logging
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 
-# Set up logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+import tracing
+import deadline
+import profiling
+import shared_cache
+import stock
+from order_items import with_items_migration
+from order_store import STATUS_INDEX, get_order, with_version
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
 
 # Initialize AWS resources
 dynamodb = boto3.resource("dynamodb")
 orders_table_name = os.environ.get("ORDERS_TABLE", "SteepleCo-Orders")
 table = dynamodb.Table(orders_table_name)
 
+# Checkout gives an order this long to be paid (its expires_at)
+CHECKOUT_EXPIRY_SECONDS = 900
+
+def expired_pending_orders(current_time):
+    """
+    PENDING orders past their expires_at. They are found through the
+    ByStatus index (checkout sets updated_at when it creates an order, and
+    nothing changes it while the order is PENDING), so only those orders are
+    read rather than the whole table.
+    """
+    kwargs = {
+        "IndexName": STATUS_INDEX,
+        "KeyConditionExpression": Key("status").eq("PENDING") & Key("updated_at").lt(current_time - CHECKOUT_EXPIRY_SECONDS)
+    }
+    expired = []
+    while True:
+        response = table.query(**kwargs)
+        for entry in response.get("Items", []):
+            order = get_order(table, entry["order_id"])
+            if order and order.get("status") == "PENDING" and int(order.get("expires_at", 0)) < current_time:
+                expired.append(order)
+        if "LastEvaluatedKey" not in response:
+            return expired
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted(retry=True)
 def handler(event, context):
     """
     Cleans up abandoned checkout sessions
-    This function is designed to run on a schedule (e.g., every 15 minutes)
+    This function runs on a schedule every 15 minutes, so the prints of
+    limited editions held by abandoned checkouts go back on sale promptly
     """
     logger.info("Starting abandoned checkout cleanup")
     
     current_time = int(time.time())
     # Find orders that have expired (older than 15 minutes and still PENDING)
     try:
-        # Note: In a production environment, you would use a GSI or scan with filter
-        # for better performance on large tables
-        response = table.scan(
-            FilterExpression="expires_at < :now AND status = :status",
-            ExpressionAttributeValues={
-                ":now": current_time,
-                ":status": "PENDING"
-            }
-        )
-        
-        expired_orders = response.get("Items", [])
-        logger.info(f"Found {len(expired_orders)} expired checkout sessions")
+        expired_orders = expired_pending_orders(current_time)
+        logger.info("Found expired checkout sessions", count=len(expired_orders))
         
         # Mark each expired order
         for order in expired_orders:
@@ -42,16 +69,58 @@ def handler(event, context):
             if not order_id:
                 continue
                 
-            logger.info(f"Marking expired order: {order_id}")
+            logger.debug("Marking expired order", order_id=order_id)
             
-            table.update_item(
-                Key={"order_id": order_id},
-                UpdateExpression="SET status = :status, updated_at = :time",
-                ExpressionAttributeValues={
-                    ":status": "EXPIRED",
-                    ":time": current_time
-                }
+            update_expression = "SET #status_attr = :status, updated_at = :time"
+            expression_attr_values = {
+                ":status": "EXPIRED",
+                ":time": current_time
+            }
+            expression_attr_names = {
+                "#status_attr": "status"
+            }
+            reservations = order.get("stock_reservations")
+            if reservations:
+                update_expression += ", stock_released = :released"
+                expression_attr_values[":released"] = True
+            
+            # Rewrite legacy JSON-string items in the compact schema
+            update_expression = with_items_migration(
+                order, update_expression, expression_attr_names, expression_attr_values
             )
+            update_expression = with_version(update_expression, expression_attr_names, expression_attr_values)
+            
+            # Only if the order wasn't paid meanwhile
+            expression_attr_values[":pending"] = "PENDING"
+            if reservations:
+                # Its prints go back exactly once however often this runs
+                try:
+                    stock.release({"Update": {
+                        "TableName": orders_table_name,
+                        "Key": {"order_id": order_id},
+                        "UpdateExpression": update_expression,
+                        "ConditionExpression": "#status_attr = :pending AND attribute_not_exists(stock_released)",
+                        "ExpressionAttributeValues": expression_attr_values,
+                        "ExpressionAttributeNames": expression_attr_names
+                    }}, reservations)
+                except stock.OrderChanged:
+                    logger.info("Order changed before it expired, keeping its stock", order_id=order_id)
+                    continue
+            else:
+                try:
+                    table.update_item(
+                        Key={"order_id": order_id},
+                        UpdateExpression=update_expression,
+                        ConditionExpression="#status_attr = :pending",
+                        ExpressionAttributeValues=expression_attr_values,
+                        ExpressionAttributeNames=expression_attr_names
+                    )
+                except ClientError as e:
+                    if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                        raise
+                    logger.info("Order changed before it expired", order_id=order_id)
+                    continue
+            shared_cache.invalidate_order(order_id)
         
         return {
             "statusCode": 200,
@@ -60,10 +129,6 @@ def handler(event, context):
             })
         }
     except Exception as e:
-        logger.error(f"Error during checkout cleanup: {str(e)}")
-        return {
-            "statusCode": 500,
-            "body": json.dumps({
-                "error": f"Failed to clean up expired sessions: {str(e)}"
-            })
-        } 
\ No newline at end of file
+        # Fail the run, so the schedule's retry picks the rest up
+        logger.exception("Error during checkout cleanup: %s", e)
+        raise 
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""
+Claim-check consumers of the orders table stream.
+
+Status transitions of an order (PAYMENT_COMPLETE, ...) reach the consumers
+through DynamoDB Streams, with filter criteria in BackendStack deciding
+which records each one sees. The records carry whole images, but these
+consumers only take the order key and version from them (an OrderChange)
+and read the attributes they need with a consistent, projected read
+(order_store.get_order_snapshot). That way they act on the order as it is
+when they run, not as it was when the record was written, and the data
+isn't copied through invocation payloads.
+
+process() runs a consumer function for every change of a batch, concurrently
+through fanout, and reports the changes that failed as batch item failures
+so Lambda retries only those (the event source needs
+report_batch_item_failures).
+"""
+import os
+from collections import namedtuple
+
+import fanout
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+# How long a batch waits for its consumers (never past the invocation's budget)
+ORDER_EVENT_TIMEOUT_SECONDS = float(os.environ.get("ORDER_EVENT_TIMEOUT_SECONDS", "60"))
+
+OrderChange = namedtuple("OrderChange", ["order_id", "version", "sequence_number", "changed_at_ms"])
+
+
+class StaleSnapshot(Exception):
+    """The table returned an older version of the order than the stream record"""
+
+
+def changes(event):
+    """The OrderChange of each stream record in a Lambda event"""
+    result = []
+    for record in event.get("Records", []):
+        stream = record.get("dynamodb", {})
+        order_id = stream.get("Keys", {}).get("order_id", {}).get("S")
+        if not order_id:
+            continue
+        version = stream.get("NewImage", {}).get("version", {}).get("N")
+        created = stream.get("ApproximateCreationDateTime")
+        result.append(OrderChange(
+            order_id,
+            int(version) if version is not None else 0,
+            stream.get("SequenceNumber"),
+            int(float(created) * 1000) if created else None
+        ))
+    return result
+
+
+def check_snapshot(order, change):
+    """Raise StaleSnapshot if a snapshot predates the change it was read for"""
+    if order is not None and int(order.get("version", 0)) < change.version:
+        raise StaleSnapshot(f"order {change.order_id} is at version {order.get('version', 0)}, "
+                            f"the stream record at {change.version}")
+
+
+def process(event, consume):
+    """Call consume(change) for each change; the result is for Lambda's partial batch response"""
+    batch = changes(event)
+    tasks = [(change.order_id, lambda change=change: consume(change)) for change in batch]
+    results = fanout.run(tasks, timeout=ORDER_EVENT_TIMEOUT_SECONDS)
+
+    failures = [
+        {"itemIdentifier": change.sequence_number}
+        for change, result in zip(batch, results) if not result.ok
+    ]
+    logger.info("Processed order changes", count=len(batch), failures=len(failures))
+    return {"batchItemFailures": failures}
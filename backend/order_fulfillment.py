@@ -0,0 +1,70 @@
+"""
+Submits paid orders to Prodigi, driven by the orders table stream.
+
+BackendStack delivers only records where an order has just become
+PAYMENT_COMPLETE. For each one the order is read back (see order_events)
+and handed to the Prodigi order function in this process, so nothing about
+the order travels in an invocation payload.
+"""
+import os
+import boto3
+
+import tracing
+import deadline
+import profiling
+import order_events
+import prodigi_order
+from order_store import get_order_snapshot
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+dynamodb = boto3.resource("dynamodb")
+orders_table_name = os.environ.get("ORDERS_TABLE", "SteepleCo-Orders")
+table = dynamodb.Table(orders_table_name)
+
+# What prodigi_order needs to build the print order, and nothing else
+FULFILLMENT_ATTRIBUTES = (
+    "version", "status", "items", "shipping_details", "customer_email",
+    "correlation_id", "stage_timestamps", "prodigi_order_id"
+)
+
+
+def fulfill(change):
+    order = get_order_snapshot(table, change.order_id, FULFILLMENT_ATTRIBUTES)
+    if order is None:
+        logger.warning("Paid order no longer exists, not fulfilling", order_id=change.order_id)
+        return None
+    order_events.check_snapshot(order, change)
+    if order.get("prodigi_order_id"):
+        # A redelivered record, or the order was submitted some other way
+        tracing.count("DuplicateFulfillmentAttempt")
+        logger.info("Order already submitted to Prodigi", order_id=change.order_id,
+                    prodigi_order_id=order["prodigi_order_id"])
+        return None
+
+    result = prodigi_order.handler({
+        "order_id": change.order_id,
+        "order_data": order,
+        "correlation_id": order.get("correlation_id"),
+        "requested_at": change.changed_at_ms,
+        # Stable across redeliveries of the record, unlike a request ID
+        "claim_owner": f"stream:{change.sequence_number}"
+    }, None)
+    if result.get("statusCode") == 409:
+        # Either submitted meanwhile, or another worker holds the lease and
+        # may yet fail; only the first is done with
+        submitted = get_order_snapshot(table, change.order_id, ("prodigi_order_id",))
+        if submitted is not None and not submitted.get("prodigi_order_id"):
+            raise deadline.RetryLater("Another worker holds the order's fulfillment lease")
+    # A rejected order is recorded on it as ERROR, so retrying the record
+    # would only repeat the rejection; Prodigi being unreachable raises
+    # RetryLater instead, which fails the record and retries it.
+    return result.get("statusCode")
+
+
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted(retry=True)
+def handler(event, context):
+    return order_events.process(event, fulfill)
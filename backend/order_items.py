@@ -0,0 +1,123 @@
+"""
+Compact order-line schema.
+
+Orders store `items` as a native DynamoDB list of small maps:
+
+    [{"sku": "3", "qty": 2, "cents": 50}, ...]
+
+Names and images come from the catalog when a line is read. Orders written
+before this schema hold a JSON string of the full cart items instead; those
+are decoded on read and rewritten in the compact form the next time the
+order is updated (see `migrated_items`).
+"""
+import json
+
+from catalog import get_poster
+from order_store import pack_value
+
+MAX_QUANTITY = 100
+
+
+class InvalidItems(ValueError):
+    """Raised when cart items cannot be turned into order lines"""
+
+
+def compact_items(cart_items):
+    """
+    Convert cart items sent by the client into compact order lines.
+    Prices always come from the catalog, never from the client.
+    """
+    lines = []
+    for item in cart_items:
+        sku = str(item.get("id", ""))
+        poster = get_poster(sku)
+        if not poster:
+            raise InvalidItems(f"Unknown product: {sku or 'missing id'}")
+
+        try:
+            quantity = int(item.get("quantity", 1))
+        except (TypeError, ValueError):
+            raise InvalidItems(f"Invalid quantity for product {sku}")
+        if quantity < 1 or quantity > MAX_QUANTITY:
+            raise InvalidItems(f"Invalid quantity for product {sku}")
+
+        lines.append({"sku": sku, "qty": quantity, "cents": poster["price_cents"]})
+    return lines
+
+
+def legacy_lines(items):
+    """Convert legacy full cart items into compact lines, keeping what the catalog can't resolve"""
+    lines = []
+    for item in items:
+        sku = str(item.get("id", "unknown"))
+        line = {
+            "sku": sku,
+            "qty": int(item.get("quantity", 1)),
+            "cents": int(round(float(item.get("price", 0)) * 100))
+        }
+        if not get_poster(sku):
+            line["name"] = item.get("name", "Unknown item")
+            if item.get("image"):
+                line["image"] = item["image"]
+        lines.append(line)
+    return lines
+
+
+def order_lines(order):
+    """Return the compact lines of an order, whichever schema it was stored in"""
+    items = order.get("items") or []
+    if isinstance(items, str):
+        try:
+            items = json.loads(items)
+        except ValueError:
+            raise InvalidItems(f"Order {order.get('order_id')} has unparseable items")
+
+    if items and "sku" not in items[0]:
+        return legacy_lines(items)
+    return items
+
+
+def expand_line(line):
+    """Resolve a compact line into the item shape used by emails, Prodigi and the frontend"""
+    poster = get_poster(line["sku"]) or {}
+    cents = int(line["cents"])
+    return {
+        "id": line["sku"],
+        "name": poster.get("name") or line.get("name", "Unknown item"),
+        "image": poster.get("image") or line.get("image", ""),
+        "quantity": int(line["qty"]),
+        "price": cents / 100,
+        "price_cents": cents
+    }
+
+
+def load_items(order):
+    """Return the fully resolved items of an order"""
+    return [expand_line(line) for line in order_lines(order)]
+
+
+def migrated_items(order):
+    """
+    Return compact lines to write back if the order still uses the legacy
+    JSON-string schema, otherwise None.
+    """
+    if isinstance(order.get("items"), str):
+        try:
+            return order_lines(order)
+        except InvalidItems:
+            return None
+    return None
+
+
+def with_items_migration(order, update_expression, names, values):
+    """
+    Extend a SET update expression so it also rewrites legacy items, letting
+    writers migrate an order as part of an update they make anyway.
+    """
+    lines = migrated_items(order)
+    if lines is None:
+        return update_expression
+
+    names["#items_attr"] = "items"
+    values[":items"] = pack_value(lines)
+    return update_expression + ", #items_attr = :items"
@@ -0,0 +1,145 @@
+"""
+Emails the shop about each paid order, driven by the orders table stream.
+
+Gets the same PAYMENT_COMPLETE records as order_fulfillment and reads back
+only what the email shows (see order_events). Records are delivered at least
+once, so a retried batch can send an order's email twice.
+"""
+import os
+import boto3
+
+import tracing
+import deadline
+import profiling
+import order_events
+from order_items import load_items
+from order_store import get_order_snapshot
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+# Initialize AWS resources
+dynamodb = boto3.resource("dynamodb")
+orders_table_name = os.environ.get("ORDERS_TABLE", "SteepleCo-Orders")
+table = dynamodb.Table(orders_table_name)
+ses_client = boto3.client('ses')
+
+# Email configuration
+NOTIFICATION_EMAIL = "hello@hansenhome.ai"
+SES_SENDER_EMAIL = os.environ.get("SES_SENDER_EMAIL", "hello@hansenhome.ai")
+
+NOTIFICATION_ATTRIBUTES = ("version", "items", "customer_email", "amount", "amount_paid")
+
+def send_notification_email(order_data):
+    """Send an email notification about a new purchase using AWS SES"""
+    try:
+        # Extract order details
+        order_id = order_data.get('order_id', 'Unknown')
+        customer_email = order_data.get('customer_email') or 'Unknown'
+        amount = int(order_data.get('amount_paid') or order_data.get('amount') or 0)
+        # Convert amount from cents to dollars with proper formatting
+        amount_formatted = f"${(amount / 100):.2f}"
+        
+        # Resolve the order lines against the catalog
+        try:
+            items = load_items(order_data)
+        except ValueError:
+            items = []
+            
+        items_html = ""
+        for item in items:
+            items_html += f"<li>{item['name']} x {item['quantity']} - ${item['price']:.2f}</li>"
+        
+        # Create HTML version
+        html = f"""
+        <html>
+        <head>
+            <style>
+                body {{ font-family: Arial, sans-serif; line-height: 1.6; }}
+                .container {{ padding: 20px; }}
+                h2 {{ color: #256F8A; }}
+                .order-details {{ margin: 20px 0; }}
+                .order-total {{ font-weight: bold; margin-top: 20px; }}
+            </style>
+        </head>
+        <body>
+            <div class="container">
+                <h2>New Order Received!</h2>
+                <p>A new order has been placed and payment has been confirmed.</p>
+                
+                <div class="order-details">
+                    <p><strong>Order ID:</strong> {order_id}</p>
+                    <p><strong>Customer Email:</strong> {customer_email}</p>
+                    <p><strong>Total Amount:</strong> {amount_formatted}</p>
+                </div>
+                
+                <h3>Order Items:</h3>
+                <ul>
+                    {items_html}
+                </ul>
+                
+                <p class="order-total">Total: {amount_formatted}</p>
+                
+                <p>This order is being processed for fulfillment through Prodigi.</p>
+            </div>
+        </body>
+        </html>
+        """
+        
+        # Create plain text version
+        text = f"""
+        New Order Received!
+        
+        A new order has been placed and payment has been confirmed.
+        
+        Order ID: {order_id}
+        Customer Email: {customer_email}
+        Total Amount: {amount_formatted}
+        
+        This order is being processed for fulfillment through Prodigi.
+        """
+        
+        # Send email using AWS SES
+        response = ses_client.send_email(
+            Source=SES_SENDER_EMAIL,
+            Destination={
+                'ToAddresses': [NOTIFICATION_EMAIL]
+            },
+            Message={
+                'Subject': {
+                    'Data': f"New Order: {order_id}"
+                },
+                'Body': {
+                    'Text': {
+                        'Data': text
+                    },
+                    'Html': {
+                        'Data': html
+                    }
+                }
+            }
+        )
+        
+        logger.info("Notification email sent", message_id=response['MessageId'])
+        
+    except Exception as e:
+        logger.error("Failed to send notification email: %s", e,
+                     sender=SES_SENDER_EMAIL, recipient_address=NOTIFICATION_EMAIL)
+        # Fails the stream record, so the email is retried
+        raise
+
+
+def notify(change):
+    order = get_order_snapshot(table, change.order_id, NOTIFICATION_ATTRIBUTES)
+    if order is None:
+        logger.warning("Paid order no longer exists, not notifying", order_id=change.order_id)
+        return
+    order_events.check_snapshot(order, change)
+    send_notification_email(order)
+
+
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted(retry=True)
+def handler(event, context):
+    return order_events.process(event, notify)
@@ -1,22 +1,85 @@
 import os
 import json
 import boto3
-import logging
+from collections import namedtuple
+from decimal import Decimal
 
-# Configure logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+import tracing
+import deadline
+import profiling
+import shared_cache
+from cache import LRUCache
+from order_archive import lookup_archived_order
+from order_items import load_items
+from order_store import INTERNAL_ATTRIBUTES, get_order, get_order_version
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
 
 # Initialize AWS resources
 dynamodb = boto3.resource('dynamodb')
 orders_table_name = os.environ.get('ORDERS_TABLE', 'OrdersTable')
 table = dynamodb.Table(orders_table_name)
 
+# Rendered responses for recently requested orders. Within the TTL they are
+# served as they are; after it, a version-only read decides whether the
+# cached body is still current. Every order write bumps the version.
+ORDER_CACHE_SIZE = int(os.environ.get("ORDER_CACHE_SIZE", "512"))
+ORDER_CACHE_TTL_SECONDS = float(os.environ.get("ORDER_CACHE_TTL_SECONDS", "5"))
+order_cache = LRUCache(ORDER_CACHE_SIZE, ORDER_CACHE_TTL_SECONDS, name="OrderCache")
+
+CachedOrder = namedtuple("CachedOrder", ["version", "etag", "body"])
+
+def decimal_default(obj):
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    raise TypeError("Object of type '%s' is not JSON serializable" % type(obj).__name__)
+
+def etag_for(version):
+    return f'"v{version}"'
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match comparison (weak, as RFC 9110 asks for this header)"""
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
+
+def order_response(cached):
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Headers': '*',
+            'Access-Control-Expose-Headers': 'ETag',
+            'Content-Type': 'application/json',
+            'Cache-Control': 'no-cache',
+            'ETag': cached.etag
+        },
+        'body': cached.body
+    }
+
+def not_modified_response(etag):
+    return {
+        'statusCode': 304,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Headers': '*',
+            'Access-Control-Expose-Headers': 'ETag',
+            'Cache-Control': 'no-cache',
+            'ETag': etag
+        },
+        'body': ''
+    }
+
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted
 def handler(event, context):
     """
     Gets the status of an order
     """
-    logger.info(f"Received order status check event: {json.dumps(event)}")
+    logger.debug("Received order status check event", event=event)
     
     # Handle OPTIONS request for CORS
     if event.get('httpMethod') == 'OPTIONS':
@@ -49,13 +112,54 @@ def handler(event, context):
             })
         }
         
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    if_none_match = headers.get('if-none-match')
+        
     try:
-        logger.info(f"Retrieving order {order_id} from table {orders_table_name}")
-        response = table.get_item(Key={'order_id': order_id})
-        order = response.get('Item')
+        cached, fresh = order_cache.get(order_id)
+        if cached is not None and fresh and not if_none_match:
+            order_cache.hit()
+            return order_response(cached)
+        
+        # Another container may have rendered it; writers invalidate this entry.
+        # get_json counts the lookup as SharedCacheHit/SharedCacheMiss, so
+        # OrderCacheHit stays this container's own hit rate
+        shared = shared_cache.get_json(shared_cache.order_key(order_id))
+        if shared is not None:
+            cached = CachedOrder(shared['version'], etag_for(shared['version']), shared['body'])
+            order_cache.put(order_id, cached)
+            if if_none_match and etag_matches(if_none_match, cached.etag):
+                tracing.count("OrderNotModified")
+                return not_modified_response(cached.etag)
+            return order_response(cached)
+        
+        if cached is not None or if_none_match:
+            # Projected read: has the order changed since the client's or our copy?
+            version = get_order_version(table, order_id)
+            if version is not None:
+                etag = etag_for(version)
+                if if_none_match and etag_matches(if_none_match, etag):
+                    tracing.count("OrderNotModified")
+                    logger.debug("Order not modified", version=version)
+                    return not_modified_response(etag)
+                if cached is not None and cached.version == version:
+                    order_cache.put(order_id, cached)
+                    shared_cache.set_json(shared_cache.order_key(order_id), cached._asdict())
+                    order_cache.hit()
+                    return order_response(cached)
+        
+        order_cache.miss()
+        order = get_order(table, order_id)
+        
+        if not order:
+            # Old terminal orders are moved to the archive by order_archive
+            order = lookup_archived_order(order_id)
+            if order:
+                logger.info("Order served from the archive")
+                order['archived'] = True
         
         if not order:
-            logger.error(f"Order {order_id} not found")
+            logger.warning("Order not found")
             return {
                 'statusCode': 404,
                 'headers': {
@@ -68,30 +172,43 @@ def handler(event, context):
                 })
             }
             
-        logger.info(f"Found order: {json.dumps(order, default=str)}")
+        logger.debug("Found order", order=order)
+        
+        # The fulfillment lease changes without bumping the version, so it
+        # can't be part of a body served under the version's ETag
+        for name in INTERNAL_ATTRIBUTES:
+            order.pop(name, None)
         
-        # Clean up order data for response
-        if 'items' in order and isinstance(order['items'], str):
-            try:
-                order['items'] = json.loads(order['items'])
-            except:
-                pass
+        # Resolve order lines against the catalog for the response
+        try:
+            order['items'] = load_items(order)
+        except ValueError:
+            logger.warning("Order has unreadable items")
                 
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': '*',
-                'Content-Type': 'application/json'
-            },
-            'body': json.dumps({
-                'order': order,
-                'message': f"Order status: {order.get('status', 'UNKNOWN')}"
-            })
-        }
+        body = json.dumps({
+            'order': order,
+            'message': f"Order status: {order.get('status', 'UNKNOWN')}"
+        }, default=decimal_default)
+        
+        if order.get('archived'):
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Access-Control-Allow-Origin': '*',
+                    'Access-Control-Allow-Headers': '*',
+                    'Content-Type': 'application/json'
+                },
+                'body': body
+            }
+        
+        version = int(order.get('version', 0))
+        cached = CachedOrder(version, etag_for(version), body)
+        order_cache.put(order_id, cached)
+        shared_cache.set_json(shared_cache.order_key(order_id), cached._asdict())
+        return order_response(cached)
         
     except Exception as e:
-        logger.error(f"Error retrieving order status: {str(e)}")
+        logger.exception("Error retrieving order status: %s", e)
         return {
             'statusCode': 500,
             'headers': {
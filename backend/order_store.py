@@ -0,0 +1,289 @@
+"""
+Repository helpers for the orders table.
+
+Bulky attributes (shipping details, the item list and Prodigi error bodies)
+are zlib-compressed into binary attributes once their JSON form goes over
+COMPRESSION_THRESHOLD bytes. DynamoDB bills writes per 1 KB and reads per
+4 KB of item size, so keeping large orders under those boundaries saves
+capacity units on every access.
+
+Compressed values start with a one-byte format version so the codec can be
+changed later without rewriting old rows. Smaller values are stored natively
+and stay readable in the console.
+
+Each order also keeps a stage_timestamps map (stage name -> epoch
+milliseconds) recording when it first reached each point of its lifecycle,
+so latency between stages can be measured after the fact; updated_at only
+ever holds the latest change.
+
+Every write to an order increments its numeric version attribute (put_order
+starts it at 1, updates go through with_version). A reader holding a cached
+copy can check whether it is still current with a projected read of the
+version alone (get_order_version), which costs the minimum read unit however
+large the order is.
+
+Submitting an order to Prodigi is guarded by a lease on the order
+(claim_fulfillment): fulfillment_claimed_by names the worker and
+fulfillment_claim_expires (epoch seconds) when its claim lapses, so a worker
+that dies mid-submission doesn't block the order for good. The claim is
+granted only while the order has no prodigi_order_id. Claim writes leave the
+version alone, so the lease is one of the INTERNAL_ATTRIBUTES readers must
+not show: an order's version (and ETag) only covers what is left.
+
+While Prodigi is working on an order it carries fulfillment_shard and
+in_fulfillment_since (epoch seconds), the keys of the sparse InFulfillment
+index: with_in_fulfillment sets them when Prodigi accepts the order and
+without_in_fulfillment removes them once its shipping status is terminal, so
+the index holds only the orders still waiting on Prodigi, oldest first
+within each shard.
+"""
+import os
+import json
+import time
+import zlib
+from decimal import Decimal
+from boto3.dynamodb.types import Binary
+from botocore.exceptions import ClientError
+
+COMPRESSED_ATTRIBUTES = ("shipping_details", "items", "error_message")
+COMPRESSION_THRESHOLD = int(os.environ.get("COMPRESSION_THRESHOLD", "512"))
+
+# Format markers: the first byte of every compressed attribute
+ZLIB_JSON_V1 = b"\x01"
+
+# Longer than a Prodigi submission can take (its read timeout is 10 s)
+FULFILLMENT_LEASE_SECONDS = int(os.environ.get("FULFILLMENT_LEASE_SECONDS", "120"))
+
+# Sparse index of orders Prodigi has not finished. Its partition key is
+# spread over a few shards so the index has no single hot key; readers
+# query every shard.
+IN_FULFILLMENT_INDEX = os.environ.get("IN_FULFILLMENT_INDEX", "InFulfillment")
+IN_FULFILLMENT_SHARDS = int(os.environ.get("IN_FULFILLMENT_SHARDS", "4"))
+
+# Bookkeeping for the workers, never part of an order as customers see it
+INTERNAL_ATTRIBUTES = (
+    "fulfillment_claimed_by", "fulfillment_claim_expires", "fulfillment_shard", "in_fulfillment_since"
+)
+
+# Index of orders by status, most recently updated last (every status
+# write also sets updated_at); tools/reprocess_orders.py selects from it
+STATUS_INDEX = os.environ.get("STATUS_INDEX", "ByStatus")
+
+# Prodigi stages after which an order never changes again
+TERMINAL_SHIPPING_STATUSES = ["Complete", "Cancelled"]
+
+# Stages written to stage_timestamps, in lifecycle order. Prodigi callbacks
+# add their own stage names (in_progress, shipped, complete, ...) after these.
+ORDER_STAGES = (
+    "created",                # checkout stored the order
+    "payment_succeeded",      # Stripe created the payment_intent.succeeded event (1 s resolution)
+    "payment_confirmed",      # the webhook marked the order PAYMENT_COMPLETE
+    "fulfillment_requested",  # the PAYMENT_COMPLETE write reached the orders stream
+    "fulfillment_started",    # order_fulfillment picked the order up
+    "prodigi_accepted"        # Prodigi accepted the print order
+)
+
+
+def _json_default(obj):
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    if isinstance(obj, set):
+        return sorted(obj)
+    raise TypeError("Object of type '%s' is not JSON serializable" % type(obj).__name__)
+
+
+def pack_value(value):
+    """Compress a single attribute value if it is large enough to be worth it"""
+    if value is None or isinstance(value, (Binary, bytes)):
+        return value
+
+    encoded = json.dumps(value, default=_json_default, separators=(",", ":")).encode("utf-8")
+    if len(encoded) <= COMPRESSION_THRESHOLD:
+        return value
+
+    compressed = zlib.compress(encoded, 6)
+    if len(compressed) + 1 >= len(encoded):
+        return value
+    return Binary(ZLIB_JSON_V1 + compressed)
+
+
+def unpack_value(value):
+    """Reverse pack_value; values that were stored natively pass through"""
+    if isinstance(value, Binary):
+        value = value.value
+    if not isinstance(value, bytes) or not value:
+        return value
+
+    marker, payload = value[:1], value[1:]
+    if marker == ZLIB_JSON_V1:
+        # Numbers come back as Decimal, exactly like a native DynamoDB read
+        return json.loads(zlib.decompress(payload), parse_float=Decimal, parse_int=Decimal)
+    raise ValueError(f"Unknown compressed attribute format: {marker!r}")
+
+
+def pack_order(item):
+    """Return a copy of an order item ready to be written"""
+    packed = dict(item)
+    for name in COMPRESSED_ATTRIBUTES:
+        if name in packed:
+            packed[name] = pack_value(packed[name])
+    return packed
+
+
+def unpack_order(item):
+    """Decompress an order item read from the table (or a stream image)"""
+    if not item:
+        return item
+    for name in COMPRESSED_ATTRIBUTES:
+        if name in item:
+            item[name] = unpack_value(item[name])
+    return item
+
+
+def get_order(table, order_id, **kwargs):
+    """Read and decompress an order, or return None if it does not exist"""
+    response = table.get_item(Key={"order_id": order_id}, **kwargs)
+    return unpack_order(response.get("Item"))
+
+
+def put_order(table, item, **kwargs):
+    """Compress and write a whole order"""
+    item.setdefault("version", 1)
+    return table.put_item(Item=pack_order(item), **kwargs)
+
+
+def put_order_request(table_name, item, condition=None):
+    """
+    A TransactWriteItems Put of a whole order, for writing it together with
+    items of other tables (see stock.py)
+    """
+    item.setdefault("version", 1)
+    request = {"TableName": table_name, "Item": pack_order(item)}
+    if condition:
+        request["ConditionExpression"] = condition
+    return {"Put": request}
+
+
+def get_order_version(table, order_id):
+    """
+    The order's version from a read projected to that attribute alone, 0 for
+    orders written before versioning, or None if the order does not exist.
+    """
+    response = table.get_item(
+        Key={"order_id": order_id},
+        ProjectionExpression="order_id, #order_version",
+        ExpressionAttributeNames={"#order_version": "version"}
+    )
+    item = response.get("Item")
+    if item is None:
+        return None
+    return int(item.get("version", 0))
+
+
+def get_order_snapshot(table, order_id, attributes):
+    """
+    A strongly consistent read of just the named attributes of an order,
+    decompressed, or None if it does not exist. Stream consumers use this to
+    act on the order as it is now rather than on the image in the record.
+    """
+    attributes = ["order_id"] + [attribute for attribute in attributes if attribute != "order_id"]
+    names = {f"#snap{index}": attribute for index, attribute in enumerate(attributes)}
+    response = table.get_item(
+        Key={"order_id": order_id},
+        ProjectionExpression=", ".join(names),
+        ExpressionAttributeNames=names,
+        ConsistentRead=True
+    )
+    return unpack_order(response.get("Item"))
+
+
+def claim_fulfillment(table, order_id, owner, lease_seconds=FULFILLMENT_LEASE_SECONDS):
+    """
+    Take the order's fulfillment lease for owner; False if the order was
+    already submitted, or another worker holds an unexpired lease.
+    """
+    now = int(time.time())
+    try:
+        table.update_item(
+            Key={"order_id": order_id},
+            UpdateExpression="SET fulfillment_claimed_by = :owner, fulfillment_claim_expires = :expires",
+            ConditionExpression=(
+                "attribute_exists(order_id) AND attribute_not_exists(prodigi_order_id) AND "
+                "(attribute_not_exists(fulfillment_claimed_by) OR fulfillment_claimed_by = :owner "
+                "OR fulfillment_claim_expires < :now)"
+            ),
+            ExpressionAttributeValues={":owner": owner, ":expires": now + lease_seconds, ":now": now}
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return False
+    return True
+
+
+def release_fulfillment(table, order_id, owner):
+    """Give up a lease owner still holds, so another attempt needn't wait for it to expire"""
+    try:
+        table.update_item(
+            Key={"order_id": order_id},
+            UpdateExpression="REMOVE fulfillment_claimed_by, fulfillment_claim_expires",
+            ConditionExpression="fulfillment_claimed_by = :owner",
+            ExpressionAttributeValues={":owner": owner}
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+
+
+def with_version(update_expression, names, values):
+    """Extend an update expression (a SET clause) so it bumps the order's version"""
+    names["#order_version"] = "version"
+    values[":version_step"] = 1
+    return update_expression + " ADD #order_version :version_step"
+
+
+def fulfillment_shard(order_id):
+    """The order's InFulfillment shard; crc32 rather than hash(), which differs per process"""
+    return zlib.crc32(str(order_id).encode("utf-8")) % IN_FULFILLMENT_SHARDS
+
+
+def with_in_fulfillment(order_id, update_expression, names, values):
+    """Extend a SET update expression so it adds the order to the InFulfillment index"""
+    values[":ff_shard"] = fulfillment_shard(order_id)
+    values[":ff_since"] = int(time.time())
+    return (update_expression + ", fulfillment_shard = :ff_shard, "
+            "in_fulfillment_since = if_not_exists(in_fulfillment_since, :ff_since)")
+
+
+def without_in_fulfillment(update_expression):
+    """Extend an update expression so it takes the order out of the InFulfillment index"""
+    return update_expression + " REMOVE fulfillment_shard, in_fulfillment_since"
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def with_stage_timestamps(order, stages, update_expression, names, values):
+    """
+    Extend a SET update expression so it records when the order reached each
+    of the given stages ({stage: epoch ms, or None for now}). A stage keeps
+    the first time it was recorded, so retried writers don't move it.
+    """
+    stages = {stage: int(timestamp or now_ms()) for stage, timestamp in stages.items()}
+    if not stages:
+        return update_expression
+
+    names["#stage_ts"] = "stage_timestamps"
+    if isinstance((order or {}).get("stage_timestamps"), dict):
+        clauses = []
+        for index, (stage, timestamp) in enumerate(stages.items()):
+            names[f"#stage_{index}"] = stage
+            values[f":stage_{index}"] = timestamp
+            path = f"#stage_ts.#stage_{index}"
+            clauses.append(f"{path} = if_not_exists({path}, :stage_{index})")
+        return update_expression + ", " + ", ".join(clauses)
+
+    # Orders created before stage tracking have no map to set paths in
+    values[":stage_ts"] = stages
+    return update_expression + ", #stage_ts = if_not_exists(#stage_ts, :stage_ts)"
@@ -1,29 +1,36 @@
 import os
 import json
 import boto3
-import logging
-from boto3.dynamodb.conditions import Key
 
-# Set up logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+import tracing
+import deadline
+import profiling
+import rate_limit
+import shared_cache
+from status_events import latest_status_event
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
 
 # Initialize AWS resources
 dynamodb = boto3.resource("dynamodb")
 orders_table_name = os.environ.get("ORDERS_TABLE", "OrdersTable")
 table = dynamodb.Table(orders_table_name)
 
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted
+@rate_limit.limited("payment-status")
 def handler(event, context):
     """
     Checks for payment status updates for a specific client
     This allows the frontend to poll for confirmation from Stripe webhooks
     """
-    logger.info(f"Received payment status check: {event}")
-    logger.info(f"Using orders table: {orders_table_name}")
+    logger.debug("Received payment status check", event=event)
     
     # Handle preflight OPTIONS request for CORS
     if event.get('httpMethod') == 'OPTIONS':
-        logger.info("Handling OPTIONS preflight request")
+        logger.debug("Handling OPTIONS preflight request")
         return {
             'statusCode': 200,
             'headers': {
@@ -39,7 +46,7 @@ def handler(event, context):
     # Extract query parameters
     query_params = event.get('queryStringParameters', {})
     if not query_params:
-        logger.error("Missing query parameters in payment status check")
+        logger.warning("Missing query parameters in payment status check")
         return {
             'statusCode': 400,
             'headers': {
@@ -53,10 +60,10 @@ def handler(event, context):
     client_id = query_params.get('clientId')
     order_id = query_params.get('orderId')
     
-    logger.info(f"Payment status check for clientId: {client_id}, orderId: {order_id}")
+    logger.debug("Payment status check", client_id=client_id)
     
     if not client_id:
-        logger.error("Missing clientId parameter in payment status check")
+        logger.warning("Missing clientId parameter in payment status check")
         return {
             'statusCode': 400,
             'headers': {
@@ -70,28 +77,40 @@ def handler(event, context):
     # If we have an order_id, check that specific order
     if order_id:
         try:
-            logger.info(f"Checking specific order: {order_id}")
-            response = table.get_item(Key={'order_id': order_id})
-            order = response.get('Item')
-            
-            if not order:
-                logger.error(f"Order {order_id} not found in table")
-                return {
-                    'statusCode': 404,
-                    'headers': {
-                        'Access-Control-Allow-Origin': '*',
-                        'Access-Control-Allow-Headers': '*',
-                        'Access-Control-Allow-Methods': 'OPTIONS,GET'
-                    },
-                    'body': json.dumps({'error': f'Order {order_id} not found'})
-                }
-            
-            logger.info(f"Order found with status: {order.get('status', 'unknown')}")
+            # Polls for one order land on many containers; order writers
+            # invalidate the shared entry when the status changes
+            cache_key = shared_cache.payment_status_key(order_id)
+            cached = shared_cache.get_json(cache_key)
+            if cached is not None:
+                status = cached['status']
+            else:
+                response = table.get_item(
+                    Key={'order_id': order_id},
+                    ProjectionExpression='order_id, #status_attr',
+                    ExpressionAttributeNames={'#status_attr': 'status'}
+                )
+                order = response.get('Item')
+                
+                if not order:
+                    logger.warning("Order not found", table=orders_table_name)
+                    return {
+                        'statusCode': 404,
+                        'headers': {
+                            'Access-Control-Allow-Origin': '*',
+                            'Access-Control-Allow-Headers': '*',
+                            'Access-Control-Allow-Methods': 'OPTIONS,GET'
+                        },
+                        'body': json.dumps({'error': f'Order {order_id} not found'})
+                    }
+                
+                status = order.get('status', '')
+                confirmed = status in ('PAYMENT_COMPLETE', 'PROCESSING')
+                shared_cache.set_json(cache_key, {'status': status}, shared_cache.SHARED_CACHE_TTL_SECONDS
+                                      if confirmed else shared_cache.SHARED_CACHE_PENDING_TTL_SECONDS)
             
             # Check if payment is complete
-            status = order.get('status', '')
             if status == 'PAYMENT_COMPLETE' or status == 'PROCESSING':
-                logger.info(f"Order {order_id} has confirmed payment status: {status}")
+                logger.debug("Order has confirmed payment status", status=status)
                 return {
                     'statusCode': 200,
                     'headers': {
@@ -107,7 +126,7 @@ def handler(event, context):
                     })
                 }
             else:
-                logger.info(f"Order {order_id} payment not yet confirmed, current status: {status}")
+                logger.debug("Order payment not yet confirmed", status=status)
                 return {
                     'statusCode': 200,
                     'headers': {
@@ -123,7 +142,7 @@ def handler(event, context):
                     })
                 }
         except Exception as e:
-            logger.error(f"Error checking order status: {str(e)}")
+            logger.exception("Error checking order status: %s", e)
             return {
                 'statusCode': 500,
                 'headers': {
@@ -134,28 +153,11 @@ def handler(event, context):
                 'body': json.dumps({'error': f'Error checking order: {str(e)}'})
             }
     
-    # Check for status updates for this client
+    # Check the newest status event recorded for this client
     try:
-        # Query for status updates
-        # In a real implementation, you might want to use a secondary index
-        # Currently just scanning the table as a simple solution
-        response = table.scan(
-            FilterExpression="client_id = :cid",
-            ExpressionAttributeValues={
-                ":cid": client_id
-            }
-        )
-        
-        items = response.get('Items', [])
+        most_recent = latest_status_event(client_id, cached=True)
         
-        # Check if we have any status updates for this client
-        payment_complete_items = [item for item in items if item.get('status') in ['PAYMENT_COMPLETE', 'PROCESSING']]
-        
-        if payment_complete_items:
-            # Sort by timestamp to get the most recent
-            sorted_items = sorted(payment_complete_items, key=lambda x: x.get('timestamp', 0), reverse=True)
-            most_recent = sorted_items[0]
-            
+        if most_recent and most_recent.get('status') in ['PAYMENT_COMPLETE', 'PROCESSING']:
             return {
                 'statusCode': 200,
                 'headers': {
@@ -167,7 +169,7 @@ def handler(event, context):
                     'success': True,
                     'status': most_recent.get('status'),
                     'order_id': most_recent.get('order_id'),
-                    'timestamp': most_recent.get('timestamp'),
+                    'timestamp': int(most_recent.get('timestamp', 0)),
                     'message': 'Payment confirmed'
                 })
             }
@@ -185,7 +187,7 @@ def handler(event, context):
                 })
             }
     except Exception as e:
-        logger.error(f"Error checking status updates: {str(e)}")
+        logger.exception("Error checking status updates: %s", e)
         return {
             'statusCode': 500,
             'headers': {
@@ -250,7 +252,7 @@ def get_payment_status(event, context):
             })
         }
     except Exception as e:
-        logger.error(f"Error getting payment status: {str(e)}")
+        logger.exception("Error getting payment status: %s", e)
         return {
             'statusCode': 500,
             'headers': {
@@ -2,40 +2,71 @@ import os
 import json
 import boto3
 import stripe
-import logging
-import time
 import uuid
 from botocore.exceptions import ClientError
 
-# Configure logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+import tracing
+import deadline
+import profiling
+import rate_limit
+import config
+import stripe_webhook
+from order_store import get_order
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
 
 # Initialize AWS resources
 dynamodb = boto3.resource('dynamodb')
 orders_table_name = os.environ.get('ORDERS_TABLE', 'OrdersTable')
 table = dynamodb.Table(orders_table_name)
 
-# Initialize Stripe
-stripe.api_key = os.environ.get('STRIPE_SECRET_KEY', '')
+def retrieve_payment_intent(payment_intent_id):
+    api_key = config.require("STRIPE_SECRET_KEY")
+    try:
+        return stripe.PaymentIntent.retrieve(payment_intent_id, api_key=api_key)
+    except stripe.AuthenticationError:
+        # The cached key may have been rotated out; retry once with a fresh one
+        if not config.refresh() or config.get("STRIPE_SECRET_KEY") == api_key:
+            raise
+        logger.warning("Stripe rejected the cached secret key, retrying with the reloaded one")
+        return stripe.PaymentIntent.retrieve(payment_intent_id, api_key=config.require("STRIPE_SECRET_KEY"))
 
-# Import Prodigi order functions if available
-try:
-    from prodigi_order import create_prodigi_order
-    HAS_PRODIGI = True
-except ImportError:
-    logger.warning("Prodigi order module not available - will not send orders for fulfillment")
-    HAS_PRODIGI = False
+def succeeded_payment(order):
+    """
+    A stand-in payment_intent.succeeded event for the order's PaymentIntent,
+    or None unless Stripe reports it succeeded for this very order
+    """
+    payment_intent_id = order.get('payment_intent_id')
+    if not payment_intent_id:
+        return None
+    try:
+        intent = retrieve_payment_intent(payment_intent_id)
+    except stripe.InvalidRequestError as e:
+        logger.warning("Could not retrieve the order's payment intent: %s", e)
+        return None
+    if intent.get('status') != 'succeeded' or (intent.get('metadata') or {}).get('order_id') != order['order_id']:
+        return None
+    return {
+        'id': None,
+        'type': 'payment_intent.succeeded',
+        'created': None,
+        'data': {'object': intent}
+    }
 
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted
+@rate_limit.limited("payment-success")
 def handler(event, context):
     """
     Handles successful payment confirmations from the frontend
     """
-    logger.info(f"Received payment success event: {event}")
+    logger.debug("Received payment success event", event=event)
     
     # Handle preflight OPTIONS request for CORS
     if event.get('httpMethod') == 'OPTIONS':
-        logger.info("Handling OPTIONS preflight request")
+        logger.debug("Handling OPTIONS preflight request")
         return {
             'statusCode': 200,
             'headers': {
@@ -57,6 +88,7 @@ def handler(event, context):
             
         # Get order details
         order_id = body.get('orderId')
+        tracing.annotate(order_id=order_id)
         job_id = body.get('jobId')
         client_id = body.get('clientId')
         
@@ -73,8 +105,7 @@ def handler(event, context):
             
         # Retrieve the order from DynamoDB
         try:
-            response = table.get_item(Key={'order_id': order_id})
-            order = response.get('Item')
+            order = get_order(table, order_id)
             
             if not order:
                 return {
@@ -87,36 +118,13 @@ def handler(event, context):
                     'body': json.dumps({'error': f'Order {order_id} not found'})
                 }
                 
-            logger.info(f"Retrieved order: {order}")
+            logger.debug("Retrieved order", order=order)
             
-            # Check if the order has already been processed
+            # The webhook (or a replay of it) has confirmed the payment;
+            # fulfillment follows through the orders stream
             current_status = order.get('status', '')
-            if current_status == 'PAID':
-                logger.info(f"Order {order_id} already marked as PAID, checking for Prodigi processing")
-                
-                # If order is paid but not yet sent to Prodigi, do that now
-                if not order.get('prodigi_order_id') and HAS_PRODIGI:
-                    # Send to Prodigi for fulfillment
-                    try:
-                        prodigi_order_result = create_prodigi_order(order)
-                        prodigi_order_id = prodigi_order_result.get('prodigi_order_id')
-                        
-                        # Update order with Prodigi order ID
-                        table.update_item(
-                            Key={'order_id': order_id},
-                            UpdateExpression="SET prodigi_order_id = :poi, status = :status, updated_at = :time",
-                            ExpressionAttributeValues={
-                                ':poi': prodigi_order_id,
-                                ':status': 'PROCESSING',
-                                ':time': int(time.time())
-                            }
-                        )
-                        
-                        logger.info(f"Created Prodigi order {prodigi_order_id} for order {order_id}")
-                    except Exception as e:
-                        logger.error(f"Error creating Prodigi order: {str(e)}")
-                        # Continue anyway, as we can retry this later
-                
+            if current_status not in stripe_webhook.REPLAYABLE_STATUSES or order.get('prodigi_order_id'):
+                logger.info("Order already processed", order_status=current_status)
                 return {
                     'statusCode': 200,
                     'headers': {
@@ -127,52 +135,43 @@ def handler(event, context):
                     'body': json.dumps({
                         'message': 'Order already processed',
                         'order_id': order_id,
-                        'status': order.get('status')
+                        'status': current_status
                     })
                 }
-                
-            # Verify payment with Stripe if needed
-            # For security, you might want to double-check with Stripe here
-            # but in this case we're just trusting the client indication
-            
-            # Update order status to PAID
-            current_time = int(time.time())
-            
-            update_expr = "SET status = :status, updated_at = :time"
-            expr_values = {
-                ':status': 'PAID',
-                ':time': current_time
-            }
-            
-            table.update_item(
-                Key={'order_id': order_id},
-                UpdateExpression=update_expr,
-                ExpressionAttributeValues=expr_values
-            )
             
-            logger.info(f"Updated order {order_id} status to PAID")
+            # Anyone can call this endpoint; only Stripe can say the order was paid
+            payment = succeeded_payment(order)
+            if payment is None:
+                tracing.count("PaymentNotConfirmed")
+                logger.warning("Payment success reported for an order Stripe has no payment for",
+                               order_status=current_status)
+                return {
+                    'statusCode': 402,
+                    'headers': {
+                        'Access-Control-Allow-Origin': '*',
+                        'Access-Control-Allow-Headers': '*',
+                        'Access-Control-Allow-Methods': 'OPTIONS,POST'
+                    },
+                    'body': json.dumps({'error': 'Payment not confirmed', 'order_id': order_id})
+                }
             
-            # If Prodigi integration is available, create the order for fulfillment
-            if HAS_PRODIGI:
-                try:
-                    prodigi_order_result = create_prodigi_order(order)
-                    prodigi_order_id = prodigi_order_result.get('prodigi_order_id')
-                    
-                    # Update order with Prodigi order ID
-                    table.update_item(
-                        Key={'order_id': order_id},
-                        UpdateExpression="SET prodigi_order_id = :poi, status = :status, updated_at = :time",
-                        ExpressionAttributeValues={
-                            ':poi': prodigi_order_id,
-                            ':status': 'PROCESSING',
-                            ':time': current_time
-                        }
-                    )
-                    
-                    logger.info(f"Created Prodigi order {prodigi_order_id} for order {order_id}")
-                except Exception as e:
-                    logger.error(f"Error creating Prodigi order: {str(e)}")
-                    # Continue anyway as we successfully processed payment
+            # The webhook hasn't arrived yet: apply the payment the way it
+            # would, conditional on the order still awaiting it
+            result = stripe_webhook.apply_payment_succeeded(payment, replay=True)
+            if result['statusCode'] not in (200, 409):
+                logger.error("Failed to apply the confirmed payment", status_code=result['statusCode'])
+                return {
+                    'statusCode': 500,
+                    'headers': {
+                        'Access-Control-Allow-Origin': '*',
+                        'Access-Control-Allow-Headers': '*',
+                        'Access-Control-Allow-Methods': 'OPTIONS,POST'
+                    },
+                    'body': json.dumps({'error': 'Failed to record the payment'})
+                }
+            if result['statusCode'] == 200:
+                tracing.count("PaymentConfirmedBeforeWebhook")
+                logger.info("Applied the payment ahead of the webhook")
             
             return {
                 'statusCode': 200,
@@ -184,12 +183,12 @@ def handler(event, context):
                 'body': json.dumps({
                     'message': 'Payment successful',
                     'order_id': order_id,
-                    'status': 'PAID'
+                    'status': 'PAYMENT_COMPLETE'
                 })
             }
             
         except ClientError as e:
-            logger.error(f"DynamoDB error: {str(e)}")
+            logger.error("DynamoDB error: %s", e)
             return {
                 'statusCode': 500,
                 'headers': {
@@ -201,7 +200,7 @@ def handler(event, context):
             }
             
     except Exception as e:
-        logger.error(f"Error processing payment success: {str(e)}")
+        logger.exception("Error processing payment success: %s", e)
         return {
             'statusCode': 500,
             'headers': {
@@ -1,26 +1,75 @@
 import os
 import json
+import uuid
 import requests
-import logging
 import boto3
 import time
-import traceback
 
-# Configure logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+import tracing
+import deadline
+import profiling
+import config
+import shared_cache
+from order_items import load_items, with_items_migration
+from order_store import (
+    claim_fulfillment, get_order, now_ms, pack_value, release_fulfillment, with_in_fulfillment,
+    with_stage_timestamps, with_version
+)
+from structured_logging import get_logger, lazy
+
+logger = get_logger(__name__)
 
 # Initialize AWS resources
 dynamodb = boto3.resource('dynamodb')
 orders_table_name = os.environ.get('ORDERS_TABLE', 'OrdersTable')
 table = dynamodb.Table(orders_table_name)
 
-def create_prodigi_order(order_data):
+# Prodigi API base URL; overridable so local harnesses can point at a mock
+PRODIGI_API_URL = os.environ.get("PRODIGI_API_URL", "https://api.sandbox.prodigi.com/v4.0")
+# (connect, read) seconds; the invocation's remaining budget may cut these shorter
+PRODIGI_TIMEOUT = (3.05, float(os.environ.get("PRODIGI_READ_TIMEOUT", "10")))
+
+# Pooled connections, with timeouts bounded by the deadline budget
+http = deadline.session()
+
+def record_failure(order_id, order_data, error_message, stages):
+    """Mark the order as failed, keeping the error and when it happened"""
+    expression_attr_values = {
+        ":status": "ERROR",
+        ":error": pack_value(error_message),
+        ":time": int(time.time())
+    }
+    expression_attr_names = {
+        "#status_attr": "status"
+    }
+    update_expression = with_stage_timestamps(
+        order_data, dict(stages, prodigi_failed=None),
+        "SET #status_attr = :status, error_message = :error, updated_at = :time",
+        expression_attr_names, expression_attr_values
+    )
+    update_expression = with_version(update_expression, expression_attr_names, expression_attr_values)
+    table.update_item(
+        Key={"order_id": order_id},
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues=expression_attr_values,
+        ExpressionAttributeNames=expression_attr_names
+    )
+    shared_cache.invalidate_order(order_id)
+
+def release_claim(order_id, owner):
+    """Let another attempt submit the order straight away instead of after the lease expires"""
+    try:
+        release_fulfillment(table, order_id, owner)
+    except Exception as e:
+        logger.warning("Failed to release fulfillment claim: %s", e)
+
+def create_prodigi_order(order_data, context=None):
     """
     Helper function for creating a Prodigi order from order data
-    This is used by other Lambda functions via import
+    This is used by other Lambda functions via import; pass the caller's
+    Lambda context so the lease is taken under its request ID
     """
-    logger.info(f"Creating Prodigi order via helper function")
+    logger.debug("Creating Prodigi order via helper function")
     
     # Pass the order data to the Lambda handler in the expected format
     event = {
@@ -29,7 +78,7 @@ def create_prodigi_order(order_data):
     }
     
     # Use the main handler
-    result = handler(event, {})
+    result = handler(event, context)
     
     # Extract response body
     if isinstance(result.get("body"), str):
@@ -44,12 +93,15 @@ def create_prodigi_order(order_data):
         "message": response_body.get("message")
     }
 
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted(retry=True)
 def handler(event, context):
     """
     Creates a print order with Prodigi after payment is confirmed
     """
-    logger.info(f"Received Prodigi order request: {json.dumps(event, default=str)}")
-    logger.info(f"Using orders table: {orders_table_name}")
+    logger.debug("Received Prodigi order request", event=event)
+    started_at = now_ms()
     
     # Extract order details from the event
     order_id = event.get("order_id")
@@ -65,43 +117,46 @@ def handler(event, context):
 
     # If no order data provided, try to get it from DynamoDB
     if not order_data:
-        logger.info(f"No order data in event, retrieving from DynamoDB")
+        logger.debug("No order data in event, retrieving from DynamoDB")
         try:
-            response = table.get_item(Key={"order_id": order_id})
-            order_data = response.get("Item", {})
+            order_data = get_order(table, order_id) or {}
             
             if not order_data:
-                logger.error(f"Order {order_id} not found in database")
+                logger.error("Order not found in database", table=orders_table_name)
                 return {
                     "statusCode": 404,
                     "body": json.dumps({"error": f"Order {order_id} not found"})
                 }
             
-            logger.info(f"Retrieved order from DynamoDB: {json.dumps(order_data, default=str)}")
+            logger.debug("Retrieved order from DynamoDB", order=order_data)
         except Exception as e:
-            logger.error(f"Error retrieving order: {str(e)}")
+            logger.exception("Error retrieving order: %s", e)
             return {
                 "statusCode": 500,
                 "body": json.dumps({"error": f"Error retrieving order: {str(e)}"})
             }
     
-    # Parse items from order data
-    items_json = order_data.get("items", "[]")
-    if isinstance(items_json, str):
-        try:
-            items = json.loads(items_json)
-            logger.info(f"Parsed items from JSON string, found {len(items)} items")
-        except Exception as e:
-            logger.error(f"Error parsing items JSON: {str(e)}")
-            return {
-                "statusCode": 400,
-                "body": json.dumps({"error": f"Invalid items data: {str(e)}"})
-            }
-    else:
-        items = items_json
+    # Orders from before correlation IDs use their order ID instead
+    correlation_id = event.get("correlation_id") or order_data.get("correlation_id") or order_id
+    tracing.annotate(correlation_id=correlation_id)
+    
+    # The stream's delivery delay shows up between these two stages
+    stages = {"fulfillment_started": started_at}
+    if event.get("requested_at"):
+        stages["fulfillment_requested"] = event["requested_at"]
+    
+    # Resolve order lines against the catalog
+    try:
+        items = load_items(order_data)
+    except ValueError as e:
+        logger.error("Error reading order items: %s", e)
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": f"Invalid items data: {str(e)}"})
+        }
     
     if not items:
-        logger.error(f"No items found in order {order_id}")
+        logger.error("No items found in order")
         return {
             "statusCode": 400,
             "body": json.dumps({"error": "Order has no items"})
@@ -110,29 +165,27 @@ def handler(event, context):
     # Get customer email
     customer_email = order_data.get("customer_email") or payment_intent.get("receipt_email")
     if not customer_email:
-        logger.error(f"No customer email found for order {order_id}")
+        logger.error("No customer email found for order")
         return {
             "statusCode": 400,
             "body": json.dumps({"error": "Missing customer email"})
         }
     
-    logger.info(f"Processing order {order_id} with {len(items)} items for {customer_email}")
+    logger.info("Processing order", item_count=len(items))
     
     # Get customer shipping details
     shipping_details = order_data.get("shipping_details", {})
     if not shipping_details:
-        logger.error(f"No shipping details found for order {order_id}")
+        logger.error("No shipping details found for order")
         return {
             "statusCode": 400,
             "body": json.dumps({"error": "Missing shipping details"})
         }
         
-    logger.info(f"Shipping details: {json.dumps(shipping_details, default=str)}")
+    logger.debug("Shipping details", shipping_details=shipping_details)
     
     # Get Prodigi Sandbox API key - ONLY use sandbox for testing
-    prodigi_api_key = os.environ.get("PRODIGI_SANDBOX_API_KEY")
-    logger.info(f"Available Prodigi env vars: {[k for k in os.environ.keys() if 'PRODIGI' in k]}")
-    
+    prodigi_api_key = config.get("PRODIGI_SANDBOX_API_KEY")
     if not prodigi_api_key:
         logger.error("PRODIGI_SANDBOX_API_KEY not set in environment variables")
         return {
@@ -140,10 +193,6 @@ def handler(event, context):
             "body": json.dumps({"error": "Missing Prodigi Sandbox API configuration"})
         }
     
-    # Show a masked version of the API key for debugging
-    masked_key = prodigi_api_key[:4] + '*' * 5
-    logger.info(f"Using Prodigi API key: {masked_key}")
-    
     # Build the Prodigi order payload
     prodigi_items = []
     for item in items:
@@ -166,7 +215,7 @@ def handler(event, context):
         # Extract image file from item
         image_url = item.get("image", "")
         if not image_url:
-            logger.error(f"No image URL found for item: {json.dumps(item, default=str)}")
+            logger.error("No image URL found for item", item=item)
             continue
             
         # Transform relative path to absolute URL if needed
@@ -231,7 +280,13 @@ def handler(event, context):
             }
         },
         "items": prodigi_items,
-        "idempotencyKey": order_id
+        "idempotencyKey": order_id,
+        "merchantReference": order_id,
+        # Echoed back on Prodigi's callbacks so they join the same trace
+        "metadata": {
+            "order_id": order_id,
+            "correlation_id": correlation_id
+        }
     }
     
     # Send order to Prodigi
@@ -242,68 +297,48 @@ def handler(event, context):
     
     # Determine API endpoint based on environment
     # When using PRODIGI_SANDBOX_API_KEY, always use sandbox endpoint
-    prodigi_url = "https://api.sandbox.prodigi.com/v4.0/orders"
-    logger.info("Using Prodigi SANDBOX API endpoint")
+    prodigi_url = f"{PRODIGI_API_URL}/orders"
+    logger.debug("Prodigi payload", url=prodigi_url, payload=prodigi_payload)
     
-    logger.info(f"Sending order to Prodigi")
-    logger.info(f"Prodigi payload: {json.dumps(prodigi_payload, default=str)}")
+    # Only the worker holding the order's lease submits it; stream consumer
+    # retries, the reconciler tools and manual runs may all get here. A
+    # retried stream record claims under the same owner, so it can finish
+    # what an earlier attempt left under the lease.
+    claim_owner = event.get("claim_owner") or getattr(context, "aws_request_id", None) or uuid.uuid4().hex
+    if not claim_fulfillment(table, order_id, claim_owner):
+        tracing.count("DuplicateFulfillmentAttempt")
+        logger.info("Order already submitted or being submitted, not sending it again")
+        return {
+            "statusCode": 409,
+            "body": json.dumps({"message": "Order already submitted to Prodigi"})
+        }
+    prodigi_order_id = None
     
     try:
-        response = requests.post(prodigi_url, headers=headers, json=prodigi_payload)
+        with tracing.span("Prodigi", "POST /orders") as prodigi_span:
+            response = http.post(prodigi_url, headers=headers, json=prodigi_payload, timeout=PRODIGI_TIMEOUT)
+            prodigi_span.error = response.status_code >= 400
         
-        logger.info(f"Prodigi API response status: {response.status_code}")
-        logger.info(f"Prodigi API response body: {response.text}")
+        logger.info("Prodigi API responded", status_code=response.status_code)
+        logger.debug("Prodigi API response body", body=lazy(lambda: response.text))
         
         if response.status_code in [200, 201, 202]:
-            # Success - update the order with the Prodigi ID
             order_response = response.json()
-            prodigi_order_id = order_response.get("id")
-            
-            if prodigi_order_id:
-                update_response = table.update_item(
-                    Key={"order_id": order_id},
-                    UpdateExpression="SET prodigi_order_id = :poi, #status_attr = :status, updated_at = :time",
-                    ExpressionAttributeValues={
-                        ":poi": prodigi_order_id,
-                        ":status": "PROCESSING",
-                        ":time": int(time.time())
-                    },
-                    ExpressionAttributeNames={
-                        "#status_attr": "status"
-                    },
-                    ReturnValues="ALL_NEW"
-                )
-                
-                logger.info(f"Updated order with Prodigi order ID: {prodigi_order_id}")
-                
-            return {
-                "statusCode": 200,
-                "body": json.dumps({
-                    "message": "Order submitted to Prodigi successfully",
-                    "prodigi_order_id": prodigi_order_id
-                })
-            }
+            # Prodigi v4 wraps the created order: {"outcome": ..., "order": {"id": ...}}
+            prodigi_order_id = (order_response.get("order") or {}).get("id") or order_response.get("id")
         else:
             # Error from Prodigi API
             error_message = f"Prodigi API error: {response.text}"
-            logger.error(error_message)
+            logger.error("Prodigi API error", status_code=response.status_code, body=response.text)
             
             if response.status_code == 401:
-                logger.error("Authentication failed. Check your API key.")
+                if config.refresh() and config.get("PRODIGI_SANDBOX_API_KEY") != prodigi_api_key:
+                    # The key was rotated after it was cached; Lambda runs us again with the new one
+                    raise deadline.RetryLater("Prodigi rejected the cached API key")
+                logger.error("Prodigi authentication failed, check the API key")
             
             # Update the order with the error
-            table.update_item(
-                Key={"order_id": order_id},
-                UpdateExpression="SET #status_attr = :status, error_message = :error, updated_at = :time",
-                ExpressionAttributeValues={
-                    ":status": "ERROR",
-                    ":error": error_message,
-                    ":time": int(time.time())
-                },
-                ExpressionAttributeNames={
-                    "#status_attr": "status"
-                }
-            )
+            record_failure(order_id, order_data, error_message, stages)
             
             return {
                 "statusCode": response.status_code,
@@ -313,30 +348,91 @@ def handler(event, context):
                 })
             }
     
+    except deadline.RetryLater:
+        raise
+    
+    except (requests.Timeout, requests.ConnectionError) as e:
+        # Prodigi may or may not have the order; the idempotency key makes a
+        # retry safe, so leave the order as it is and let Lambda redeliver
+        tracing.count("ProdigiUnavailable")
+        logger.warning("Prodigi did not respond, will retry: %s", e)
+        raise deadline.RetryLater(f"Prodigi unavailable: {e}") from e
+    
     except Exception as e:
         # Handle any other errors
         error_message = f"Error processing order: {str(e)}"
-        logger.error(error_message)
-        logger.error(traceback.format_exc())
+        logger.exception(error_message)
         
         # Update the order with the error
         try:
-            table.update_item(
-                Key={"order_id": order_id},
-                UpdateExpression="SET #status_attr = :status, error_message = :error, updated_at = :time",
-                ExpressionAttributeValues={
-                    ":status": "ERROR",
-                    ":error": error_message,
-                    ":time": int(time.time())
-                },
-                ExpressionAttributeNames={
-                    "#status_attr": "status"
-                }
-            )
+            record_failure(order_id, order_data, error_message, stages)
         except Exception as update_error:
-            logger.error(f"Failed to update order status: {str(update_error)}")
+            logger.error("Failed to update order status: %s", update_error)
         
         return {
             "statusCode": 500,
             "body": json.dumps({"error": error_message})
-        } 
\ No newline at end of file
+        }
+    
+    finally:
+        # Once Prodigi has the order the lease is kept, so nobody submits it again
+        if not prodigi_order_id:
+            release_claim(order_id, claim_owner)
+    
+    if prodigi_order_id:
+        # Success - update the order with the Prodigi ID
+        update_expression = "SET prodigi_order_id = :poi, #status_attr = :status, updated_at = :time"
+        expression_attr_values = {
+            ":poi": prodigi_order_id,
+            ":status": "PROCESSING",
+            ":time": int(time.time())
+        }
+        expression_attr_names = {
+            "#status_attr": "status"
+        }
+        
+        # Rewrite legacy JSON-string items in the compact schema
+        update_expression = with_items_migration(
+            order_data, update_expression, expression_attr_names, expression_attr_values
+        )
+        
+        # prodigi_reconciler finds orders whose callbacks never came here
+        update_expression = with_in_fulfillment(
+            order_id, update_expression, expression_attr_names, expression_attr_values
+        )
+        stages["prodigi_accepted"] = None
+        update_expression = with_stage_timestamps(
+            order_data, stages, update_expression, expression_attr_names, expression_attr_values
+        )
+        update_expression = with_version(update_expression, expression_attr_names, expression_attr_values)
+        if order_data.get("error_message") is not None:
+            # A re-submitted order no longer carries the earlier attempt's error
+            update_expression += " REMOVE error_message"
+        
+        try:
+            table.update_item(
+                Key={"order_id": order_id},
+                UpdateExpression=update_expression,
+                ExpressionAttributeValues=expression_attr_values,
+                ExpressionAttributeNames=expression_attr_names
+            )
+        except Exception as e:
+            # Prodigi accepted the order, so it isn't an ERROR. Failing the
+            # invocation leaves the lease in place; once it expires the stream
+            # retry submits again under the same idempotency key, gets the
+            # same Prodigi order back and records it.
+            tracing.count("ProdigiAcceptedNotRecorded")
+            logger.error("Prodigi accepted the order but recording it failed: %s", e,
+                         prodigi_order_id=prodigi_order_id)
+            raise
+        shared_cache.invalidate_order(order_id)
+        
+        logger.info("Updated order with Prodigi order ID", prodigi_order_id=prodigi_order_id)
+    
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "message": "Order submitted to Prodigi successfully",
+            "prodigi_order_id": prodigi_order_id
+        })
+    }
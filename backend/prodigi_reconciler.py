@@ -0,0 +1,231 @@
+"""
+Catches up on Prodigi status changes whose callbacks never arrived.
+
+prodigi_webhook is the only thing that moves an order along once Prodigi has
+accepted it, so a lost callback leaves the order PROCESSING for good. This
+job runs on a schedule and reads the orders still waiting on Prodigi from
+the sparse InFulfillment index (see order_store) instead of scanning the
+table. Orders that have waited longer than RECONCILE_MIN_AGE_SECONDS are
+looked up in Prodigi's orders API, RECONCILE_CONCURRENCY at a time over one
+pooled session, and any status that differs from the order's is recorded
+through prodigi_webhook.apply_shipping_status, the webhook's own
+conditional update.
+
+Orders stay in the index for the days Prodigi takes to ship them, so each
+run checks the next RECONCILE_BATCH_LIMIT of them rather than the oldest:
+the checkpoint holds a cursor per index shard, and a shard read to its end
+starts again from its oldest order on the next run. Orders Prodigi has no
+record of are taken out of the index (ProdigiOrderUnknown) for an operator
+to look into, rather than being asked about on every pass.
+
+Each run sets FulfillmentBacklogAge, the seconds since the oldest order in
+the index reached Prodigi, and FulfillmentBacklog, how many orders are old
+enough to be checked.
+"""
+import os
+import time
+import heapq
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.adapters import HTTPAdapter
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+import tracing
+import deadline
+import profiling
+import config
+import checkpoints
+import shared_cache
+import prodigi_webhook
+from order_store import (
+    IN_FULFILLMENT_INDEX, IN_FULFILLMENT_SHARDS, get_order_snapshot, with_version, without_in_fulfillment
+)
+from prodigi_order import PRODIGI_API_URL, PRODIGI_TIMEOUT
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+table = prodigi_webhook.table
+
+JOB_NAME = "prodigi-reconciler"
+
+# Callbacks normally arrive within minutes; only check orders older than this
+RECONCILE_MIN_AGE_SECONDS = int(os.environ.get("RECONCILE_MIN_AGE_SECONDS", "3600"))
+# Upper bound on orders checked per run, split between the index shards
+RECONCILE_BATCH_LIMIT = int(os.environ.get("RECONCILE_BATCH_LIMIT", "200"))
+RECONCILE_CONCURRENCY = int(os.environ.get("RECONCILE_CONCURRENCY", "8"))
+
+# Enough pooled connections for every worker to keep its own
+http = deadline.session()
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=RECONCILE_CONCURRENCY)
+http.mount("https://", _adapter)
+http.mount("http://", _adapter)
+
+SNAPSHOT_ATTRIBUTES = ("shipping_status", "stage_timestamps", "customer_email", "prodigi_order_id")
+
+
+def shard_entries(shard, due_before, limit, after=None):
+    """
+    Up to limit index entries of one shard that reached Prodigi before
+    due_before, oldest first, starting after the cursor `after`. Returns
+    the entries and the cursor to continue from, or None at the shard's end.
+    """
+    kwargs = {
+        "IndexName": IN_FULFILLMENT_INDEX,
+        "KeyConditionExpression": Key("fulfillment_shard").eq(shard) & Key("in_fulfillment_since").lt(due_before),
+        "ScanIndexForward": True
+    }
+    if after:
+        kwargs["ExclusiveStartKey"] = dict(after, fulfillment_shard=shard)
+    entries = []
+    while len(entries) < limit:
+        response = table.query(Limit=limit - len(entries), **kwargs)
+        entries.extend(response.get("Items", []))
+        if "LastEvaluatedKey" not in response:
+            return entries, None
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    last = entries[-1]
+    return entries, {"order_id": last["order_id"], "in_fulfillment_since": int(last["in_fulfillment_since"])}
+
+
+def next_in_fulfillment(due_before, limit, cursors):
+    """
+    The next due entries of every shard, oldest first, and the cursors to
+    save for the next run (a shard read to its end starts over)
+    """
+    per_shard = max(1, limit // IN_FULFILLMENT_SHARDS)
+    shards, next_cursors = [], {}
+    for shard in range(IN_FULFILLMENT_SHARDS):
+        entries, cursor = shard_entries(shard, due_before, per_shard, cursors.get(str(shard)))
+        shards.append(entries)
+        next_cursors[str(shard)] = cursor
+    merged = heapq.merge(*shards, key=lambda entry: entry["in_fulfillment_since"])
+    return list(merged), next_cursors
+
+
+def backlog(due_before):
+    """(epoch seconds the oldest order in the index reached Prodigi or None, orders due)"""
+    oldest, due = None, 0
+    for shard in range(IN_FULFILLMENT_SHARDS):
+        condition = Key("fulfillment_shard").eq(shard)
+        response = table.query(IndexName=IN_FULFILLMENT_INDEX, KeyConditionExpression=condition, Limit=1)
+        for entry in response.get("Items", []):
+            since = int(entry["in_fulfillment_since"])
+            oldest = since if oldest is None else min(oldest, since)
+
+        kwargs = {
+            "IndexName": IN_FULFILLMENT_INDEX,
+            "KeyConditionExpression": condition & Key("in_fulfillment_since").lt(due_before),
+            "Select": "COUNT"
+        }
+        while True:
+            response = table.query(**kwargs)
+            due += response.get("Count", 0)
+            if "LastEvaluatedKey" not in response:
+                break
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    return oldest, due
+
+
+def prodigi_status(prodigi_order_id, api_key):
+    """The order's current stage at Prodigi (InProgress, Complete, ...), or None if it is unknown there"""
+    url = f"{PRODIGI_API_URL}/orders/{prodigi_order_id}"
+    with tracing.span("Prodigi", "GET /orders/{id}") as prodigi_span:
+        response = http.get(url, headers={"X-API-Key": api_key}, timeout=PRODIGI_TIMEOUT)
+        prodigi_span.error = response.status_code >= 400 and response.status_code != 404
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return ((response.json().get("order") or {}).get("status") or {}).get("stage")
+
+
+def forget_unknown(order_id, prodigi_order_id):
+    """Take an order Prodigi doesn't know out of the index, flagging it for an operator"""
+    expression_attr_names = {}
+    expression_attr_values = {":now": int(time.time()), ":prodigi_order_id": prodigi_order_id}
+    update_expression = with_version("SET prodigi_unknown_at = :now", expression_attr_names, expression_attr_values)
+    try:
+        table.update_item(
+            Key={"order_id": order_id},
+            UpdateExpression=without_in_fulfillment(update_expression),
+            # Unless it was resubmitted meanwhile
+            ConditionExpression="prodigi_order_id = :prodigi_order_id",
+            ExpressionAttributeNames=expression_attr_names,
+            ExpressionAttributeValues=expression_attr_values
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return
+    shared_cache.invalidate_order(order_id)
+
+
+def reconcile(entry, api_key):
+    """Bring one order in line with Prodigi; returns what happened to it"""
+    order_id = entry["order_id"]
+    status = prodigi_status(entry["prodigi_order_id"], api_key)
+    if status is None:
+        logger.error("Prodigi has no record of the order; taking it out of the InFulfillment index",
+                     order_id=order_id, prodigi_order_id=entry["prodigi_order_id"])
+        forget_unknown(order_id, entry["prodigi_order_id"])
+        return "unknown"
+    if status == entry.get("shipping_status"):
+        return "unchanged"
+
+    # The index only projects the keys and status; the update needs the stage map
+    order = get_order_snapshot(table, order_id, SNAPSHOT_ATTRIBUTES)
+    if order is None:
+        # Archived since the index was read
+        return "unchanged"
+    if not prodigi_webhook.apply_shipping_status(order_id, order, status, expected=True):
+        # A callback got there first
+        return "unchanged"
+    logger.warning("Applied a Prodigi status the webhook missed", order_id=order_id,
+                   previous_status=order.get("shipping_status"), shipping_status=status)
+    prodigi_webhook.send_shipping_update(order_id, order, status)
+    return "updated"
+
+
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted(retry=True)
+def handler(event, context):
+    now = int(time.time())
+    due_before = now - RECONCILE_MIN_AGE_SECONDS + 1
+    oldest, due_count = backlog(due_before)
+    backlog_age = now - oldest if oldest is not None else 0
+    tracing.gauge("FulfillmentBacklogAge", backlog_age, unit="Seconds")
+    tracing.gauge("FulfillmentBacklog", due_count, unit="Count")
+
+    checkpoint = checkpoints.load(JOB_NAME)
+    due, cursors = next_in_fulfillment(due_before, RECONCILE_BATCH_LIMIT, checkpoint.get("cursors") or {})
+    logger.info("Orders waiting on Prodigi", due=due_count, checking=len(due), backlog_age=backlog_age)
+
+    counts = {"updated": 0, "unchanged": 0, "unknown": 0, "failed": 0}
+    if due:
+        api_key = config.require("PRODIGI_SANDBOX_API_KEY")
+        # Each worker runs in a copy of this context, so its spans and
+        # deadline checks belong to this invocation
+        with ThreadPoolExecutor(max_workers=RECONCILE_CONCURRENCY, thread_name_prefix="reconcile") as pool:
+            futures = [
+                (entry, pool.submit(contextvars.copy_context().run, reconcile, entry, api_key))
+                for entry in due
+            ]
+            for entry, future in futures:
+                try:
+                    counts[future.result()] += 1
+                except (Exception, deadline.BudgetExhausted) as e:
+                    counts["failed"] += 1
+                    logger.error("Failed to reconcile order: %s", e, order_id=entry["order_id"])
+
+    # Failed orders come round again with the rest of their shard
+    checkpoints.save(JOB_NAME, cursors=cursors, **counts)
+
+    tracing.count("ProdigiStatusReconciled", counts["updated"])
+    tracing.count("ProdigiReconcileFailed", counts["failed"])
+    tracing.count("ProdigiOrderUnknown", counts["unknown"])
+    tracing.annotate(reconciled=counts, backlog_age=backlog_age)
+    logger.info("Reconciled Prodigi order states", **counts)
+    return dict(counts, due=due_count, checked=len(due), backlog_age=backlog_age)
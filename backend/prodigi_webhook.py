@@ -1,56 +1,81 @@
 import os
+import re
 import json
 import boto3
-import logging
 
-# Set up logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+import tracing
+import deadline
+import profiling
+import shared_cache
+from botocore.exceptions import ClientError
+from order_store import (
+    TERMINAL_SHIPPING_STATUSES, get_order, with_stage_timestamps, with_version, without_in_fulfillment
+)
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
 
 dynamodb = boto3.resource("dynamodb")
 table = dynamodb.Table(os.environ.get("ORDERS_TABLE"))
 ses = boto3.client("ses")
 
-def handler(event, context):
-    logger.info(f"Received Prodigi webhook event: {event}")
-    body = json.loads(event.get("body", "{}"))
-    order_id = body.get("reference")
-    shipping_status = body.get("status")
-    
-    if not order_id:
-        logger.error("No order reference provided in webhook")
-        return {
-            "statusCode": 400,
-            "body": json.dumps({"error": "Missing order reference"})
-        }
+def shipping_stage(shipping_status):
+    """Stage name for a Prodigi status, e.g. InProgress -> in_progress"""
+    if not shipping_status:
+        return "unknown"
+    words = re.sub(r"(?<=[a-z0-9])(?=[A-Z])", "_", str(shipping_status))
+    return re.sub(r"[^a-z0-9]+", "_", words.lower()).strip("_")
+
+def apply_shipping_status(order_id, order, shipping_status, expected=False):
+    """
+    Record a Prodigi status on the order; False if the order already has it.
+    With expected=True the write also requires the order's shipping status
+    to still be the one in `order`, so a status read from Prodigi earlier
+    can't overwrite a newer one a callback has written since. Terminal
+    statuses take the order out of the InFulfillment index.
+    """
+    expression_attr_names = {}
+    expression_attr_values = {":s": shipping_status}
+    update_expression = with_stage_timestamps(
+        order, {shipping_stage(shipping_status): None},
+        "SET shipping_status = :s", expression_attr_names, expression_attr_values
+    )
+    update_expression = with_version(update_expression, expression_attr_names, expression_attr_values)
+    if shipping_status in TERMINAL_SHIPPING_STATUSES:
+        update_expression = without_in_fulfillment(update_expression)
+
+    condition = "attribute_not_exists(shipping_status) OR shipping_status <> :s"
+    if expected:
+        if order.get("shipping_status") is None:
+            condition = "attribute_not_exists(shipping_status)"
+        else:
+            condition = "shipping_status = :previous AND shipping_status <> :s"
+            expression_attr_values[":previous"] = order["shipping_status"]
 
-    logger.info(f"Processing webhook for order {order_id} with status {shipping_status}")
-    
-    # Update the order's shipping status in DynamoDB
     try:
         table.update_item(
             Key={"order_id": order_id},
-            UpdateExpression="SET shipping_status = :s",
-            ExpressionAttributeValues={":s": shipping_status}
+            UpdateExpression=update_expression,
+            ConditionExpression=condition,
+            ExpressionAttributeNames=expression_attr_names,
+            ExpressionAttributeValues=expression_attr_values
         )
-        logger.info(f"Updated order {order_id} status to {shipping_status}")
-    except Exception as e:
-        logger.error(f"Error updating order status in DynamoDB: {str(e)}")
-        return {
-            "statusCode": 500,
-            "body": json.dumps({"error": f"Failed to update order: {str(e)}"})
-        }
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        logger.info("Shipping status already recorded", shipping_status=shipping_status)
+        return False
+    shared_cache.invalidate_order(order_id)
+    logger.info("Updated order shipping status", shipping_status=shipping_status)
+    return True
 
-    # Retrieve the customer email for notification
+def send_shipping_update(order_id, order, shipping_status):
+    """Email the customer the new shipping status; failures are logged, not raised"""
     try:
-        response = table.get_item(Key={"order_id": order_id})
-        order = response.get("Item", {})
         customer_email = order.get("customer_email")
         
         if customer_email:
             ses_sender = os.environ.get("SES_SENDER_EMAIL", "hello@hansenhome.ai")
-            logger.info(f"Sending notification to {customer_email} from {ses_sender}")
-            
             ses.send_email(
                 Source=ses_sender,
                 Destination={"ToAddresses": [customer_email]},
@@ -59,12 +84,49 @@ def handler(event, context):
                     "Body": {"Text": {"Data": f"Your order {order_id} status has been updated to: {shipping_status}."}}
                 }
             )
-            logger.info(f"Email notification sent to {customer_email} for order {order_id}")
+            logger.info("Shipping update email sent")
         else:
-            logger.warning(f"No customer email found for order {order_id}")
+            logger.warning("No customer email found for order")
     except Exception as e:
-        logger.error(f"Error sending email notification: {str(e)}")
+        logger.error("Error sending email notification: %s", e)
         # Continue processing since email notification failure is not critical
+
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted
+def handler(event, context):
+    logger.debug("Received Prodigi webhook event", event=event)
+    body = json.loads(event.get("body", "{}"))
+    # Prodigi's callback format wraps the order (with the merchantReference
+    # and metadata we sent) in data.order
+    prodigi_order = (body.get("data") or {}).get("order") or {}
+    metadata = prodigi_order.get("metadata") or {}
+    order_id = body.get("reference") or prodigi_order.get("merchantReference") or metadata.get("order_id")
+    tracing.annotate(order_id=order_id)
+    shipping_status = body.get("status") or (prodigi_order.get("status") or {}).get("stage")
+    
+    if not order_id:
+        logger.error("No order reference provided in webhook")
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": "Missing order reference"})
+        }
+
+    # Update the order's shipping status in DynamoDB
+    try:
+        order = get_order(table, order_id) or {}
+        tracing.annotate(correlation_id=metadata.get("correlation_id") or order.get("correlation_id") or order_id)
+        changed = apply_shipping_status(order_id, order, shipping_status)
+    except Exception as e:
+        logger.exception("Error updating order status in DynamoDB: %s", e)
+        return {
+            "statusCode": 500,
+            "body": json.dumps({"error": f"Failed to update order: {str(e)}"})
+        }
+
+    # Notify the customer; a repeated callback has already been notified
+    if changed:
+        send_shipping_update(order_id, order, shipping_status)
     
     return {
         "statusCode": 200,
@@ -0,0 +1,216 @@
+"""
+Sampled profiling of handler invocations.
+
+A fraction of the invocations of a handler decorated with profiled() run
+with a statistical stack sampler (a thread reading the handler thread's
+stack every PROFILE_INTERVAL_MS) and, optionally, tracemalloc. The rest run
+untouched. Each profile is gzip-compressed JSON:
+
+    stack samples   folded "module:function;module:function..." -> count
+    memory          tracemalloc peak/current bytes and the top allocation sites
+    context         function, request id, duration, cold start, order id
+
+stored as profiles/<function>/<yyyy-mm-dd>/<request id>.json.gz in
+PROFILE_BUCKET, or under PROFILE_DIR for local runs. tools/profiles.py
+merges them into folded stacks for flamegraph.pl or speedscope.
+
+Configuration (environment):
+    PROFILE_SAMPLE_RATE   fraction of invocations profiled, default 0 (off)
+    PROFILE_INTERVAL_MS   stack sampling interval, default 5
+    PROFILE_MEMORY        also trace allocations, default true; this slows
+                          the profiled invocation's allocations down
+    PROFILE_BUCKET        S3 bucket for profiles
+    PROFILE_DIR           local directory for profiles (wins over the bucket)
+
+Decorate under trace_handler and above budgeted, so the upload is neither
+counted in the profile nor cut short by the deadline:
+
+    @tracing.trace_handler
+    @profiling.profiled
+    @deadline.budgeted
+    def handler(event, context):
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import uuid
+import random
+import functools
+import threading
+import tracemalloc
+import contextvars
+from collections import Counter
+
+import tracing
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MEMORY = os.environ.get("PROFILE_MEMORY", "true").lower() == "true"
+PROFILE_BUCKET = os.environ.get("PROFILE_BUCKET")
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+PROFILE_PREFIX = "profiles"
+
+# Allocation sites kept per profile
+MEMORY_TOP_SITES = 15
+# Frames kept per sample, innermost first
+MAX_STACK_DEPTH = 128
+
+_HANDLER_DIR = os.path.dirname(os.path.abspath(__file__))
+_labels = {}
+_profiling = contextvars.ContextVar("profiling", default=False)
+_s3 = None
+
+
+def _module_name(filename):
+    path = filename.replace("\\", "/")
+    for marker in ("/site-packages/", "/dist-packages/", "/var/runtime/", "/var/task/"):
+        if marker in path:
+            path = path.split(marker, 1)[1]
+            break
+    else:
+        if os.path.dirname(os.path.abspath(filename)) == _HANDLER_DIR or "/lib/python" not in path:
+            path = os.path.basename(path)
+        else:
+            path = path.split("/lib/python", 1)[1].split("/", 1)[-1]
+    if path.endswith(".py"):
+        path = path[:-3]
+    return path.replace("/", ".").replace(".__init__", "")
+
+
+def _label(code):
+    label = _labels.get(code)
+    if label is None:
+        label = _labels[code] = f"{_module_name(code.co_filename)}:{code.co_name}"
+    return label
+
+
+def fold(frame, root=None):
+    """A frame's stack as one folded line, outermost first, stopping below root"""
+    labels = []
+    while frame is not None and frame is not root and len(labels) < MAX_STACK_DEPTH:
+        labels.append(_label(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class StackSampler(threading.Thread):
+    """Counts the folded stacks seen on one thread at a fixed interval"""
+
+    def __init__(self, thread_id, root=None, interval_ms=PROFILE_INTERVAL_MS):
+        super().__init__(name="profiler", daemon=True)
+        self.thread_id = thread_id
+        self.root = root
+        self.interval = interval_ms / 1000.0
+        self.samples = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[fold(frame, self.root)] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return self.samples
+
+
+def _memory_summary():
+    current, peak = tracemalloc.get_traced_memory()
+    statistics = tracemalloc.take_snapshot().statistics("lineno")[:MEMORY_TOP_SITES]
+    return {
+        "peak_bytes": peak,
+        "current_bytes": current,
+        "top": [
+            {
+                "location": f"{_module_name(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+                "size_bytes": stat.size,
+                "count": stat.count
+            }
+            for stat in statistics
+        ]
+    }
+
+
+def profile_key(function_name, request_id, timestamp):
+    day = time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+    return f"{PROFILE_PREFIX}/{function_name}/{day}/{request_id}.json.gz"
+
+
+def write_profile(profile):
+    """Store a profile in PROFILE_DIR or PROFILE_BUCKET; never raises"""
+    global _s3
+    key = profile_key(profile["function"], profile["request_id"], profile["timestamp"])
+    data = gzip.compress(json.dumps(profile, separators=(",", ":"), default=str).encode("utf-8"))
+    try:
+        if PROFILE_DIR:
+            path = os.path.join(PROFILE_DIR, *key.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        elif PROFILE_BUCKET:
+            if _s3 is None:
+                import boto3
+                _s3 = boto3.client("s3")
+            _s3.put_object(Bucket=PROFILE_BUCKET, Key=key, Body=data,
+                           ContentType="application/json", ContentEncoding="gzip")
+        else:
+            return None
+    except Exception as e:
+        logger.warning("Failed to store profile: %s", e, key=key)
+        return None
+    return key
+
+
+def profiled(func):
+    """Decorate a Lambda handler to profile PROFILE_SAMPLE_RATE of its invocations"""
+    function_name = func.__module__
+
+    @functools.wraps(func)
+    def wrapper(event, context):
+        # Handlers called from another handler are part of the caller's profile
+        if PROFILE_SAMPLE_RATE <= 0 or _profiling.get() or random.random() >= PROFILE_SAMPLE_RATE:
+            return func(event, context)
+
+        token = _profiling.set(True)
+        trace_memory = PROFILE_MEMORY and not tracemalloc.is_tracing()
+        if trace_memory:
+            tracemalloc.start()
+        # Stacks start at the handler; the runtime frames above it are the same every time
+        sampler = StackSampler(threading.get_ident(), root=sys._getframe())
+        sampler.start()
+        started = time.perf_counter()
+        try:
+            return func(event, context)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            samples = sampler.stop()
+            memory = None
+            if trace_memory:
+                memory = _memory_summary()
+                tracemalloc.stop()
+            _profiling.reset(token)
+
+            trace = tracing.current_trace()
+            profile = {
+                "version": 1,
+                "function": function_name,
+                "request_id": getattr(context, "aws_request_id", None) or str(uuid.uuid4()),
+                "timestamp": int(time.time()),
+                "duration_ms": round(duration_ms, 3),
+                "interval_ms": PROFILE_INTERVAL_MS,
+                "cold_start": trace.cold_start if trace is not None else None,
+                "annotations": dict(trace.annotations) if trace is not None else {},
+                "samples": dict(samples),
+                "memory": memory
+            }
+            if write_profile(profile):
+                tracing.count("Profiled")
+
+    return wrapper
@@ -0,0 +1,197 @@
+"""
+Per-client and per-IP rate limiting for the public API handlers.
+
+Each route has a token bucket per clientId (the browser's localStorage id)
+and per source IP, so a client that rotates its id is still held back by its
+address. A request passes only if both buckets have a token; otherwise the
+handler answers 429 with Retry-After before doing any work, and a
+RateLimited metric is counted.
+
+The buckets live in the RATE_LIMITS_TABLE so every container sees the same
+counts. Each one is kept as a single number, the time at which it will be
+full again (the generic cell rate algorithm): a request is admitted while
+that time is no more than the bucket's burst ahead of now, and pushes it one
+interval further. Admitting a request is therefore one conditional
+UpdateItem with no read first. Items expire through TTL once their bucket
+is full again.
+
+That time only ever moves forward, so the value a container saw last is a
+lower bound on the real one: a container that already knows a bucket is
+empty turns the client away without calling DynamoDB at all
+(RateLimitedLocally), which keeps a runaway poll loop from costing a write
+per request.
+
+The limiter fails open: if DynamoDB errors, the request is let through and
+RateLimiterError is counted.
+
+    @tracing.trace_handler
+    @profiling.profiled
+    @deadline.budgeted
+    @rate_limit.limited("checkout")
+    def handler(event, context):
+"""
+import os
+import json
+import math
+import time
+import functools
+from collections import namedtuple
+
+import boto3
+from botocore.exceptions import ClientError
+
+import tracing
+from cache import LRUCache
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() != "false"
+RATE_LIMITS_TABLE = os.environ.get("RATE_LIMITS_TABLE", "SteepleCo-RateLimits")
+# Buckets remembered per container for the local fast path
+RATE_LIMIT_CACHE_ENTRIES = int(os.environ.get("RATE_LIMIT_CACHE_ENTRIES", "10000"))
+# Kept after a bucket is full again, so a returning client's item is usually still there
+RATE_LIMIT_TTL_PADDING_SECONDS = 60
+
+Limit = namedtuple("Limit", ["per_second", "burst"])
+
+# route -> limits per client id and per source IP. A shopper checks out a
+# few times at most, and the payment page polls /payment-status every 5 s;
+# the IP limits leave room for several shoppers behind one NAT.
+ROUTE_LIMITS = {
+    "checkout": {"client": Limit(10 / 60, 5), "ip": Limit(1, 20)},
+    "payment-success": {"client": Limit(10 / 60, 5), "ip": Limit(1, 20)},
+    "payment-status": {"client": Limit(0.5, 6), "ip": Limit(5, 50)}
+}
+
+dynamodb = boto3.resource("dynamodb")
+table = dynamodb.Table(RATE_LIMITS_TABLE)
+
+# bucket key -> the latest full-again time (epoch ms) this container has seen
+_known = LRUCache(RATE_LIMIT_CACHE_ENTRIES, ttl=float("inf"))
+
+
+def _remember(key, full_at):
+    known, _ = _known.get(key)
+    if known is None or full_at > known:
+        _known.put(key, full_at)
+
+
+def _retry_after(full_at, tolerance, now):
+    return max(1, math.ceil((full_at - tolerance - now) / 1000))
+
+
+def take(key, limit, now=None):
+    """
+    Take a token from the bucket; None if it had one, otherwise the seconds
+    until it will have one.
+    """
+    now = now or int(time.time() * 1000)
+    interval = 1000 / limit.per_second
+    # How far ahead of now the full-again time may be while a token is left
+    tolerance = interval * (limit.burst - 1)
+
+    known, _ = _known.get(key)
+    if known is not None and known - tolerance > now:
+        tracing.count("RateLimitedLocally")
+        return _retry_after(known, tolerance, now)
+
+    expires_at = math.ceil((now + tolerance + interval) / 1000) + RATE_LIMIT_TTL_PADDING_SECONDS
+    # A bucket that is full again restarts from now; otherwise it moves on
+    # from where it is. Try whichever this container expects first.
+    attempts = [
+        ("SET full_at = :next, expires_at = :expires", "attribute_not_exists(full_at) OR full_at <= :now",
+         {":next": int(now + interval)}),
+        ("SET full_at = full_at + :interval, expires_at = :expires", "full_at > :now AND full_at <= :limit",
+         {":interval": int(interval), ":limit": int(now + tolerance)})
+    ]
+    if known is not None and known > now:
+        attempts.reverse()
+
+    full_at = None
+    for update_expression, condition, values in attempts:
+        try:
+            response = table.update_item(
+                Key={"bucket_key": key},
+                UpdateExpression=update_expression,
+                ConditionExpression=condition,
+                ExpressionAttributeValues=dict(values, **{":now": now, ":expires": expires_at}),
+                ReturnValues="UPDATED_NEW",
+                ReturnValuesOnConditionCheckFailure="ALL_OLD"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            full_at = int((e.response.get("Item") or {}).get("full_at", {}).get("N", 0))
+            if full_at - tolerance > now:
+                # Empty either way
+                break
+            continue
+        _remember(key, int(response["Attributes"]["full_at"]))
+        return None
+
+    # Empty, or (rarely) both writes lost a race with other containers
+    _remember(key, full_at)
+    return _retry_after(full_at, tolerance, now)
+
+
+def identities(event):
+    """(client id, source IP) of an API Gateway request; either may be None"""
+    client_id = (event.get("queryStringParameters") or {}).get("clientId")
+    if client_id is None and event.get("body"):
+        try:
+            body = json.loads(event["body"])
+            client_id = body.get("clientId") if isinstance(body, dict) else None
+        except ValueError:
+            pass
+    source_ip = ((event.get("requestContext") or {}).get("identity") or {}).get("sourceIp")
+    return client_id, source_ip
+
+
+def check(route, event):
+    """None if the request may go ahead, otherwise the seconds the caller should wait"""
+    client_id, source_ip = identities(event)
+    limits = ROUTE_LIMITS[route]
+    for kind, identity in (("client", client_id), ("ip", source_ip)):
+        if not identity:
+            continue
+        try:
+            retry_after = take(f"{route}#{kind}#{identity}", limits[kind])
+        except Exception as e:
+            tracing.count("RateLimiterError")
+            logger.warning("Rate limiter unavailable, letting the request through: %s", e)
+            return None
+        if retry_after is not None:
+            tracing.count("RateLimited")
+            tracing.annotate(rate_limited=kind)
+            # A runaway client would otherwise log a line per request; RateLimited counts them
+            logger.debug("Rate limited", route=route, limited_by=kind, client_id=client_id, retry_after=retry_after)
+            return retry_after
+    return None
+
+
+def too_many_requests_response(retry_after):
+    return {
+        "statusCode": 429,
+        "headers": {
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Headers": "*",
+            "Content-Type": "application/json",
+            "Retry-After": str(retry_after)
+        },
+        "body": json.dumps({"error": "Too many requests, please retry later", "retryable": True})
+    }
+
+
+def limited(route):
+    """Decorate an API handler (under budgeted) to answer 429 when the caller is over the route's limits"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(event, context):
+            if RATE_LIMIT_ENABLED and event.get("httpMethod") != "OPTIONS":
+                retry_after = check(route, event)
+                if retry_after is not None:
+                    return too_many_requests_response(retry_after)
+            return func(event, context)
+        return wrapper
+    return decorate
@@ -0,0 +1,187 @@
+import os
+import boto3
+import random
+import time
+from datetime import datetime, timezone
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+import tracing
+import deadline
+import profiling
+from catalog import SHIPPING_COSTS
+from order_items import load_items
+from order_store import unpack_order
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+# Initialize AWS resources
+dynamodb = boto3.resource("dynamodb")
+aggregates_table_name = os.environ.get("AGGREGATES_TABLE", "SteepleCo-SalesAggregates")
+aggregates_table = dynamodb.Table(aggregates_table_name)
+
+# Every counter is split over this many items so a busy day (or a best-selling
+# poster) never turns into a single hot partition key. Readers sum all shards.
+AGGREGATE_SHARDS = int(os.environ.get("AGGREGATE_SHARDS", "8"))
+
+# Markers that make stream redeliveries idempotent only need to outlive the
+# stream retention window (24 hours); keep them a week to be safe.
+APPLIED_MARKER_TTL = 7 * 24 * 60 * 60
+
+deserializer = TypeDeserializer()
+
+
+def day_key(day):
+    return f"day#{day}"
+
+
+def poster_key(poster_id):
+    return f"poster#{poster_id}"
+
+
+def shipping_key(shipping_method):
+    return f"shipping#{shipping_method}"
+
+
+def deserialize_image(image):
+    """Convert a DynamoDB stream image into plain Python values"""
+    item = {name: deserializer.deserialize(value) for name, value in (image or {}).items()}
+    return unpack_order(item)
+
+
+def is_payment_transition(record):
+    """True when a stream record moves an order into PAYMENT_COMPLETE"""
+    if record.get("eventName") not in ("INSERT", "MODIFY"):
+        return False
+
+    images = record.get("dynamodb", {})
+    new_status = images.get("NewImage", {}).get("status", {}).get("S")
+    old_status = images.get("OldImage", {}).get("status", {}).get("S")
+    return new_status == "PAYMENT_COMPLETE" and old_status != "PAYMENT_COMPLETE"
+
+
+def order_increments(order):
+    """
+    Work out the counter increments contributed by one paid order.
+    Returns a dict of aggregate key -> {attribute: amount}.
+    """
+    revenue_cents = int(order.get("amount_paid") or order.get("amount") or 0)
+    paid_at = int(order.get("updated_at") or time.time())
+    day = datetime.fromtimestamp(paid_at, tz=timezone.utc).strftime("%Y-%m-%d")
+    shipping_method = (order.get("shipping_details") or {}).get("shippingMethod", "BUDGET")
+    if shipping_method not in SHIPPING_COSTS:
+        # Charged and shipped as BUDGET (see checkout_session and prodigi_order)
+        shipping_method = "BUDGET"
+
+    try:
+        items = load_items(order)
+    except ValueError:
+        logger.warning("Order has unparseable items, counting revenue only", order_id=order.get('order_id'))
+        items = []
+
+    total_units = 0
+    increments = {}
+
+    for item in items:
+        poster_id = item["id"]
+        quantity = item["quantity"]
+        line_cents = item["price_cents"] * quantity
+        total_units += quantity
+
+        poster = increments.setdefault(poster_key(poster_id), {"units": 0, "revenue_cents": 0})
+        poster["units"] += quantity
+        poster["revenue_cents"] += line_cents
+
+    increments[day_key(day)] = {"revenue_cents": revenue_cents, "orders": 1, "units": total_units}
+    increments[shipping_key(shipping_method)] = {"revenue_cents": revenue_cents, "orders": 1}
+
+    return increments
+
+
+def apply_order(order):
+    """
+    Atomically add one order's contribution to the sharded counters.
+    A marker item written in the same transaction guards against double
+    counting when the stream redelivers a batch. Returns False if the order
+    had already been applied.
+    """
+    order_id = order["order_id"]
+    increments = order_increments(order)
+    now = int(time.time())
+
+    transact_items = [{
+        "Put": {
+            "TableName": aggregates_table_name,
+            "Item": {
+                "aggregate_key": f"applied#{order_id}",
+                "shard": 0,
+                "expires_at": now + APPLIED_MARKER_TTL
+            },
+            "ConditionExpression": "attribute_not_exists(aggregate_key)"
+        }
+    }]
+
+    for key, counters in increments.items():
+        names = {}
+        values = {}
+        clauses = []
+        for index, (attribute, amount) in enumerate(counters.items()):
+            names[f"#c{index}"] = attribute
+            values[f":c{index}"] = amount
+            clauses.append(f"#c{index} :c{index}")
+
+        transact_items.append({
+            "Update": {
+                "TableName": aggregates_table_name,
+                "Key": {"aggregate_key": key, "shard": random.randrange(AGGREGATE_SHARDS)},
+                "UpdateExpression": "ADD " + ", ".join(clauses),
+                "ExpressionAttributeNames": names,
+                "ExpressionAttributeValues": values
+            }
+        })
+
+    try:
+        dynamodb.meta.client.transact_write_items(TransactItems=transact_items)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "TransactionCanceledException":
+            raise
+        reasons = e.response.get("CancellationReasons", [])
+        if reasons and reasons[0].get("Code") == "ConditionalCheckFailed":
+            logger.info("Order already applied to sales aggregates, skipping", order_id=order_id)
+            return False
+        raise
+
+    logger.debug("Applied order to sales aggregates", order_id=order_id, aggregate_count=len(increments))
+    return True
+
+
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted(retry=True)
+def handler(event, context):
+    """
+    Consumes the orders table stream and keeps the sales aggregates up to date
+    """
+    records = event.get("Records", [])
+    logger.debug("Received order stream records", count=len(records))
+
+    failures = []
+    applied = 0
+
+    for record in records:
+        if not is_payment_transition(record):
+            continue
+
+        try:
+            order = deserialize_image(record["dynamodb"].get("NewImage"))
+            if apply_order(order):
+                applied += 1
+        except Exception as e:
+            logger.exception("Failed to aggregate stream record: %s", e, event_id=record.get('eventID'))
+            failures.append({"itemIdentifier": record["dynamodb"].get("SequenceNumber")})
+
+    logger.info("Applied paid orders", applied=applied, failures=len(failures))
+
+    # Report partial failures so only the failed records are retried
+    return {"batchItemFailures": failures}
@@ -0,0 +1,142 @@
+import os
+import json
+import boto3
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import tracing
+import deadline
+import profiling
+from catalog import POSTERS, SHIPPING_COSTS
+from sales_aggregator import (
+    AGGREGATE_SHARDS,
+    day_key,
+    poster_key,
+    shipping_key
+)
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+# Initialize AWS resources
+dynamodb = boto3.resource("dynamodb")
+aggregates_table_name = os.environ.get("AGGREGATES_TABLE", "SteepleCo-SalesAggregates")
+
+# BatchGetItem accepts at most 100 keys per request
+BATCH_GET_LIMIT = 100
+MAX_REPORT_DAYS = 92
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': '*',
+    'Access-Control-Allow-Methods': 'GET,OPTIONS',
+    'Content-Type': 'application/json'
+}
+
+
+def decimal_default(obj):
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    raise TypeError("Object of type '%s' is not JSON serializable" % type(obj).__name__)
+
+
+def batch_get(keys):
+    """Fetch aggregate items by key, following UnprocessedKeys"""
+    items = []
+    for start in range(0, len(keys), BATCH_GET_LIMIT):
+        request = {aggregates_table_name: {"Keys": keys[start:start + BATCH_GET_LIMIT]}}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            items.extend(response.get("Responses", {}).get(aggregates_table_name, []))
+            request = response.get("UnprocessedKeys") or None
+    return items
+
+
+def read_counters(aggregate_keys):
+    """Sum every shard of the given aggregate keys"""
+    keys = [
+        {"aggregate_key": key, "shard": shard}
+        for key in aggregate_keys
+        for shard in range(AGGREGATE_SHARDS)
+    ]
+
+    totals = {key: {} for key in aggregate_keys}
+    for item in batch_get(keys):
+        counters = totals[item["aggregate_key"]]
+        for attribute, value in item.items():
+            if attribute in ("aggregate_key", "shard"):
+                continue
+            counters[attribute] = counters.get(attribute, 0) + value
+    return totals
+
+
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted
+def handler(event, context):
+    """
+    Returns pre-aggregated sales figures for a date range.
+    Daily figures honour the range; poster and shipping-method totals are all-time.
+    """
+    logger.info("Received sales report request", query=event.get('queryStringParameters'))
+
+    if event.get('httpMethod') == 'OPTIONS':
+        return {'statusCode': 200, 'headers': CORS_HEADERS, 'body': '{}'}
+
+    query_params = event.get('queryStringParameters') or {}
+    today = datetime.utcnow().date()
+
+    try:
+        end = datetime.strptime(query_params['to'], "%Y-%m-%d").date() if query_params.get('to') else today
+        start = datetime.strptime(query_params['from'], "%Y-%m-%d").date() if query_params.get('from') else end - timedelta(days=29)
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': CORS_HEADERS,
+            'body': json.dumps({'error': 'Dates must be formatted as YYYY-MM-DD'})
+        }
+
+    if start > end or (end - start).days >= MAX_REPORT_DAYS:
+        return {
+            'statusCode': 400,
+            'headers': CORS_HEADERS,
+            'body': json.dumps({'error': f'Date range must be between 1 and {MAX_REPORT_DAYS} days'})
+        }
+
+    try:
+        days = [(start + timedelta(days=offset)).isoformat() for offset in range((end - start).days + 1)]
+        # Every counter that can exist; ones never written read as empty
+        poster_ids = sorted(POSTERS)
+        shipping_methods = sorted(SHIPPING_COSTS)
+
+        totals = read_counters(
+            [day_key(day) for day in days]
+            + [poster_key(poster_id) for poster_id in poster_ids]
+            + [shipping_key(method) for method in shipping_methods]
+        )
+
+        report = {
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'days': [dict(day=day, **totals[day_key(day)]) for day in days],
+            'posters': {
+                poster_id: totals[poster_key(poster_id)] for poster_id in poster_ids if totals[poster_key(poster_id)]
+            },
+            'shipping_methods': {
+                method: totals[shipping_key(method)] for method in shipping_methods if totals[shipping_key(method)]
+            }
+        }
+
+        return {
+            'statusCode': 200,
+            'headers': CORS_HEADERS,
+            'body': json.dumps(report, default=decimal_default)
+        }
+
+    except Exception as e:
+        logger.exception("Error building sales report: %s", e)
+        return {
+            'statusCode': 500,
+            'headers': CORS_HEADERS,
+            'body': json.dumps({'error': f'Error building sales report: {str(e)}'})
+        }
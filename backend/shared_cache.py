@@ -0,0 +1,164 @@
+"""
+Cache shared between Lambda containers, in front of hot order and status reads.
+
+Checkout pages poll /payment-status and /order-status for the same order
+from whichever container API Gateway picks, so a per-container cache (see
+cache.py) misses most of those polls. With SHARED_CACHE_URL set, the read
+handlers keep their answers here and the writers invalidate them:
+
+    order:<order id>            rendered /order-status body and its version
+    payment-status:<order id>   the order's status, for /payment-status
+    client-status:<client id>   newest status event for a client
+
+Backends, chosen by SHARED_CACHE_URL:
+
+    redis://host:6379/0, rediss://...   Redis or ElastiCache (needs redis-py)
+    memory                              in-process dict, for local runs
+    unset                               off: every get misses, nothing is stored
+
+Every write to an order calls invalidate_order() after it succeeds, and new
+status events are written through by status_events. An entry can still be
+stale for up to SHARED_CACHE_TTL_SECONDS if a reader stores what it read
+just before a concurrent write, so the TTL is kept short, and shorter still
+(SHARED_CACHE_PENDING_TTL_SECONDS) for answers that are about to change.
+
+The cache is an optimisation only: Redis errors and timeouts count as misses
+(SharedCacheError metric) and never fail a request.
+"""
+import os
+import json
+import time
+import threading
+
+import tracing
+from structured_logging import get_logger
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = get_logger(__name__)
+
+SHARED_CACHE_URL = os.environ.get("SHARED_CACHE_URL")
+SHARED_CACHE_TTL_SECONDS = int(os.environ.get("SHARED_CACHE_TTL_SECONDS", "30"))
+# For answers that are about to change (payment not confirmed yet), so one
+# stored just after a write was invalidated does not hold a poller up for long
+SHARED_CACHE_PENDING_TTL_SECONDS = int(os.environ.get("SHARED_CACHE_PENDING_TTL_SECONDS", "2"))
+# Kept well below an API call's budget; a slow cache is worse than none
+SHARED_CACHE_TIMEOUT = float(os.environ.get("SHARED_CACHE_TIMEOUT", "0.1"))
+SHARED_CACHE_PREFIX = os.environ.get("SHARED_CACHE_PREFIX", "steepleco:")
+
+
+class NullCache:
+    enabled = False
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=SHARED_CACHE_TTL_SECONDS):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+
+class MemoryCache:
+    """Stand-in for Redis when everything runs in one process"""
+    enabled = True
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=SHARED_CACHE_TTL_SECONDS):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+class RedisCache:
+    enabled = True
+
+    def __init__(self, url, timeout=SHARED_CACHE_TIMEOUT):
+        if redis is None:
+            raise RuntimeError("SHARED_CACHE_URL points at Redis but redis-py is not installed")
+        self._client = redis.Redis.from_url(
+            url, socket_timeout=timeout, socket_connect_timeout=timeout, decode_responses=True
+        )
+
+    def _call(self, operation, *args, **kwargs):
+        try:
+            with tracing.span("Redis", operation):
+                return getattr(self._client, operation.lower())(*args, **kwargs)
+        except redis.RedisError as e:
+            tracing.count("SharedCacheError")
+            logger.warning("Shared cache %s failed: %s", operation, e)
+            return None
+
+    def get(self, key):
+        return self._call("GET", key)
+
+    def set(self, key, value, ttl=SHARED_CACHE_TTL_SECONDS):
+        self._call("SET", key, value, ex=ttl)
+
+    def delete(self, *keys):
+        self._call("DELETE", *keys)
+
+
+def from_url(url):
+    if not url:
+        return NullCache()
+    if url == "memory":
+        return MemoryCache()
+    return RedisCache(url)
+
+
+cache = from_url(SHARED_CACHE_URL)
+
+
+def get_json(key):
+    """A cached JSON value, or None; counts SharedCacheHit/SharedCacheMiss"""
+    if not cache.enabled:
+        return None
+    value = cache.get(SHARED_CACHE_PREFIX + key)
+    tracing.count("SharedCacheHit" if value is not None else "SharedCacheMiss")
+    return json.loads(value) if value is not None else None
+
+
+def set_json(key, value, ttl=SHARED_CACHE_TTL_SECONDS):
+    if cache.enabled:
+        cache.set(SHARED_CACHE_PREFIX + key, json.dumps(value, separators=(",", ":")), ttl)
+
+
+def order_key(order_id):
+    return f"order:{order_id}"
+
+
+def payment_status_key(order_id):
+    return f"payment-status:{order_id}"
+
+
+def client_status_key(client_id):
+    return f"client-status:{client_id}"
+
+
+def invalidate_order(order_id):
+    """Drop everything cached for an order; call after writing it"""
+    if cache.enabled and order_id:
+        cache.delete(SHARED_CACHE_PREFIX + order_key(order_id), SHARED_CACHE_PREFIX + payment_status_key(order_id))
@@ -0,0 +1,73 @@
+"""
+Per-client status event log.
+
+The frontend polls /payment-status with its clientId while the Stripe
+webhook confirms the payment. Events are appended to a table keyed by
+client_id with a millisecond event_time sort key, so the newest status for a
+client is a single Query(Limit=1, ScanIndexForward=False) rather than a scan
+of the orders table. Events expire through the table's TTL.
+
+With a shared cache configured, the newest event per client is also kept
+there: record_status_event writes it through, so polls read the table only
+when the cache has no entry.
+"""
+import os
+import time
+import boto3
+from boto3.dynamodb.conditions import Key
+
+import shared_cache
+
+STATUS_EVENT_TTL = 24 * 60 * 60
+
+dynamodb = boto3.resource("dynamodb")
+status_events_table_name = os.environ.get("STATUS_EVENTS_TABLE", "SteepleCo-StatusEvents")
+status_events_table = dynamodb.Table(status_events_table_name)
+
+
+def record_status_event(client_id, order_id, status, timestamp=None):
+    """Append a status event for a client"""
+    now_ms = int(time.time() * 1000)
+    timestamp = int(timestamp or now_ms // 1000)
+    status_events_table.put_item(
+        Item={
+            "client_id": client_id,
+            "event_time": now_ms,
+            "order_id": order_id,
+            "status": status,
+            "timestamp": timestamp,
+            "expires_at": timestamp + STATUS_EVENT_TTL
+        }
+    )
+    shared_cache.set_json(shared_cache.client_status_key(client_id), {
+        "event": {"order_id": order_id, "status": status, "timestamp": timestamp}
+    })
+
+
+def latest_status_event(client_id, cached=False):
+    """
+    Return the newest status event for a client, or None. With cached=True
+    the shared cache is tried first and filled on a miss, including with
+    "no event yet", which is what most polls see.
+    """
+    cache_key = shared_cache.client_status_key(client_id)
+    if cached:
+        entry = shared_cache.get_json(cache_key)
+        if entry is not None:
+            return entry["event"]
+
+    response = status_events_table.query(
+        KeyConditionExpression=Key("client_id").eq(client_id),
+        ScanIndexForward=False,
+        Limit=1
+    )
+    items = response.get("Items", [])
+    event = items[0] if items else None
+    if cached:
+        ttl = shared_cache.SHARED_CACHE_TTL_SECONDS if event else shared_cache.SHARED_CACHE_PENDING_TTL_SECONDS
+        shared_cache.set_json(cache_key, {"event": event and {
+            "order_id": event.get("order_id"),
+            "status": event.get("status"),
+            "timestamp": int(event.get("timestamp", 0))
+        }}, ttl)
+    return event
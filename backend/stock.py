@@ -0,0 +1,242 @@
+"""
+Stock of limited-edition posters (catalog entries with an edition_size).
+
+Each SKU's remaining prints are split over STOCK_SHARDS items of the
+STOCK_TABLE (sku, shard) -> available, so the checkouts of a drop write to
+several keys instead of one hot counter. A reservation takes prints from a
+shard with a conditional `ADD available -qty` (only while available >= qty),
+so no shard ever goes below zero and nothing is sold twice.
+
+Reserving is one TransactWriteItems: the order write (checkout's Put, say)
+plus one decrement per limited SKU, on a shard picked at random. If a shard
+has too few prints left, another untried one is picked; after
+SHARD_ATTEMPTS misses the shards are read and the quantity is split across
+those that still have prints, or SoldOut is raised if together they don't
+have enough. A miss returns the shard's level, and each container remembers
+the levels it has seen for STOCK_HINT_SECONDS, so shards it knows are short
+aren't tried again; toward the end of an edition that saves many of the
+failed transactions. The order records what it took in stock_reservations
+([{sku, shard, qty}]) so exactly that can be given back.
+
+Prints go back with release(): order_cleanup expires a PENDING order and
+adds its reservations back to their shards in one transaction, conditional
+on the order still being PENDING and not released before. An order paid
+after that takes its prints again when the payment is applied (see
+stripe_webhook.reclaim_stock).
+
+Edition numbers are not handed out here; a released print would leave a
+gap. Number the prints of an edition when they are fulfilled.
+"""
+import os
+import random
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+import tracing
+from cache import LRUCache
+from catalog import get_poster
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+STOCK_TABLE = os.environ.get("STOCK_TABLE", "SteepleCo-Stock")
+STOCK_SHARDS = int(os.environ.get("STOCK_SHARDS", "8"))
+# Random shards tried before reading them all; near the end of an edition
+# most shards are empty and the read finds the rest at once
+SHARD_ATTEMPTS = int(os.environ.get("STOCK_SHARD_ATTEMPTS", "3"))
+# Transactions that lost a race with another checkout are retried this often
+CONFLICT_ATTEMPTS = 3
+# How long a shard level seen here is trusted; prints only come back on release
+STOCK_HINT_SECONDS = float(os.environ.get("STOCK_HINT_SECONDS", "2"))
+
+dynamodb = boto3.resource("dynamodb")
+table = dynamodb.Table(STOCK_TABLE)
+
+# (sku, shard) -> prints available when this container last saw it
+_levels = LRUCache(4096, ttl=STOCK_HINT_SECONDS)
+
+
+class SoldOut(Exception):
+    """Raised when a limited edition has fewer prints left than an order asks for"""
+
+    def __init__(self, sku, requested, available):
+        super().__init__(f"Only {available} prints of {sku} left, {requested} requested")
+        self.sku = sku
+        self.requested = requested
+        self.available = available
+
+
+class StockContention(Exception):
+    """Raised when a reservation kept losing races with other checkouts"""
+
+
+class OrderChanged(Exception):
+    """Raised when the order write of a stock transaction failed its condition"""
+
+
+def limited_demand(order_lines):
+    """SKU -> prints wanted, for the limited-edition lines of an order"""
+    demand = {}
+    for line in order_lines:
+        poster = get_poster(line["sku"])
+        if poster and poster.get("edition_size"):
+            demand[line["sku"]] = demand.get(line["sku"], 0) + int(line["qty"])
+    return demand
+
+
+def reserved_demand(reservations):
+    """SKU -> prints, for reservations recorded on an order"""
+    demand = {}
+    for reservation in reservations:
+        demand[reservation["sku"]] = demand.get(reservation["sku"], 0) + int(reservation["qty"])
+    return demand
+
+
+def shard_levels(sku):
+    """shard -> prints available, read consistently"""
+    response = table.query(KeyConditionExpression=Key("sku").eq(sku), ConsistentRead=True)
+    levels = {int(item["shard"]): int(item["available"]) for item in response.get("Items", [])}
+    for shard, level in levels.items():
+        _levels.put((sku, shard), level)
+    return levels
+
+
+def _known_short(sku, shard, qty):
+    level, fresh = _levels.get((sku, shard))
+    return fresh and level < qty
+
+
+def seed(sku, edition_size, shards=STOCK_SHARDS):
+    """
+    Spread an edition over the shards; False if the SKU was seeded before,
+    in which case its stock is left as it is.
+    """
+    requests = [
+        {"Put": {
+            "TableName": STOCK_TABLE,
+            "Item": {"sku": sku, "shard": shard, "available": edition_size // shards + (shard < edition_size % shards)},
+            "ConditionExpression": "attribute_not_exists(sku)"
+        }}
+        for shard in range(shards)
+    ]
+    return _transact(requests) is None
+
+
+def _take(reservation):
+    return {"Update": {
+        "TableName": STOCK_TABLE,
+        "Key": {"sku": reservation["sku"], "shard": int(reservation["shard"])},
+        "UpdateExpression": "ADD available :delta",
+        "ConditionExpression": "available >= :qty",
+        "ExpressionAttributeValues": {":delta": -int(reservation["qty"]), ":qty": int(reservation["qty"])},
+        "ReturnValuesOnConditionCheckFailure": "ALL_OLD"
+    }}
+
+
+def _give_back(reservation):
+    return {"Update": {
+        "TableName": STOCK_TABLE,
+        "Key": {"sku": reservation["sku"], "shard": int(reservation["shard"])},
+        "UpdateExpression": "ADD available :qty",
+        "ExpressionAttributeValues": {":qty": int(reservation["qty"])}
+    }}
+
+
+def _transact(requests):
+    """None if the transaction went through, otherwise each request's cancellation reason"""
+    try:
+        dynamodb.meta.client.transact_write_items(TransactItems=requests)
+        return None
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "TransactionCanceledException":
+            raise
+        return e.response.get("CancellationReasons") or [{} for _ in requests]
+
+
+def _write(order_request, stock_requests):
+    """Like _transact, for an order write plus stock updates; the reasons are the stock updates'"""
+    reasons = _transact([order_request] + stock_requests)
+    if reasons is None:
+        return None
+    if reasons[0].get("Code") == "ConditionalCheckFailed":
+        raise OrderChanged()
+    return reasons[1:]
+
+
+def _split(sku, qty):
+    """Reservations taking qty from whichever shards have prints, fullest first"""
+    levels = shard_levels(sku)
+    available = sum(max(level, 0) for level in levels.values())
+    if available < qty:
+        raise SoldOut(sku, qty, available)
+
+    reservations = []
+    for shard, level in sorted(levels.items(), key=lambda entry: -entry[1]):
+        taken = min(level, qty)
+        reservations.append({"sku": sku, "shard": shard, "qty": taken})
+        qty -= taken
+        if not qty:
+            break
+    return reservations
+
+
+def reserve(demand, order_request):
+    """
+    Take the prints in demand (see limited_demand) in one transaction with
+    the order write order_request(reservations) builds, and return the
+    reservations. Raises SoldOut, StockContention, or OrderChanged if the
+    order write's own condition failed.
+    """
+    tried = {sku: set() for sku in demand}
+    for _ in range(SHARD_ATTEMPTS):
+        reservations = []
+        for sku, qty in demand.items():
+            candidates = [
+                shard for shard in range(STOCK_SHARDS)
+                if shard not in tried[sku] and not _known_short(sku, shard, qty)
+            ]
+            if candidates:
+                reservations.append({"sku": sku, "shard": random.choice(candidates), "qty": qty})
+        if len(reservations) < len(demand):
+            break
+
+        reasons = _write(order_request(reservations), [_take(reservation) for reservation in reservations])
+        if reasons is None:
+            tracing.count("StockReserved", sum(demand.values()))
+            return reservations
+        tracing.count("StockShardMissed")
+        for reservation, reason in zip(reservations, reasons):
+            if reason.get("Code") == "ConditionalCheckFailed":
+                tried[reservation["sku"]].add(reservation["shard"])
+                if "Item" in reason:
+                    level = int(reason["Item"]["available"]["N"])
+                    _levels.put((reservation["sku"], reservation["shard"]), level)
+
+    # No shard tried had enough on its own: take from several
+    for _ in range(CONFLICT_ATTEMPTS):
+        try:
+            reservations = [reservation for sku, qty in demand.items() for reservation in _split(sku, qty)]
+        except SoldOut as e:
+            tracing.count("StockSoldOut")
+            logger.info("Limited edition sold out", sku=e.sku, requested=e.requested, available=e.available)
+            raise
+        if _write(order_request(reservations), [_take(reservation) for reservation in reservations]) is None:
+            tracing.count("StockReserved", sum(demand.values()))
+            return reservations
+        tracing.count("StockShardMissed")
+    raise StockContention(f"Could not reserve {demand} after {CONFLICT_ATTEMPTS} attempts")
+
+
+def release(order_request, reservations):
+    """
+    Give reservations back in one transaction with order_request, which
+    must make the release happen once (e.g. by setting stock_released on a
+    condition that it isn't set). Raises OrderChanged if it isn't met.
+    """
+    for _ in range(CONFLICT_ATTEMPTS):
+        if _write(order_request, [_give_back(reservation) for reservation in reservations]) is None:
+            tracing.count("StockReleased", sum(int(reservation["qty"]) for reservation in reservations))
+            return
+    raise StockContention(f"Could not release {len(reservations)} reservations after {CONFLICT_ATTEMPTS} attempts")
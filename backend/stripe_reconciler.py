@@ -0,0 +1,201 @@
+"""
+Replays Stripe payments the webhook never applied.
+
+If the webhook endpoint is down, or rejects an event, a paid order stays
+PENDING and order_cleanup later marks it EXPIRED. This job runs on a
+schedule and pages through Stripe's payment_intent.succeeded events, plus
+succeeded PaymentIntents (which outlive Stripe's 30 days of events), created
+since its checkpoint. It looks their orders up in bulk with BatchGetItem,
+and replays each payment whose order is not marked paid yet through
+stripe_webhook.apply_payment_succeeded, the webhook's own code path. The
+replay only writes while the order is still PENDING or EXPIRED and has not
+reached Prodigi, so a status read here that the webhook or payment_success
+has overtaken since doesn't send the order through fulfillment again.
+Payments younger than RECONCILE_MIN_AGE_SECONDS are left to the webhook.
+
+The checkpoint holds a cursor (epoch seconds). Each run lists from a little
+before it (RECONCILE_OVERLAP_SECONDS, for events that become visible late)
+and saves it again after every chunk, so a run cut short by its deadline is
+continued by the next. A failed replay holds the cursor at that payment, so
+the next run retries it, while the rest of the window is still worked
+through. The checkpoint also counts each payment's failed attempts: after
+RECONCILE_MAX_ATTEMPTS it is given up on (StripeReplayAbandoned) and no
+longer holds the cursor, so one payment that can never be applied doesn't
+stall the job for good.
+"""
+import os
+import time
+import stripe
+
+import tracing
+import deadline
+import profiling
+import config
+import checkpoints
+import stripe_webhook
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+JOB_NAME = "stripe-reconciler"
+
+# How far back the first run looks
+RECONCILE_LOOKBACK_SECONDS = int(os.environ.get("RECONCILE_LOOKBACK_SECONDS", str(3 * 24 * 60 * 60)))
+RECONCILE_OVERLAP_SECONDS = int(os.environ.get("RECONCILE_OVERLAP_SECONDS", "300"))
+# Stripe delivers webhooks within seconds; only replay payments older than this
+RECONCILE_MIN_AGE_SECONDS = int(os.environ.get("STRIPE_RECONCILE_MIN_AGE_SECONDS", "600"))
+# Stripe's largest page
+RECONCILE_PAGE_SIZE = 100
+# BatchGetItem's limit
+BATCH_GET_LIMIT = 100
+# Stop starting chunks with this much of the invocation left
+RECONCILE_RESERVE_SECONDS = float(os.environ.get("RECONCILE_RESERVE_SECONDS", "15"))
+# Runs that may fail to replay a payment before it is given up on
+RECONCILE_MAX_ATTEMPTS = int(os.environ.get("RECONCILE_MAX_ATTEMPTS", "5"))
+
+# Order statuses that mean the webhook has not marked the order paid
+UNCONFIRMED_STATUSES = stripe_webhook.REPLAYABLE_STATUSES
+
+
+def payment_created(payment):
+    return payment["created"] or payment["data"]["object"]["created"]
+
+
+def succeeded_payments(since, until, api_key):
+    """
+    payment_intent.succeeded events for payments made between two epoch
+    seconds, oldest first. Succeeded PaymentIntents without an event in the
+    window get a stand-in event with created=None.
+    """
+    payments = {}
+    created = {"gte": since, "lte": until}
+    events = stripe.Event.list(
+        type="payment_intent.succeeded", created=created, limit=RECONCILE_PAGE_SIZE, api_key=api_key
+    )
+    for event in events.auto_paging_iter():
+        intent = event["data"]["object"]
+        payments.setdefault(intent["id"], event)
+
+    intents = stripe.PaymentIntent.list(created=created, limit=RECONCILE_PAGE_SIZE, api_key=api_key)
+    for intent in intents.auto_paging_iter():
+        if intent["status"] == "succeeded" and intent["id"] not in payments:
+            payments[intent["id"]] = {
+                "id": None,
+                "type": "payment_intent.succeeded",
+                "created": None,
+                "data": {"object": intent}
+            }
+
+    return sorted(payments.values(), key=payment_created)
+
+
+def order_statuses(order_ids):
+    """order_id -> status for the orders that exist, following UnprocessedKeys"""
+    statuses = {}
+    for start in range(0, len(order_ids), BATCH_GET_LIMIT):
+        request = {stripe_webhook.orders_table_name: {
+            "Keys": [{"order_id": order_id} for order_id in order_ids[start:start + BATCH_GET_LIMIT]],
+            "ProjectionExpression": "order_id, #status_attr",
+            "ExpressionAttributeNames": {"#status_attr": "status"}
+        }}
+        while request:
+            response = stripe_webhook.dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get("Responses", {}).get(stripe_webhook.orders_table_name, []):
+                statuses[item["order_id"]] = item.get("status")
+            request = response.get("UnprocessedKeys") or None
+    return statuses
+
+
+def out_of_time():
+    remaining = deadline.remaining()
+    return remaining is not None and remaining < RECONCILE_RESERVE_SECONDS
+
+
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted(retry=True)
+def handler(event, context):
+    started_at = int(time.time())
+    checkpoint = checkpoints.load(JOB_NAME)
+    cursor = int(checkpoint.get("cursor") or started_at - RECONCILE_LOOKBACK_SECONDS)
+    since = cursor - RECONCILE_OVERLAP_SECONDS
+    until = started_at - RECONCILE_MIN_AGE_SECONDS
+    # PaymentIntent ID -> {"attempts", "created"} for replays that failed
+    failures = {
+        intent_id: {"attempts": int(failure["attempts"]), "created": int(failure["created"])}
+        for intent_id, failure in (checkpoint.get("failures") or {}).items()
+    }
+
+    payments = succeeded_payments(since, until, config.require("STRIPE_SECRET_KEY"))
+    logger.info("Listed succeeded payments", count=len(payments), since=since, until=until)
+
+    counts = {"replayed": 0, "confirmed": 0, "missing": 0, "failed": 0, "abandoned": 0}
+    complete = True
+    held_at = None
+    for start in range(0, len(payments), BATCH_GET_LIMIT):
+        if out_of_time():
+            complete = False
+            break
+        chunk = payments[start:start + BATCH_GET_LIMIT]
+        order_ids = [payment["data"]["object"].get("metadata", {}).get("order_id") for payment in chunk]
+        statuses = order_statuses(sorted({order_id for order_id in order_ids if order_id}))
+
+        for payment, order_id in zip(chunk, order_ids):
+            intent_id = payment["data"]["object"]["id"]
+            status = statuses.get(order_id)
+            if status is None:
+                # No order ID, or the order was archived or never stored
+                counts["missing"] += 1
+                continue
+            if status not in UNCONFIRMED_STATUSES:
+                counts["confirmed"] += 1
+                failures.pop(intent_id, None)
+                continue
+            if failures.get(intent_id, {}).get("attempts", 0) >= RECONCILE_MAX_ATTEMPTS:
+                counts["abandoned"] += 1
+                continue
+
+            result = stripe_webhook.apply_payment_succeeded(payment, replay=True)
+            if result["statusCode"] == 409:
+                # Confirmed since the statuses were read
+                counts["confirmed"] += 1
+                failures.pop(intent_id, None)
+            elif result["statusCode"] == 200:
+                counts["replayed"] += 1
+                failures.pop(intent_id, None)
+                tracing.count("StripePaymentReplayed")
+                logger.warning("Replayed a payment the webhook missed", order_id=order_id, previous_status=status)
+            else:
+                counts["failed"] += 1
+                tracing.count("StripeReplayFailed")
+                failure = failures.setdefault(intent_id, {"attempts": 0, "created": payment_created(payment)})
+                failure["attempts"] += 1
+                logger.error("Failed to replay payment", order_id=order_id, status_code=result["statusCode"],
+                             attempts=failure["attempts"])
+                if failure["attempts"] >= RECONCILE_MAX_ATTEMPTS:
+                    counts["abandoned"] += 1
+                    tracing.count("StripeReplayAbandoned")
+                    logger.error("Giving up on replaying payment; it needs an operator",
+                                 order_id=order_id, payment_intent_id=intent_id)
+                elif held_at is None:
+                    held_at = failure["created"]
+                    cursor = max(cursor, held_at - 1)
+
+        if held_at is None:
+            cursor = max([cursor] + [payment["created"] for payment in chunk if payment["created"]])
+        checkpoints.save(JOB_NAME, cursor=cursor, failures=failures, **counts)
+
+    if complete and held_at is None:
+        # Everything up to the end of the listed window has been seen
+        cursor = max(cursor, until)
+    complete = complete and held_at is None
+    # Payments the next run won't list again no longer need their count
+    failures = {
+        intent_id: failure for intent_id, failure in failures.items()
+        if failure["created"] >= cursor - RECONCILE_OVERLAP_SECONDS
+    }
+    checkpoints.save(JOB_NAME, cursor=cursor, complete=complete, failures=failures, **counts)
+
+    tracing.annotate(reconciled=counts, complete=complete)
+    logger.info("Reconciled Stripe payments", complete=complete, cursor=cursor, **counts)
+    return dict(counts, complete=complete, cursor=cursor)
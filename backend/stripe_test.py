@@ -1,24 +1,24 @@
-import os
 import json
 import stripe
-import logging
 
-# Set up logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+import tracing
+import deadline
+import profiling
+import config
+from structured_logging import get_logger
 
-# Initialize Stripe with your secret key
-stripe_secret_key = os.environ.get("STRIPE_SECRET_KEY", "DEFAULT_NOT_SET")
-logger.info(f"Using Stripe secret key: {stripe_secret_key[:8]}...")
+logger = get_logger(__name__)
 
-stripe.api_key = stripe_secret_key
 stripe.api_version = "2023-10-16"
 
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted
 def handler(event, context):
     """
     Simple Stripe API test endpoint
     """
-    logger.info("Received test event")
+    logger.debug("Received test event")
     
     response_headers = {
         'Access-Control-Allow-Origin': '*',
@@ -26,9 +26,12 @@ def handler(event, context):
         'Content-Type': 'application/json'
     }
     
+    # Prefer the test key; fall back to the main one
+    stripe_secret_key = config.get("STRIPE_TEST_SECRET_KEY") or config.get("STRIPE_SECRET_KEY")
+
     try:
         # Try to retrieve Stripe account info
-        account = stripe.Account.retrieve()
+        account = stripe.Account.retrieve(api_key=stripe_secret_key)
         
         return {
             "statusCode": 200,
@@ -42,7 +45,7 @@ def handler(event, context):
             })
         }
     except Exception as e:
-        logger.error(f"Error testing Stripe API: {str(e)}")
+        logger.exception("Error testing Stripe API: %s", e)
         return {
             "statusCode": 400,
             "headers": response_headers,
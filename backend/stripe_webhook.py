@@ -3,15 +3,21 @@ import json
 import stripe
 import boto3
 from decimal import Decimal
-import logging
 import time
-import requests
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from botocore.exceptions import ClientError
 
-# Set up logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+import tracing
+import deadline
+import profiling
+import config
+import shared_cache
+import stock
+from order_items import with_items_migration
+from order_store import get_order, unpack_order, with_stage_timestamps, with_version
+from status_events import record_status_event
+from structured_logging import get_logger, lazy
+
+logger = get_logger(__name__)
 
 # Custom JSON encoder to handle Decimal types
 class DecimalEncoder(json.JSONEncoder):
@@ -24,165 +30,212 @@ class DecimalEncoder(json.JSONEncoder):
 dynamodb = boto3.resource("dynamodb")
 orders_table_name = os.environ.get("ORDERS_TABLE", "SteepleCo-Orders")
 table = dynamodb.Table(orders_table_name)
-lambda_client = boto3.client("lambda")
-ses_client = boto3.client('ses')
 
-# Set your Stripe secret and webhook secret
-stripe.api_key = os.environ.get("STRIPE_SECRET_KEY")
+# Statuses a payment may still confirm. Any other means it was applied
+# before: Stripe redelivers events, and replays race the webhook.
+REPLAYABLE_STATUSES = ("PENDING", "EXPIRED")
+
+# The webhook signing secret comes from config (see construct_event)
 stripe.api_version = "2025-03-31.basil"  # Updated to match webhook configuration
-endpoint_secret = os.environ.get("STRIPE_WEBHOOK_SECRET")
 
-# Email configuration
-NOTIFICATION_EMAIL = "hello@hansenhome.ai"
-SES_SENDER_EMAIL = os.environ.get("SES_SENDER_EMAIL", "hello@hansenhome.ai")
+def construct_event(payload, sig_header):
+    """Verify the Stripe signature, re-reading a signing secret that may have been rotated"""
+    endpoint_secret = config.get("STRIPE_WEBHOOK_SECRET")
+    try:
+        return stripe.Webhook.construct_event(payload, sig_header, endpoint_secret)
+    except stripe.SignatureVerificationError:
+        if not config.refresh() or config.get("STRIPE_WEBHOOK_SECRET") == endpoint_secret:
+            raise
+        logger.warning("Webhook signature matched only the reloaded signing secret")
+        return stripe.Webhook.construct_event(payload, sig_header, config.get("STRIPE_WEBHOOK_SECRET"))
+
+def already_confirmed_response(replay):
+    """409 for a replay, so the reconciler can tell; a redelivered event is simply acknowledged"""
+    if replay:
+        logger.info("Order was confirmed meanwhile, not replaying the payment")
+        return {"statusCode": 409, "body": json.dumps({"error": "Order already confirmed"}, cls=DecimalEncoder)}
+    tracing.count("DuplicatePaymentEvent")
+    logger.info("Payment was applied before, ignoring the redelivered event")
+    return {"statusCode": 200, "body": json.dumps({"received": True}, cls=DecimalEncoder)}
+
+def reclaim_stock(order_id, order):
+    """
+    Take the prints of an order that order_cleanup expired back from stock,
+    now that it has been paid. If the edition has sold out meanwhile the
+    order is still marked paid; StockOversold flags it for a refund.
+    """
+    def order_request(reservations):
+        expression_attr_names = {}
+        expression_attr_values = {":reservations": reservations}
+        return {"Update": {
+            "TableName": orders_table_name,
+            "Key": {"order_id": order_id},
+            "UpdateExpression": with_version(
+                "SET stock_reservations = :reservations REMOVE stock_released",
+                expression_attr_names, expression_attr_values
+            ),
+            # Another delivery of the event may have reclaimed them already
+            "ConditionExpression": "attribute_exists(stock_released)",
+            "ExpressionAttributeNames": expression_attr_names,
+            "ExpressionAttributeValues": expression_attr_values
+        }}
 
-def send_notification_email(order_data, payment_intent):
-    """Send an email notification about a new purchase using AWS SES"""
     try:
-        # Extract order details
-        order_id = order_data.get('order_id', 'Unknown')
-        customer_email = payment_intent.get('receipt_email', 'Unknown')
-        amount = payment_intent.get('amount', 0)
-        # Convert amount from cents to dollars with proper formatting
-        amount_formatted = f"${(amount / 100):.2f}"
+        stock.reserve(stock.reserved_demand(order["stock_reservations"]), order_request)
+        logger.info("Reclaimed the stock of an expired order paid late")
+    except stock.OrderChanged:
+        pass
+    except stock.SoldOut as e:
+        tracing.count("StockOversold")
+        logger.error("Expired order was paid after its limited edition sold out; it needs a refund",
+                     sku=e.sku, requested=e.requested, available=e.available)
+
+def apply_payment_succeeded(event_stripe, replay=False):
+    """
+    Mark the order of a payment_intent.succeeded event PAYMENT_COMPLETE, as
+    long as it is still in REPLAYABLE_STATUSES and hasn't reached Prodigi;
+    otherwise the payment was applied before and nothing is written. Also
+    used by stripe_reconciler to replay events the webhook never received,
+    which answers 409 for an order that was confirmed already.
+    """
+    payment_intent = event_stripe["data"]["object"]
+    metadata = payment_intent.get("metadata", {})
+    
+    # Extract identifiers from metadata
+    order_id = metadata.get("order_id")
+    correlation_id = metadata.get("correlation_id")
+    tracing.annotate(order_id=order_id, correlation_id=correlation_id)
+    client_id = metadata.get("client_id")
+    job_id = metadata.get("job_id")
+    
+    if not order_id:
+        logger.error("Payment intent succeeded but no order_id in metadata")
+        return {"statusCode": 400, "body": json.dumps({"error": "Missing order_id"}, cls=DecimalEncoder)}
         
-        # Get items if available - handle case where items is a JSON string
-        items_data = order_data.get('items', [])
-        if isinstance(items_data, str):
-            try:
-                items = json.loads(items_data)
-            except:
-                items = []
-        else:
-            items = items_data
-            
-        items_html = ""
-        for item in items:
-            name = item.get('name', 'Unknown item')
-            qty = item.get('quantity', 1)
-            price = item.get('price', 0)
-            items_html += f"<li>{name} x {qty} - ${price}</li>"
+    logger.info("Processing successful payment", client_id=client_id, job_id=job_id)
+    
+    # Get customer details
+    customer_email = payment_intent.get("receipt_email")
+    amount_total = payment_intent.get("amount")
+    
+    current_time = int(time.time())
+    
+    try:
+        # Get the current order first
+        current_order = get_order(table, order_id) or {}
+
+        if not current_order:
+            logger.error("Order not found in DynamoDB, unable to process", table=orders_table_name)
+            return {"statusCode": 404, "body": json.dumps({"error": f"Order {order_id} not found"}, cls=DecimalEncoder)}
         
-        # Create HTML version
-        html = f"""
-        <html>
-        <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; }}
-                .container {{ padding: 20px; }}
-                h2 {{ color: #256F8A; }}
-                .order-details {{ margin: 20px 0; }}
-                .order-total {{ font-weight: bold; margin-top: 20px; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h2>New Order Received!</h2>
-                <p>A new order has been placed and payment has been confirmed.</p>
-                
-                <div class="order-details">
-                    <p><strong>Order ID:</strong> {order_id}</p>
-                    <p><strong>Customer Email:</strong> {customer_email}</p>
-                    <p><strong>Total Amount:</strong> {amount_formatted}</p>
-                </div>
-                
-                <h3>Order Items:</h3>
-                <ul>
-                    {items_html}
-                </ul>
-                
-                <p class="order-total">Total: {amount_formatted}</p>
-                
-                <p>This order is being processed for fulfillment through Prodigi.</p>
-            </div>
-        </body>
-        </html>
-        """
+        # Orders from before correlation IDs use their order ID instead
+        correlation_id = current_order.get("correlation_id") or correlation_id or order_id
+        tracing.annotate(correlation_id=correlation_id)
         
-        # Create plain text version
-        text = f"""
-        New Order Received!
+        if current_order.get("status") not in REPLAYABLE_STATUSES or current_order.get("prodigi_order_id"):
+            return already_confirmed_response(replay)
         
-        A new order has been placed and payment has been confirmed.
+        # An order paid after it expired has given its prints back
+        if current_order.get("stock_released"):
+            reclaim_stock(order_id, current_order)
         
-        Order ID: {order_id}
-        Customer Email: {customer_email}
-        Total Amount: {amount_formatted}
+        # Update order status in DynamoDB
+        update_expression = "SET payment_status = :payment_status, #status_attr = :order_status, updated_at = :time, amount_paid = :amount"
+        expression_attr_values = {
+            ":payment_status": "paid",
+            ":order_status": "PAYMENT_COMPLETE", 
+            ":time": current_time,
+            ":amount": Decimal(str(amount_total))
+        }
         
-        This order is being processed for fulfillment through Prodigi.
-        """
+        expression_attr_names = {
+            "#status_attr": "status"
+        }
         
-        # Send email using AWS SES
-        response = ses_client.send_email(
-            Source=SES_SENDER_EMAIL,
-            Destination={
-                'ToAddresses': [NOTIFICATION_EMAIL]
-            },
-            Message={
-                'Subject': {
-                    'Data': f"New Order: {order_id}"
-                },
-                'Body': {
-                    'Text': {
-                        'Data': text
-                    },
-                    'Html': {
-                        'Data': html
-                    }
-                }
-            }
+        # Rewrite legacy JSON-string items in the compact schema
+        update_expression = with_items_migration(
+            current_order, update_expression, expression_attr_names, expression_attr_values
         )
         
-        logger.info(f"Notification email sent for order {order_id} with message ID: {response['MessageId']}")
+        # Stripe's event time marks when the payment actually succeeded
+        event_created = event_stripe.get("created")
+        update_expression = with_stage_timestamps(current_order, {
+            "payment_succeeded": event_created * 1000 if event_created else None,
+            "payment_confirmed": None
+        }, update_expression, expression_attr_names, expression_attr_values)
+        update_expression = with_version(update_expression, expression_attr_names, expression_attr_values)
+        
+        # The status was read before; don't act on it if the order moved on,
+        # which would set it PAYMENT_COMPLETE again and fulfill it twice
+        expression_attr_values[":pending"], expression_attr_values[":expired"] = REPLAYABLE_STATUSES
         
+        # Update order in DynamoDB
+        try:
+            update_response = table.update_item(
+                Key={"order_id": order_id},
+                UpdateExpression=update_expression,
+                ConditionExpression="#status_attr IN (:pending, :expired) AND attribute_not_exists(prodigi_order_id)",
+                ExpressionAttributeValues=expression_attr_values,
+                ExpressionAttributeNames=expression_attr_names,
+                ReturnValues="ALL_NEW"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return already_confirmed_response(replay)
+        shared_cache.invalidate_order(order_id)
+        
+        logger.info("Updated order status to PAYMENT_COMPLETE")
+        logger.debug("Order after update", order=lazy(unpack_order, update_response.get('Attributes')))
+        
+        # Fulfillment and the notification email follow from the
+        # PAYMENT_COMPLETE write through the orders stream (see
+        # order_fulfillment and order_notifications)
+        
+        # Record the status change so the polling frontend can pick it up
+        # This is necessary because we can't push directly to the browser
+        if client_id:
+            try:
+                record_status_event(client_id, order_id, "PAYMENT_COMPLETE", current_time)
+                logger.debug("Stored status event", client_id=client_id)
+            except Exception as status_err:
+                logger.error("Error recording client status event: %s", status_err, client_id=client_id)
+                # This is non-critical, so we continue processing
+            
     except Exception as e:
-        logger.error(f"Failed to send notification email: {str(e)}")
-        logger.error(f"SES sender email: {SES_SENDER_EMAIL}, notification email: {NOTIFICATION_EMAIL}")
+        logger.exception("Error updating order status: %s", e)
+        return {"statusCode": 500, "body": json.dumps({"error": f"Error processing payment: {str(e)}"}, cls=DecimalEncoder)}
 
+    return {"statusCode": 200, "body": json.dumps({"received": True}, cls=DecimalEncoder)}
+
+@tracing.trace_handler
+@profiling.profiled
+@deadline.budgeted
 def handler(event, context):
-    logger.info("Received webhook event")
-    logger.info(f"Event contents: {json.dumps(event, default=str)}")
+    logger.debug("Received webhook event", event=event)
     
     # Get the raw body and signature from the event
     payload = event.get("body", "")
     sig_header = event["headers"].get("Stripe-Signature")
     
-    logger.info(f"Using webhook secret starting with: {endpoint_secret[:4] if endpoint_secret else 'MISSING'}")
-    logger.info(f"Webhook raw payload type: {type(payload)}")
-    logger.info(f"Webhook payload first 50 chars: {payload[:50] if payload else 'EMPTY'}")
+    if not config.get("STRIPE_WEBHOOK_SECRET"):
+        logger.warning("STRIPE_WEBHOOK_SECRET is not set")
     
     # Special workaround for API Gateway + Lambda
     # The payload needs to be reconstructed because API Gateway modifies it,
     # breaking the signature verification
     if event.get("isBase64Encoded", False):
         import base64
-        logger.info("Payload is base64 encoded, decoding it")
+        logger.debug("Payload is base64 encoded, decoding it")
         payload = base64.b64decode(payload).decode('utf-8')
     
     try:
-        # Create the signature manually to debug
-        logger.info("Constructing expected signature for debugging")
-        import hmac
-        import hashlib
-        timestamp = sig_header.split(',')[0].split('=')[1]
-        payload_to_sign = f"{timestamp}.{payload}"
-        expected_signature = hmac.new(
-            endpoint_secret.encode('utf-8'),
-            payload_to_sign.encode('utf-8'),
-            hashlib.sha256
-        ).hexdigest()
-        logger.info(f"Expected signature starts with: {expected_signature[:10]}")
-        
-        # Attempt to construct the Stripe event with the raw payload
-        logger.info(f"Attempting to construct Stripe event with payload length: {len(payload)}")
-        event_stripe = stripe.Webhook.construct_event(
-            payload, sig_header, endpoint_secret
-        )
-        logger.info(f"Webhook event type: {event_stripe['type']}")
-        logger.info(f"Webhook event contents: {json.dumps(event_stripe, cls=DecimalEncoder)}")
+        event_stripe = construct_event(payload, sig_header)
+        logger.info("Webhook event received", event_type=event_stripe['type'], event_id=event_stripe.get('id'),
+                    payload_length=len(payload))
+        logger.debug("Webhook event contents", stripe_event=lazy(json.loads, payload))
     except Exception as e:
-        logger.error(f"Webhook signature verification failed: {str(e)}")
-        logger.error(f"Received signature: {sig_header}")
+        logger.error("Webhook signature verification failed: %s", e, payload_length=len(payload or ""))
         
         # For testing only - bypass signature verification
         # In production, you would return an error here
@@ -191,134 +244,15 @@ def handler(event, context):
             # Parse the payload directly
             payload_json = json.loads(payload)
             if payload_json.get("type") == "payment_intent.succeeded":
-                logger.info("Processing payment_intent.succeeded event despite signature failure")
+                logger.warning("Processing payment_intent.succeeded event despite signature failure")
                 event_stripe = payload_json
             else:
                 return {"statusCode": 400, "body": json.dumps({"error": "Invalid signature"}, cls=DecimalEncoder)}
         except Exception as parse_error:
-            logger.error(f"Failed to parse payload as JSON: {str(parse_error)}")
+            logger.error("Failed to parse payload as JSON: %s", parse_error)
             return {"statusCode": 400, "body": json.dumps({"error": "Invalid signature"}, cls=DecimalEncoder)}
 
     if event_stripe["type"] == "payment_intent.succeeded":
-        payment_intent = event_stripe["data"]["object"]
-        metadata = payment_intent.get("metadata", {})
-        
-        # Extract identifiers from metadata
-        order_id = metadata.get("order_id")
-        client_id = metadata.get("client_id")
-        job_id = metadata.get("job_id")
-        
-        if not order_id:
-            logger.error("Payment intent succeeded but no order_id in metadata")
-            return {"statusCode": 400, "body": json.dumps({"error": "Missing order_id"}, cls=DecimalEncoder)}
-            
-        logger.info(f"Processing successful payment for order: {order_id}, client: {client_id}, job: {job_id}")
-        
-        # Get customer details
-        customer_email = payment_intent.get("receipt_email")
-        amount_total = payment_intent.get("amount")
-        
-        current_time = int(time.time())
-        
-        try:
-            # Get the current order first
-            logger.info(f"Retrieving order {order_id} from table {orders_table_name}")
-            get_response = table.get_item(Key={"order_id": order_id})
-            current_order = get_response.get("Item", {})
-
-            if not current_order:
-                logger.error(f"Order {order_id} not found in DynamoDB. Unable to process.")
-                return {"statusCode": 404, "body": json.dumps({"error": f"Order {order_id} not found"}, cls=DecimalEncoder)}
-            
-            logger.info(f"Found order in DynamoDB: {order_id}")
-            
-            # Update order status in DynamoDB
-            update_expression = "SET payment_status = :payment_status, #status_attr = :order_status, updated_at = :time, amount_paid = :amount"
-            expression_attr_values = {
-                ":payment_status": "paid",
-                ":order_status": "PAYMENT_COMPLETE", 
-                ":time": current_time,
-                ":amount": Decimal(str(amount_total))
-            }
-            
-            expression_attr_names = {
-                "#status_attr": "status"
-            }
-            
-            # Update order in DynamoDB
-            update_response = table.update_item(
-                Key={"order_id": order_id},
-                UpdateExpression=update_expression,
-                ExpressionAttributeValues=expression_attr_values,
-                ExpressionAttributeNames=expression_attr_names,
-                ReturnValues="ALL_NEW"
-            )
-            
-            logger.info(f"Updated order status to PAYMENT_COMPLETE: {order_id}")
-            logger.info(f"Order update response: {json.dumps(update_response, cls=DecimalEncoder)}")
-            
-            # Send email notification
-            send_notification_email(current_order, payment_intent)
-            
-            # Invoke order fulfillment Lambda asynchronously
-            prodigi_lambda_name = os.environ.get("PRODIGI_ORDER_FUNCTION_NAME")
-            if prodigi_lambda_name:
-                logger.info(f"Invoking Prodigi order processing for order: {order_id}")
-                
-                # Preserve ALL original order data and add payment info
-                invoke_payload = {
-                    "order_id": order_id,
-                    "order_data": current_order,
-                    "payment_intent": payment_intent
-                }
-                
-                logger.info(f"Sending order data to Prodigi lambda with keys: {list(current_order.keys())}")
-                
-                try:
-                    lambda_response = lambda_client.invoke(
-                        FunctionName=prodigi_lambda_name,
-                        InvocationType="Event",  # Asynchronous invocation
-                        Payload=json.dumps(invoke_payload, cls=DecimalEncoder)
-                    )
-                    logger.info(f"Successfully invoked Prodigi Lambda. Response: {lambda_response}")
-                except Exception as lambda_err:
-                    logger.error(f"Failed to invoke Prodigi Lambda: {str(lambda_err)}")
-                    # Continue processing since this is non-critical
-            else:
-                logger.warning(f"PRODIGI_ORDER_FUNCTION_NAME environment variable not set. Skipping Prodigi order creation for order: {order_id}")
-            
-            # Try to update the client's browser by posting to our webhook-status resource
-            try:
-                public_webhook_url = os.environ.get("PUBLIC_WEBHOOK_URL")
-                if public_webhook_url and client_id:
-                    # This is used by the frontend to poll for status updates
-                    status_data = {
-                        "clientId": client_id,
-                        "orderId": order_id,
-                        "status": "PAYMENT_COMPLETE",
-                        "timestamp": current_time
-                    }
-                    
-                    # Store this status update for the frontend to poll
-                    # This is necessary because we can't push directly to the browser
-                    table.put_item(
-                        Item={
-                            "status_update_id": f"{client_id}_{current_time}",
-                            "client_id": client_id,
-                            "order_id": order_id,
-                            "status": "PAYMENT_COMPLETE",
-                            "timestamp": current_time,
-                            "expires_at": current_time + (60 * 60 * 24)  # 24 hour TTL
-                        }
-                    )
-                    
-                    logger.info(f"Stored status update for client: {client_id}")
-            except Exception as status_err:
-                logger.error(f"Error updating client status: {str(status_err)}")
-                # This is non-critical, so we continue processing
-                
-        except Exception as e:
-            logger.error(f"Error updating order status: {str(e)}")
-            return {"statusCode": 500, "body": json.dumps({"error": f"Error processing payment: {str(e)}"}, cls=DecimalEncoder)}
+        return apply_payment_succeeded(event_stripe)
 
     return {"statusCode": 200, "body": json.dumps({"received": True}, cls=DecimalEncoder)} 
\ No newline at end of file
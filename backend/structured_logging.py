@@ -0,0 +1,233 @@
+"""
+Structured logging shared by the handlers.
+
+    from structured_logging import get_logger, lazy
+    logger = get_logger(__name__)
+
+    logger.info("Order updated", order_id=order_id, status="PAYMENT_COMPLETE")
+    logger.debug("Prodigi payload", payload=lazy(json.loads, body))
+
+Each record is one JSON line carrying the message, level, function, request id,
+order id and correlation id (from the current trace), plus any keyword fields. Messages use
+%-style arguments and fields can be lazy(), so nothing is formatted or
+serialized unless the record is actually written.
+
+Before a record is written:
+- values under personal or secret keys (email, phone, address, API keys,
+  client secrets) are redacted,
+- e-mail addresses inside strings are masked,
+- long strings and lists are truncated.
+
+Configuration (environment):
+    LOG_LEVEL          threshold, default INFO
+    LOG_SAMPLE_RATES   per-level fraction of invocations whose records are
+                       kept, e.g. "DEBUG=0.05,INFO=1". A rate for a level
+                       below LOG_LEVEL turns that level on for the sampled
+                       invocations; the decision is per invocation, so a
+                       sampled invocation logs completely
+    LOG_MAX_FIELD_CHARS  truncation length for strings, default 1024
+"""
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import logging
+
+import tracing
+
+LOG_LEVEL = logging.getLevelName(os.environ.get("LOG_LEVEL", "INFO").upper())
+if not isinstance(LOG_LEVEL, int):
+    LOG_LEVEL = logging.INFO
+LOG_MAX_FIELD_CHARS = int(os.environ.get("LOG_MAX_FIELD_CHARS", "1024"))
+LOG_MAX_LIST_ITEMS = 20
+LOG_MAX_DEPTH = 6
+
+REDACTED_KEYS = frozenset(key.lower() for key in (
+    "customer_email", "email", "receipt_email", "phone", "phoneNumber",
+    "address1", "address2", "line1", "line2", "address", "postalCode", "postalOrZipCode",
+    "firstName", "lastName", "recipient", "billing_details",
+    "client_secret", "clientSecret", "X-API-Key", "Stripe-Signature", "Authorization",
+    "api_key", "secret", "password"
+))
+REDACTED = "[redacted]"
+EMAIL_PATTERN = re.compile(r"\b([A-Za-z0-9._%+-])[A-Za-z0-9._%+-]*@([A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)+)\b")
+
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({})))
+
+
+def _parse_sample_rates(value):
+    rates = {}
+    for part in filter(None, (p.strip() for p in value.split(","))):
+        name, _, rate = part.partition("=")
+        level = logging.getLevelName(name.strip().upper())
+        if isinstance(level, int):
+            rates[level] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+LOG_SAMPLE_RATES = _parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES", ""))
+
+
+class lazy:
+    """A value computed only if the record it belongs to is written"""
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def resolve(self):
+        return self.func(*self.args)
+
+    def __str__(self):
+        return str(self.resolve())
+
+
+def _truncate(text, limit=None):
+    limit = limit or LOG_MAX_FIELD_CHARS
+    if len(text) > limit:
+        return f"{text[:limit]}...[{len(text) - limit} more chars]"
+    return text
+
+
+def mask_emails(text):
+    return EMAIL_PATTERN.sub(r"\1***@\2", text)
+
+
+def scrub(value, depth=0):
+    """Resolve lazy values, redact sensitive keys, and truncate large values"""
+    if isinstance(value, lazy):
+        value = value.resolve()
+    if isinstance(value, str):
+        return mask_emails(_truncate(value))
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if depth >= LOG_MAX_DEPTH:
+        return "[...]"
+    if isinstance(value, dict):
+        return {
+            str(key): REDACTED if str(key).lower() in REDACTED_KEYS else scrub(item, depth + 1)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple, set)):
+        items = list(value)
+        scrubbed = [scrub(item, depth + 1) for item in items[:LOG_MAX_LIST_ITEMS]]
+        if len(items) > LOG_MAX_LIST_ITEMS:
+            scrubbed.append(f"[{len(items) - LOG_MAX_LIST_ITEMS} more items]")
+        return scrubbed
+    if isinstance(value, (bytes, bytearray)):
+        return f"[{len(value)} bytes]"
+    return mask_emails(_truncate(str(value)))
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME")
+
+    def format(self, record):
+        message = record.msg if isinstance(record.msg, str) else str(record.msg)
+        if record.args:
+            args = record.args if isinstance(record.args, tuple) else (record.args,)
+            try:
+                message = message % tuple(scrub(arg) for arg in args)
+            except (TypeError, ValueError):
+                message = f"{message} {args!r}"
+
+        entry = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": mask_emails(_truncate(message, LOG_MAX_FIELD_CHARS * 2))
+        }
+        if self.function_name:
+            entry["function"] = self.function_name
+
+        trace = tracing.current_trace()
+        if trace is not None:
+            entry["request_id"] = trace.request_id
+            for key in ("order_id", "correlation_id"):
+                if key in trace.annotations:
+                    entry[key] = trace.annotations[key]
+
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(scrub(fields))
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in ("fields", "message", "asctime", "aws_request_id"):
+                entry[key] = scrub(value)
+
+        if record.exc_info:
+            entry["exception"] = _truncate(self.formatException(record.exc_info), LOG_MAX_FIELD_CHARS * 4)
+        return json.dumps(entry, default=str, separators=(",", ":"))
+
+
+class SamplingFilter(logging.Filter):
+    """Apply LOG_LEVEL and LOG_SAMPLE_RATES, deciding once per invocation"""
+
+    def filter(self, record):
+        rate = LOG_SAMPLE_RATES.get(record.levelno)
+        if rate is None:
+            return record.levelno >= LOG_LEVEL
+        if rate >= 1.0:
+            return True
+        if rate <= 0.0:
+            return False
+
+        trace = tracing.current_trace()
+        if trace is None or not trace.request_id:
+            return random.random() < rate
+        key = f"{trace.request_id}:{record.levelno}".encode("utf-8")
+        return zlib.crc32(key) / 0xFFFFFFFF < rate
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """Logger whose keyword arguments (other than exc_info etc.) become fields"""
+
+    _logging_kwargs = ("exc_info", "stack_info", "stacklevel", "extra")
+
+    def __init__(self, logger):
+        super().__init__(logger, {})
+
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in self._logging_kwargs}
+        if fields:
+            extra = dict(kwargs.get("extra") or {})
+            extra["fields"] = fields
+            kwargs["extra"] = extra
+        return msg, kwargs
+
+
+_configured = False
+
+
+def configure():
+    """Install the JSON formatter and sampling filter on the root logger's handlers"""
+    global _configured
+    if _configured:
+        return
+    _configured = True
+
+    root = logging.getLogger()
+    if not root.handlers:
+        root.addHandler(logging.StreamHandler(sys.stderr))
+    for handler in root.handlers:
+        handler.setFormatter(JsonFormatter())
+        handler.addFilter(SamplingFilter())
+
+    # Let records below LOG_LEVEL through to the filter only if some are sampled
+    sampled_levels = [level for level, rate in LOG_SAMPLE_RATES.items() if rate > 0]
+    root.setLevel(min([LOG_LEVEL] + sampled_levels))
+
+    # Library chatter stays at WARNING whatever LOG_LEVEL says
+    for name in ("botocore", "boto3", "urllib3", "stripe"):
+        logging.getLogger(name).setLevel(max(LOG_LEVEL, logging.WARNING))
+
+
+def get_logger(name=None):
+    configure()
+    return StructuredLogger(logging.getLogger(name))
@@ -0,0 +1,388 @@
+"""
+Lightweight per-invocation tracing.
+
+Every boto3 call (DynamoDB, SES, Lambda, S3...), every Stripe API request and
+any block wrapped in span() is timed as a span. When the handler returns, the
+spans are written to stdout as one CloudWatch Embedded Metric Format record:
+a latency array per dependency (CloudWatch turns these into percentiles),
+dimensioned by function and cold start, plus the individual spans, the
+order id and the correlation id as searchable log properties.
+
+DynamoDB calls are made with ReturnConsumedCapacity=TOTAL and the capacity
+units they report are added up per invocation: a total and a per-operation
+metric, plus a per table/operation breakdown in the record. With
+TRACING_CALL_SITES=true each breakdown entry also names the handler line that
+made the call (tools/capacity_report.py ranks them).
+
+boto3 is instrumented through hooks on the default session, so this module
+must be imported before a handler module creates its clients. Import it
+first and decorate the entry point:
+
+    import tracing
+    ...
+    @tracing.trace_handler
+    def handler(event, context):
+        tracing.annotate(order_id=order_id, correlation_id=correlation_id)
+
+The correlation id is created at checkout and carried on the order and in
+the PaymentIntent metadata. Fulfillment reads it from the order item it
+takes from the stream record, and passes it on in the Prodigi order
+metadata, so one id ties together the records of every function that
+touched an order.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import contextvars
+import boto3
+
+try:
+    import stripe
+except ImportError:
+    stripe = None
+
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "true").lower() != "false"
+TRACING_CALL_SITES = os.environ.get("TRACING_CALL_SITES", "false").lower() == "true"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "SteepleCo/Backend")
+
+# EMF accepts at most 100 values per metric
+MAX_METRIC_VALUES = 100
+
+# Call sites are the first frame in a handler module (this directory)
+_THIS_FILE = os.path.abspath(__file__)
+_HANDLER_DIR = os.path.dirname(_THIS_FILE)
+_handler_modules = {}
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+_cold_start = True
+_sink = None
+
+
+class Trace:
+    """Spans and annotations collected during one invocation"""
+
+    __slots__ = ("function_name", "request_id", "cold_start", "started", "spans", "annotations", "capacity",
+                 "counters", "gauges", "lock")
+
+    def __init__(self, function_name, request_id, cold_start):
+        self.function_name = function_name
+        self.request_id = request_id
+        self.cold_start = cold_start
+        self.started = time.perf_counter()
+        self.spans = []
+        self.annotations = {}
+        self.capacity = {}
+        self.counters = {}
+        self.gauges = {}
+        # Side effects (fanout.py) record into the trace from worker threads
+        self.lock = threading.Lock()
+
+    def record(self, dependency, operation, started, error=False):
+        self.spans.append((dependency, operation, time.perf_counter() - started, error))
+
+    def record_capacity(self, operation, consumed, site=None):
+        """Add the ConsumedCapacity of a DynamoDB response (one entry or a list)"""
+        with self.lock:
+            for entry in consumed if isinstance(consumed, list) else [consumed]:
+                key = (entry.get("TableName"), operation, site)
+                totals = self.capacity.setdefault(key, [0.0, 0])
+                totals[0] += float(entry.get("CapacityUnits") or 0)
+                totals[1] += 1
+
+    def to_emf(self, timestamp_ms=None):
+        duration_ms = (time.perf_counter() - self.started) * 1000
+        latencies = {}
+        errors = {}
+        for dependency, _, elapsed, error in self.spans:
+            latencies.setdefault(dependency, []).append(round(elapsed * 1000, 3))
+            if error:
+                errors[dependency] = errors.get(dependency, 0) + 1
+
+        metrics = [{"Name": "Duration", "Unit": "Milliseconds"}]
+        record = {
+            "Function": self.function_name,
+            "ColdStart": "true" if self.cold_start else "false",
+            "Duration": round(duration_ms, 3)
+        }
+        for dependency, values in latencies.items():
+            name = dependency.replace(" ", "")
+            metrics.append({"Name": f"{name}Latency", "Unit": "Milliseconds"})
+            record[f"{name}Latency"] = values[:MAX_METRIC_VALUES]
+        for dependency, count in errors.items():
+            name = dependency.replace(" ", "")
+            metrics.append({"Name": f"{name}Errors", "Unit": "Count"})
+            record[f"{name}Errors"] = count
+
+        for name, value in self.counters.items():
+            metrics.append({"Name": name, "Unit": "Count"})
+            record[name] = value
+        for name, (value, unit) in self.gauges.items():
+            metrics.append({"Name": name, "Unit": unit})
+            record[name] = value
+
+        if self.capacity:
+            per_operation = {}
+            for (_, operation, _), (units, _) in self.capacity.items():
+                per_operation[operation] = per_operation.get(operation, 0.0) + units
+            metrics.append({"Name": "DynamoDBCapacityUnits", "Unit": "Count"})
+            record["DynamoDBCapacityUnits"] = round(sum(per_operation.values()), 2)
+            for operation, units in per_operation.items():
+                metrics.append({"Name": f"DynamoDB{operation}CapacityUnits", "Unit": "Count"})
+                record[f"DynamoDB{operation}CapacityUnits"] = round(units, 2)
+
+        record["_aws"] = {
+            "Timestamp": timestamp_ms or int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [["Function"], ["Function", "ColdStart"]],
+                "Metrics": metrics
+            }]
+        }
+        record["request_id"] = self.request_id
+        record["spans"] = [
+            {"dependency": dependency, "operation": operation, "ms": round(elapsed * 1000, 3), "error": error}
+            for dependency, operation, elapsed, error in self.spans
+        ]
+        if self.capacity:
+            record["capacity"] = [
+                dict({"table": table, "operation": operation, "units": round(units, 2), "calls": calls},
+                     **({"site": site} if site else {}))
+                for (table, operation, site), (units, calls) in self.capacity.items()
+            ]
+        record.update(self.annotations)
+        return record
+
+
+class span:
+    """
+    Time a block as a span of the current invocation; a no-op outside one.
+
+        with tracing.span("Prodigi", "POST /orders") as s:
+            response = requests.post(...)
+            s.error = response.status_code >= 400
+    """
+
+    __slots__ = ("dependency", "operation", "started", "error", "trace")
+
+    def __init__(self, dependency, operation):
+        self.dependency = dependency
+        self.operation = operation
+        self.error = False
+
+    def __enter__(self):
+        self.trace = _current_trace.get()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace is not None:
+            self.trace.record(self.dependency, self.operation, self.started, self.error or exc_type is not None)
+        return False
+
+
+def annotate(**properties):
+    """Attach properties (order_id, ...) to the current invocation's record"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.annotations.update(properties)
+
+
+def count(name, value=1):
+    """Add to a per-invocation Count metric (DeadlineExhausted, ...)"""
+    trace = _current_trace.get()
+    if trace is not None:
+        with trace.lock:
+            trace.counters[name] = trace.counters.get(name, 0) + value
+
+
+def gauge(name, value, unit="None"):
+    """Set a per-invocation metric to a measured value (backlog age, queue depth, ...)"""
+    trace = _current_trace.get()
+    if trace is not None:
+        with trace.lock:
+            trace.gauges[name] = (value, unit)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def _order_id_from_event(event):
+    if not isinstance(event, dict):
+        return None
+    query = event.get("queryStringParameters") or {}
+    return event.get("order_id") or query.get("orderId") or query.get("order_id")
+
+
+def trace_handler(func):
+    """Decorate a Lambda handler: collect spans and emit them when it returns"""
+    function_name = func.__module__
+
+    @functools.wraps(func)
+    def wrapper(event, context):
+        global _cold_start
+        # Handlers called from another handler (create_prodigi_order) add
+        # their spans to the caller's trace
+        if not TRACING_ENABLED or _current_trace.get() is not None:
+            return func(event, context)
+
+        trace = Trace(function_name, getattr(context, "aws_request_id", None), _cold_start)
+        _cold_start = False
+        order_id = _order_id_from_event(event)
+        if order_id:
+            trace.annotations["order_id"] = order_id
+        if isinstance(event, dict) and event.get("correlation_id"):
+            trace.annotations["correlation_id"] = event["correlation_id"]
+
+        token = _current_trace.set(trace)
+        try:
+            return func(event, context)
+        finally:
+            _current_trace.reset(token)
+            emit(trace)
+
+    return wrapper
+
+
+def set_sink(sink):
+    """Send EMF records to sink(line) instead of stdout (local runs, benchmarks)"""
+    global _sink
+    _sink = sink
+
+
+def emit(trace):
+    try:
+        line = json.dumps(trace.to_emf(), default=str, separators=(",", ":"))
+        if _sink is not None:
+            _sink(line)
+        else:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+    except Exception:
+        # Metrics must never fail the invocation
+        pass
+
+
+# --- boto3 -----------------------------------------------------------------
+
+def _before_boto_call(context, model, **kwargs):
+    if _current_trace.get() is not None:
+        context["tracing_started"] = time.perf_counter()
+        # after-call-error isn't given the operation model
+        context["tracing_model"] = model
+
+
+def _after_boto_call(context, model, parsed=None, **kwargs):
+    context.pop("tracing_model", None)
+    started = context.pop("tracing_started", None)
+    if started is not None:
+        trace = _current_trace.get()
+        if trace is not None:
+            error = bool(parsed and "Error" in parsed)
+            trace.record(model.service_model.service_id, model.name, started, error)
+            if parsed and parsed.get("ConsumedCapacity"):
+                site = _call_site(trace.function_name) if TRACING_CALL_SITES else None
+                trace.record_capacity(model.name, parsed["ConsumedCapacity"], site)
+
+
+def _after_boto_call_error(context, **kwargs):
+    model = context.pop("tracing_model", None)
+    started = context.pop("tracing_started", None)
+    if started is not None and model is not None:
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.record(model.service_model.service_id, model.name, started, True)
+
+
+def _request_consumed_capacity(params, model, **kwargs):
+    if (_current_trace.get() is not None and "ReturnConsumedCapacity" not in params
+            and "ReturnConsumedCapacity" in model.input_shape.members):
+        params["ReturnConsumedCapacity"] = "TOTAL"
+
+
+def _handler_module(filename):
+    module = _handler_modules.get(filename, False)
+    if module is False:
+        path = os.path.abspath(filename)
+        module = None
+        if os.path.dirname(path) == _HANDLER_DIR and path != _THIS_FILE:
+            module = os.path.splitext(os.path.basename(path))[0]
+        _handler_modules[filename] = module
+    return module
+
+
+def _call_site(entry_module):
+    """
+    module.function:line of the innermost frame in the invoked handler's
+    module, followed by the innermost backend frame when that is a shared
+    helper, e.g. "checkout_session.handler:131 > order_store.put_order:108"
+    """
+    inner = None
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = _handler_module(frame.f_code.co_filename)
+        if module:
+            site = f"{module}.{frame.f_code.co_name}:{frame.f_lineno}"
+            if module == entry_module:
+                return f"{site} > {inner}" if inner else site
+            inner = inner or site
+        frame = frame.f_back
+    return inner
+
+
+def _register_boto_hooks(events):
+    events.register("provide-client-params.dynamodb", _request_consumed_capacity,
+                    unique_id="tracing-consumed-capacity")
+    events.register("before-call", _before_boto_call, unique_id="tracing-before-call")
+    events.register("after-call", _after_boto_call, unique_id="tracing-after-call")
+    events.register("after-call-error", _after_boto_call_error, unique_id="tracing-after-call-error")
+
+
+def instrument(client):
+    """Trace a boto3 client or resource created before this module was imported"""
+    if hasattr(client.meta, "client"):
+        _register_boto_hooks(client.meta.client.meta.events)
+    else:
+        _register_boto_hooks(client.meta.events)
+    return client
+
+
+# --- Stripe ----------------------------------------------------------------
+
+class TracedStripeClient:
+    """Wraps Stripe's HTTP client so each API request becomes a span"""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def request_with_retries(self, method, url, headers, post_data=None, **kwargs):
+        path = url.split("://", 1)[-1].split("?", 1)[0]
+        path = path[path.find("/"):] if "/" in path else "/"
+        operation = f"{method.upper()} " + "/".join(
+            "{id}" if "_" in part and part[:1].islower() and any(c.isdigit() for c in part) else part
+            for part in path.split("/")
+        )
+        with span("Stripe", operation) as s:
+            content, code, response_headers = self._client.request_with_retries(
+                method, url, headers, post_data, **kwargs
+            )
+            s.error = code >= 400
+        return content, code, response_headers
+
+
+if TRACING_ENABLED:
+    if boto3.DEFAULT_SESSION is None:
+        boto3.setup_default_session()
+    _register_boto_hooks(boto3.DEFAULT_SESSION.events)
+
+    if stripe is not None and not isinstance(stripe.default_http_client, TracedStripeClient):
+        stripe.default_http_client = TracedStripeClient(
+            stripe.default_http_client
+            or stripe.new_default_http_client(verify_ssl_certs=stripe.verify_ssl_certs, proxy=stripe.proxy)
+        )
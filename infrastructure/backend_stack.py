@@ -3,9 +3,12 @@ from aws_cdk import (
     RemovalPolicy,
     Stack,
     aws_lambda as _lambda,
+    aws_lambda_event_sources as lambda_event_sources,
     aws_apigateway as apigw,
     aws_dynamodb as dynamodb,
     aws_iam as iam,
+    aws_s3 as s3,
+    aws_secretsmanager as secretsmanager,
     Duration,
     aws_events,
     aws_events_targets
@@ -25,10 +28,118 @@ class BackendStack(Stack):
                 type=dynamodb.AttributeType.STRING
             ),
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY,
+            stream=dynamodb.StreamViewType.NEW_AND_OLD_IMAGES
+        )
+
+        # Sparse index of the orders Prodigi has not finished (see
+        # backend/order_store.py); only those orders carry its keys
+        orders_table.add_global_secondary_index(
+            index_name="InFulfillment",
+            partition_key=dynamodb.Attribute(
+                name="fulfillment_shard",
+                type=dynamodb.AttributeType.NUMBER
+            ),
+            sort_key=dynamodb.Attribute(
+                name="in_fulfillment_since",
+                type=dynamodb.AttributeType.NUMBER
+            ),
+            projection_type=dynamodb.ProjectionType.INCLUDE,
+            non_key_attributes=["prodigi_order_id", "shipping_status"]
+        )
+
+        # Orders by status and last update, for operators picking out ERROR
+        # or stuck orders (tools/reprocess_orders.py)
+        orders_table.add_global_secondary_index(
+            index_name="ByStatus",
+            partition_key=dynamodb.Attribute(
+                name="status",
+                type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="updated_at",
+                type=dynamodb.AttributeType.NUMBER
+            ),
+            projection_type=dynamodb.ProjectionType.INCLUDE,
+            non_key_attributes=["error_message", "prodigi_order_id"]
+        )
+
+        # Per-client status events polled by /payment-status
+        status_events_table = dynamodb.Table(
+            self, "StatusEventsTable",
+            table_name="SteepleCo-StatusEvents",
+            partition_key=dynamodb.Attribute(
+                name="client_id",
+                type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="event_time",
+                type=dynamodb.AttributeType.NUMBER
+            ),
+            time_to_live_attribute="expires_at",
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        # Sharded sales counters maintained from the orders stream
+        aggregates_table = dynamodb.Table(
+            self, "SalesAggregatesTable",
+            table_name="SteepleCo-SalesAggregates",
+            partition_key=dynamodb.Attribute(
+                name="aggregate_key",
+                type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="shard",
+                type=dynamodb.AttributeType.NUMBER
+            ),
+            time_to_live_attribute="expires_at",
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
             removal_policy=RemovalPolicy.DESTROY
         )
 
-        # Order Cleanup Lambda (runs weekly)
+        # Cursors of scheduled jobs that work through a feed incrementally
+        checkpoints_table = dynamodb.Table(
+            self, "CheckpointsTable",
+            table_name="SteepleCo-Checkpoints",
+            partition_key=dynamodb.Attribute(
+                name="job",
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        # Token buckets of the public API's rate limiter (see backend/rate_limit.py)
+        rate_limits_table = dynamodb.Table(
+            self, "RateLimitsTable",
+            table_name="SteepleCo-RateLimits",
+            partition_key=dynamodb.Attribute(
+                name="bucket_key",
+                type=dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute="expires_at",
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        # Sharded print counters of limited editions (see backend/stock.py)
+        stock_table = dynamodb.Table(
+            self, "StockTable",
+            table_name="SteepleCo-Stock",
+            partition_key=dynamodb.Attribute(
+                name="sku",
+                type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="shard",
+                type=dynamodb.AttributeType.NUMBER
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        # Order Cleanup Lambda (runs every 15 minutes)
         order_cleanup_lambda = _lambda.Function(
             self, "OrderCleanupLambda",
             function_name="SteepleCo-OrderCleanup",
@@ -47,20 +158,75 @@ class BackendStack(Stack):
             environment={
                 "ORDERS_TABLE": orders_table.table_name,
             },
-            timeout=Duration.seconds(60)  # Give it enough time to process all expired orders
+            timeout=Duration.minutes(5)  # A drop can leave many abandoned checkouts to expire
         )
 
-        # Add EventBridge rule to trigger the cleanup function weekly
+        # Often, so the prints abandoned checkouts hold go back on sale
+        # during a drop; the ByStatus index keeps each run cheap
         cleanup_rule = aws_events.Rule(
-            self, "WeeklyCleanupRule",
-            schedule=aws_events.Schedule.rate(Duration.days(7)),
-            description="Triggers the order cleanup function weekly"
+            self, "OrderCleanupRule",
+            schedule=aws_events.Schedule.rate(Duration.minutes(15)),
+            description="Expires abandoned checkouts and releases their stock"
         )
         cleanup_rule.add_target(aws_events_targets.LambdaFunction(order_cleanup_lambda))
 
         # Grant permissions to the cleanup Lambda
         orders_table.grant_read_write_data(order_cleanup_lambda)
 
+        # Archive bucket for old orders in terminal states
+        archive_bucket = s3.Bucket(
+            self, "OrderArchiveBucket",
+            encryption=s3.BucketEncryption.S3_MANAGED,
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            enforce_ssl=True,
+            removal_policy=RemovalPolicy.RETAIN
+        )
+
+        # Order Archive Lambda (runs daily)
+        order_archive_lambda = _lambda.Function(
+            self, "OrderArchiveLambda",
+            function_name="SteepleCo-OrderArchive",
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            handler="order_archive.handler",
+            code=_lambda.Code.from_asset(
+                "backend",
+                bundling={
+                    "image": _lambda.Runtime.PYTHON_3_9.bundling_image,
+                    "command": [
+                        "bash", "-c",
+                        "pip install -r requirements.txt -t /asset-output && cp -au . /asset-output"
+                    ]
+                }
+            ),
+            environment={
+                "ORDERS_TABLE": orders_table.table_name,
+                "ARCHIVE_BUCKET": archive_bucket.bucket_name,
+                "ARCHIVE_AFTER_DAYS": "90"
+            },
+            # A single writer keeps the read-modify-write of the index shards safe
+            reserved_concurrent_executions=1,
+            memory_size=512,
+            timeout=Duration.minutes(5)
+        )
+
+        archive_rule = aws_events.Rule(
+            self, "DailyArchiveRule",
+            schedule=aws_events.Schedule.rate(Duration.days(1)),
+            description="Moves old terminal orders to the S3 archive daily"
+        )
+        archive_rule.add_target(aws_events_targets.LambdaFunction(order_archive_lambda))
+
+        orders_table.grant_read_write_data(order_archive_lambda)
+        archive_bucket.grant_read_write(order_archive_lambda)
+
+        # Stripe and Prodigi keys live in one Secrets Manager secret (a JSON
+        # object keyed like the env vars), read at runtime by backend/config.py.
+        # The deploy workflow writes it; nothing secret goes into the template.
+        api_keys_secret = secretsmanager.Secret.from_secret_name_v2(
+            self, "ApiKeysSecret",
+            self.node.try_get_context('api_keys_secret_name') or "SteepleCo/ApiKeys"
+        )
+
         # Create Lambda functions
         create_checkout_session = _lambda.Function(
             self, 'CreateCheckoutSession',
@@ -78,14 +244,16 @@ class BackendStack(Stack):
             ),
             handler='checkout_session.handler',
             environment={
-                'STRIPE_SECRET_KEY': self.node.try_get_context('stripe_secret_key') or self.node.try_get_context('stripe_test_secret_key') or "sk_placeholder_value",
+                'CONFIG_SECRET_ID': api_keys_secret.secret_name,
                 'SUCCESS_URL': self.node.try_get_context('success_url') or 'https://hansenhomeai.github.io/success',
                 'CANCEL_URL': self.node.try_get_context('cancel_url') or 'https://hansenhomeai.github.io/cancel',
                 'ORDERS_TABLE': orders_table.table_name
-            }
+            },
+            timeout=Duration.seconds(10)  # deadline.py budgets dependency calls within this; API Gateway gives up at 29 s
         )
 
-        # Prodigi Order Lambda
+        # Prodigi Order Lambda (invoked by hand to resubmit an order; paid
+        # orders are submitted by the OrderFulfillment stream consumer)
         prodigi_order_lambda = _lambda.Function(
             self, "ProdigiOrderLambda",
             function_name="SteepleCo-ProdigiOrder",
@@ -103,8 +271,7 @@ class BackendStack(Stack):
             ),
             environment={
                 "ORDERS_TABLE": orders_table.table_name,
-                "PRODIGI_SANDBOX_API_KEY": self.node.try_get_context('prodigi_sandbox_api_key') or "prod_sandbox_sk_xxxxxxxxxxxxxxxxxxxxxxxx",
-                "LOG_LEVEL": "DEBUG"  # Set to DEBUG for maximum logging
+                "CONFIG_SECRET_ID": api_keys_secret.secret_name
             },
             timeout=Duration.seconds(30)  # Give it enough time to process the API call
         )
@@ -122,7 +289,7 @@ class BackendStack(Stack):
             resources=["*"]  # You can restrict this to specific ARNs if desired
         )
         
-        # Update ProcessWebhook Lambda to use SES
+        # Stripe webhook Lambda
         process_webhook = _lambda.Function(
             self, 'ProcessWebhook',
             function_name="SteepleCo-WebhookHandler",
@@ -139,27 +306,52 @@ class BackendStack(Stack):
             ),
             handler='stripe_webhook.handler',
             environment={
-                'STRIPE_SECRET_KEY': self.node.try_get_context('stripe_secret_key') or self.node.try_get_context('stripe_test_secret_key') or "sk_placeholder_value",
-                'STRIPE_WEBHOOK_SECRET': self.node.try_get_context('stripe_webhook_secret') or "whsec_placeholder",
-                'PRODIGI_SANDBOX_API_KEY': self.node.try_get_context('prodigi_sandbox_api_key') or "prod_sandbox_sk_xxxxxxxxxxxxxxxxxxxxxxxx",
+                'CONFIG_SECRET_ID': api_keys_secret.secret_name,
                 'ORDERS_TABLE': orders_table.table_name,
-                'SES_SENDER_EMAIL': self.node.try_get_context('ses_sender_email') or 'hello@hansenhome.ai',
-                'PRODIGI_ORDER_FUNCTION_NAME': prodigi_order_lambda.function_name,
-                'LOG_LEVEL': 'DEBUG'
+                'STATUS_EVENTS_TABLE': status_events_table.table_name
             },
             timeout=Duration.seconds(30)  # Give enough time to process the webhook
         )
-        
-        # Add SES permissions to the webhook Lambda
-        process_webhook.add_to_role_policy(ses_policy_statement)
-        
-        # Add permissions to invoke the Prodigi Order Lambda function
-        lambda_invoke_policy = iam.PolicyStatement(
-            effect=iam.Effect.ALLOW,
-            actions=["lambda:InvokeFunction"],
-            resources=[prodigi_order_lambda.function_arn]
+
+        # Stripe Reconciler Lambda: replays payments the webhook missed
+        stripe_reconciler_lambda = _lambda.Function(
+            self, "StripeReconcilerLambda",
+            function_name="SteepleCo-StripeReconciler",
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            handler="stripe_reconciler.handler",
+            code=_lambda.Code.from_asset(
+                "backend",
+                bundling={
+                    "image": _lambda.Runtime.PYTHON_3_9.bundling_image,
+                    "command": [
+                        "bash", "-c",
+                        "pip install -r requirements.txt -t /asset-output && cp -au . /asset-output"
+                    ]
+                }
+            ),
+            environment={
+                "CONFIG_SECRET_ID": api_keys_secret.secret_name,
+                "ORDERS_TABLE": orders_table.table_name,
+                "STATUS_EVENTS_TABLE": status_events_table.table_name,
+                "CHECKPOINTS_TABLE": checkpoints_table.table_name
+            },
+            # A single writer of the checkpoint
+            reserved_concurrent_executions=1,
+            timeout=Duration.minutes(5)
+        )
+
+        # Often enough that a missed payment is confirmed soon after the
+        # order; one order_cleanup expired meanwhile takes its stock back
+        reconcile_rule = aws_events.Rule(
+            self, "StripeReconcileRule",
+            schedule=aws_events.Schedule.rate(Duration.minutes(15)),
+            description="Replays Stripe payments the webhook did not apply"
         )
-        process_webhook.add_to_role_policy(lambda_invoke_policy)
+        reconcile_rule.add_target(aws_events_targets.LambdaFunction(stripe_reconciler_lambda))
+
+        orders_table.grant_read_write_data(stripe_reconciler_lambda)
+        status_events_table.grant_write_data(stripe_reconciler_lambda)
+        checkpoints_table.grant_read_write_data(stripe_reconciler_lambda)
 
         # Prodigi Webhook Lambda
         prodigi_webhook_lambda = _lambda.Function(
@@ -180,12 +372,51 @@ class BackendStack(Stack):
             environment={
                 "ORDERS_TABLE": orders_table.table_name,
                 "SES_SENDER_EMAIL": self.node.try_get_context('ses_sender_email') or 'hello@hansenhome.ai'
-            }
+            },
+            timeout=Duration.seconds(10)
         )
         
         # Add SES permissions to prodigi webhook Lambda
         prodigi_webhook_lambda.add_to_role_policy(ses_policy_statement)
 
+        # Prodigi Reconciler Lambda: applies status changes whose callbacks were lost
+        prodigi_reconciler_lambda = _lambda.Function(
+            self, "ProdigiReconcilerLambda",
+            function_name="SteepleCo-ProdigiReconciler",
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            handler="prodigi_reconciler.handler",
+            code=_lambda.Code.from_asset(
+                "backend",
+                bundling={
+                    "image": _lambda.Runtime.PYTHON_3_9.bundling_image,
+                    "command": [
+                        "bash", "-c",
+                        "pip install -r requirements.txt -t /asset-output && cp -au . /asset-output"
+                    ]
+                }
+            ),
+            environment={
+                "CONFIG_SECRET_ID": api_keys_secret.secret_name,
+                "ORDERS_TABLE": orders_table.table_name,
+                "CHECKPOINTS_TABLE": checkpoints_table.table_name,
+                "SES_SENDER_EMAIL": self.node.try_get_context('ses_sender_email') or 'hello@hansenhome.ai'
+            },
+            # Overlapping runs would check the same orders twice
+            reserved_concurrent_executions=1,
+            timeout=Duration.minutes(5)
+        )
+        prodigi_reconciler_lambda.add_to_role_policy(ses_policy_statement)
+
+        prodigi_reconcile_rule = aws_events.Rule(
+            self, "ProdigiReconcileRule",
+            schedule=aws_events.Schedule.rate(Duration.hours(1)),
+            description="Applies Prodigi order states the webhook did not receive"
+        )
+        prodigi_reconcile_rule.add_target(aws_events_targets.LambdaFunction(prodigi_reconciler_lambda))
+
+        orders_table.grant_read_write_data(prodigi_reconciler_lambda)
+        checkpoints_table.grant_read_write_data(prodigi_reconciler_lambda)
+
         # Order Status Lambda
         order_status_lambda = _lambda.Function(
             self, "OrderStatusLambda",
@@ -204,8 +435,136 @@ class BackendStack(Stack):
             ),
             environment={
                 "ORDERS_TABLE": orders_table.table_name,
+                "ARCHIVE_BUCKET": archive_bucket.bucket_name,
+            },
+            timeout=Duration.seconds(10)
+        )
+        archive_bucket.grant_read(order_status_lambda)
+
+        # Sales Aggregator Lambda (consumes the orders stream)
+        sales_aggregator_lambda = _lambda.Function(
+            self, "SalesAggregatorLambda",
+            function_name="SteepleCo-SalesAggregator",
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            handler="sales_aggregator.handler",
+            code=_lambda.Code.from_asset(
+                "backend",
+                bundling={
+                    "image": _lambda.Runtime.PYTHON_3_9.bundling_image,
+                    "command": [
+                        "bash", "-c",
+                        "pip install -r requirements.txt -t /asset-output && cp -au . /asset-output"
+                    ]
+                }
+            ),
+            environment={
+                "AGGREGATES_TABLE": aggregates_table.table_name,
+                "AGGREGATE_SHARDS": "8"
+            },
+            timeout=Duration.seconds(30)
+        )
+
+        # Only deliver records where an order has just become PAYMENT_COMPLETE
+        payment_complete_filter = _lambda.FilterCriteria.filter({
+            "eventName": _lambda.FilterRule.is_equal("MODIFY"),
+            "dynamodb": {
+                "NewImage": {"status": {"S": _lambda.FilterRule.is_equal("PAYMENT_COMPLETE")}},
+                "OldImage": {"status": {"S": _lambda.FilterRule.not_equals("PAYMENT_COMPLETE")}}
             }
+        })
+        sales_aggregator_lambda.add_event_source(lambda_event_sources.DynamoEventSource(
+            orders_table,
+            starting_position=_lambda.StartingPosition.LATEST,
+            batch_size=100,
+            bisect_batch_on_error=True,
+            retry_attempts=5,
+            report_batch_item_failures=True,
+            filters=[payment_complete_filter]
+        ))
+        aggregates_table.grant_read_write_data(sales_aggregator_lambda)
+
+        # Order Fulfillment and Order Notifications Lambdas: the rest of what
+        # follows a payment, on the same records. They take only the order key
+        # and version from a record and read the order back (backend/order_events.py).
+        order_fulfillment_lambda = _lambda.Function(
+            self, "OrderFulfillmentLambda",
+            function_name="SteepleCo-OrderFulfillment",
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            handler="order_fulfillment.handler",
+            code=_lambda.Code.from_asset(
+                "backend",
+                bundling={
+                    "image": _lambda.Runtime.PYTHON_3_9.bundling_image,
+                    "command": [
+                        "bash", "-c",
+                        "pip install -r requirements.txt -t /asset-output && cp -au . /asset-output"
+                    ]
+                }
+            ),
+            environment={
+                "ORDERS_TABLE": orders_table.table_name,
+                "CONFIG_SECRET_ID": api_keys_secret.secret_name
+            },
+            timeout=Duration.seconds(60)  # A batch of Prodigi submissions, at most 10 s each
         )
+        order_notifications_lambda = _lambda.Function(
+            self, "OrderNotificationsLambda",
+            function_name="SteepleCo-OrderNotifications",
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            handler="order_notifications.handler",
+            code=_lambda.Code.from_asset(
+                "backend",
+                bundling={
+                    "image": _lambda.Runtime.PYTHON_3_9.bundling_image,
+                    "command": [
+                        "bash", "-c",
+                        "pip install -r requirements.txt -t /asset-output && cp -au . /asset-output"
+                    ]
+                }
+            ),
+            environment={
+                "ORDERS_TABLE": orders_table.table_name,
+                "SES_SENDER_EMAIL": self.node.try_get_context('ses_sender_email') or 'hello@hansenhome.ai'
+            },
+            timeout=Duration.seconds(30)
+        )
+        for order_consumer in (order_fulfillment_lambda, order_notifications_lambda):
+            order_consumer.add_event_source(lambda_event_sources.DynamoEventSource(
+                orders_table,
+                starting_position=_lambda.StartingPosition.LATEST,
+                batch_size=10,
+                bisect_batch_on_error=True,
+                retry_attempts=5,
+                report_batch_item_failures=True,
+                filters=[payment_complete_filter]
+            ))
+        orders_table.grant_read_write_data(order_fulfillment_lambda)
+        orders_table.grant_read_data(order_notifications_lambda)
+        order_notifications_lambda.add_to_role_policy(ses_policy_statement)
+
+        # Sales Report Lambda (reads the aggregates for dashboards)
+        sales_report_lambda = _lambda.Function(
+            self, "SalesReportLambda",
+            function_name="SteepleCo-SalesReport",
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            handler="sales_report.handler",
+            code=_lambda.Code.from_asset(
+                "backend",
+                bundling={
+                    "image": _lambda.Runtime.PYTHON_3_9.bundling_image,
+                    "command": [
+                        "bash", "-c",
+                        "pip install -r requirements.txt -t /asset-output && cp -au . /asset-output"
+                    ]
+                }
+            ),
+            environment={
+                "AGGREGATES_TABLE": aggregates_table.table_name,
+                "AGGREGATE_SHARDS": "8"
+            },
+            timeout=Duration.seconds(10)
+        )
+        aggregates_table.grant_read_data(sales_report_lambda)
 
         # Define CORS options
         cors_options = apigw.CorsOptions(
@@ -274,8 +633,9 @@ class BackendStack(Stack):
             ),
             handler='stripe_test.handler',
             environment={
-                'STRIPE_SECRET_KEY': self.node.try_get_context('stripe_test_secret_key') or "sk_placeholder_value"
-            }
+                'CONFIG_SECRET_ID': api_keys_secret.secret_name
+            },
+            timeout=Duration.seconds(10)
         )
         
         stripe_test = api.root.add_resource("stripe-test")
@@ -297,6 +657,21 @@ class BackendStack(Stack):
             apigw.LambdaIntegration(order_status_lambda)
         )
 
+        # Add sales report endpoint (requires an API key, since it exposes revenue)
+        sales_report = api.root.add_resource("sales-report")
+        sales_report.add_method(
+            "GET",
+            apigw.LambdaIntegration(sales_report_lambda),
+            api_key_required=True
+        )
+
+        sales_report_usage_plan = api.add_usage_plan(
+            "SalesReportUsagePlan",
+            name="SteepleCo-SalesReport",
+            api_stages=[apigw.UsagePlanPerApiStage(api=api, stage=api.deployment_stage)]
+        )
+        sales_report_usage_plan.add_api_key(api.add_api_key("SalesReportApiKey"))
+
         # Payment Success Lambda
         payment_success_lambda = _lambda.Function(
             self, 'PaymentSuccessLambda',
@@ -314,11 +689,12 @@ class BackendStack(Stack):
             ),
             handler='payment_success.handler',
             environment={
-                'STRIPE_SECRET_KEY': self.node.try_get_context('stripe_test_secret_key') or self.node.try_get_context('stripe_secret_key') or "sk_placeholder_value",
-                'PRODIGI_SANDBOX_API_KEY': self.node.try_get_context('prodigi_sandbox_api_key') or "prod_sandbox_sk_xxxxxxxxxxxxxxxxxxxxxxxx",
+                'CONFIG_SECRET_ID': api_keys_secret.secret_name,
                 'ORDERS_TABLE': orders_table.table_name,
+                'STATUS_EVENTS_TABLE': status_events_table.table_name,
                 'SES_SENDER_EMAIL': self.node.try_get_context('ses_sender_email') or 'hello@hansenhome.ai'
-            }
+            },
+            timeout=Duration.seconds(20)  # Stripe is called inline; API Gateway gives up at 29 s
         )
         
         # Add SES permissions to payment success Lambda
@@ -369,8 +745,10 @@ class BackendStack(Stack):
             ),
             handler='payment_status.handler',
             environment={
-                'ORDERS_TABLE': orders_table.table_name
-            }
+                'ORDERS_TABLE': orders_table.table_name,
+                'STATUS_EVENTS_TABLE': status_events_table.table_name
+            },
+            timeout=Duration.seconds(10)
         )
 
         # Add payment-status endpoint with CORS enabled
@@ -404,25 +782,84 @@ class BackendStack(Stack):
         # Grant permissions
         orders_table.grant_read_write_data(create_checkout_session)
         orders_table.grant_read_write_data(process_webhook)
-        orders_table.grant_write_data(prodigi_webhook_lambda)
+        orders_table.grant_read_write_data(prodigi_webhook_lambda)  # Reads the order before recording the shipping stage
         orders_table.grant_read_data(order_status_lambda)
         orders_table.grant_read_data(payment_status_lambda)  # Grant permissions to payment status Lambda
         orders_table.grant_read_write_data(payment_success_lambda)  # Grant permissions to payment success Lambda
+        status_events_table.grant_write_data(process_webhook)
+        status_events_table.grant_write_data(payment_success_lambda)  # Applies payments ahead of the webhook
+        for function_with_keys in (create_checkout_session, process_webhook, stripe_reconciler_lambda,
+                                   prodigi_order_lambda, order_fulfillment_lambda, prodigi_reconciler_lambda,
+                                   payment_success_lambda, stripe_test_lambda):
+            api_keys_secret.grant_read(function_with_keys)
+        status_events_table.grant_read_data(payment_status_lambda)
+        # Checkout reserves prints, order_cleanup gives them back and a late
+        # payment (webhook, reconciler or payment_success) takes them again
+        for stock_function in (create_checkout_session, order_cleanup_lambda, process_webhook, stripe_reconciler_lambda,
+                               payment_success_lambda):
+            stock_function.add_environment("STOCK_TABLE", stock_table.table_name)
+            stock_table.grant_read_write_data(stock_function)
+        for rate_limited_function in (create_checkout_session, payment_success_lambda, payment_status_lambda):
+            rate_limited_function.add_environment("RATE_LIMITS_TABLE", rate_limits_table.table_name)
+            rate_limits_table.grant_write_data(rate_limited_function)
 
         # Add logging configuration function
         def add_enhanced_logging(lambda_function):
-            """Add enhanced CloudWatch logging for Lambda functions"""
+            """Configure structured logging (see backend/structured_logging.py)"""
             lambda_function.add_environment("LOG_LEVEL", "INFO")
-            lambda_function.add_environment("POWERTOOLS_SERVICE_NAME", "poster-shop")
-            lambda_function.add_environment("POWERTOOLS_LOGGER_SAMPLE_RATE", "1.0")
-            lambda_function.add_environment("POWERTOOLS_LOGGER_LOG_EVENT", "true")
+            # Full DEBUG detail (events, payloads) for 1% of invocations
+            lambda_function.add_environment("LOG_SAMPLE_RATES", "DEBUG=0.01")
             
         # Apply enhanced logging to all Lambda functions
         add_enhanced_logging(order_cleanup_lambda)
         add_enhanced_logging(create_checkout_session)
         add_enhanced_logging(process_webhook)
+        add_enhanced_logging(stripe_reconciler_lambda)
         add_enhanced_logging(prodigi_webhook_lambda)
+        add_enhanced_logging(prodigi_reconciler_lambda)
         add_enhanced_logging(order_status_lambda)
         add_enhanced_logging(payment_success_lambda)
         add_enhanced_logging(payment_status_lambda)
-        add_enhanced_logging(prodigi_order_lambda) 
\ No newline at end of file
+        add_enhanced_logging(prodigi_order_lambda)
+        add_enhanced_logging(sales_aggregator_lambda)
+        add_enhanced_logging(order_fulfillment_lambda)
+        add_enhanced_logging(order_notifications_lambda)
+        add_enhanced_logging(sales_report_lambda)
+        add_enhanced_logging(order_archive_lambda)
+
+        # Sampled handler profiles (see backend/profiling.py); off unless
+        # deployed with -c profile_sample_rate=0.01
+        profiles_bucket = s3.Bucket(
+            self, "HandlerProfilesBucket",
+            encryption=s3.BucketEncryption.S3_MANAGED,
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            enforce_ssl=True,
+            removal_policy=RemovalPolicy.DESTROY,
+            auto_delete_objects=True,
+            lifecycle_rules=[s3.LifecycleRule(expiration=Duration.days(14))]
+        )
+        profile_sample_rate = str(self.node.try_get_context('profile_sample_rate') or "0")
+
+        def add_profiling(lambda_function):
+            lambda_function.add_environment("PROFILE_BUCKET", profiles_bucket.bucket_name)
+            lambda_function.add_environment("PROFILE_SAMPLE_RATE", profile_sample_rate)
+            profiles_bucket.grant_put(lambda_function)
+
+        for profiled_function in (order_cleanup_lambda, create_checkout_session, process_webhook,
+                                  stripe_reconciler_lambda, prodigi_webhook_lambda, prodigi_reconciler_lambda,
+                                  order_status_lambda, payment_success_lambda, payment_status_lambda,
+                                  prodigi_order_lambda, sales_aggregator_lambda, order_fulfillment_lambda,
+                                  order_notifications_lambda, sales_report_lambda, order_archive_lambda,
+                                  stripe_test_lambda):
+            add_profiling(profiled_function)
+
+        # Optional cache shared by all containers in front of order and status
+        # reads (see backend/shared_cache.py): -c shared_cache_url=rediss://...
+        # An ElastiCache endpoint also needs the functions placed in its VPC.
+        shared_cache_url = self.node.try_get_context('shared_cache_url')
+        if shared_cache_url:
+            for order_function in (create_checkout_session, process_webhook, stripe_reconciler_lambda,
+                                   prodigi_webhook_lambda, prodigi_reconciler_lambda, order_status_lambda,
+                                   payment_status_lambda, payment_success_lambda, prodigi_order_lambda,
+                                   order_fulfillment_lambda, order_cleanup_lambda):
+                order_function.add_environment("SHARED_CACHE_URL", shared_cache_url)
@@ -495,7 +495,7 @@ document.getElementById('shipping-form').addEventListener('submit', async (e) =>
         if (!response.ok) {
             const errorData = await response.json().catch(() => ({}));
             console.error('API Error:', response.status, errorData);
-            throw new Error(`Checkout API returned ${response.status}: ${errorData.message || 'Unknown error'}`);
+            throw new Error(`Checkout API returned ${response.status}: ${errorData.error || errorData.message || 'Unknown error'}`);
         }
 
         const data = await response.json();
@@ -0,0 +1,14 @@
+"""
+Makes the Lambda modules in backend/ importable from the scripts in tools/.
+The backend modules create boto3 resources at import time, so a region is
+defaulted to the one the stack deploys to.
+"""
+import os
+import sys
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
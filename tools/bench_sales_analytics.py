@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the columnar sales analytics against a naive per-order loop.
+
+The naive version is what a one-off script over the orders table does today:
+walk every order dict and json.loads its `items` string for every report.
+Both implementations run on the same synthetic orders and their results are
+checked for equality before timings are printed.
+
+Usage:
+    python tools/bench_sales_analytics.py --orders 50000
+"""
+import json
+import time
+import random
+import argparse
+from datetime import datetime, timezone
+
+from sales_analytics import OrderColumns, PAID_STATUSES, WEEK_ORIGIN, WEEK_SECONDS
+
+POSTER_IDS = [1, 2, 3, 4, 5]
+COUNTRIES = ["US", "US", "US", "CA", "GB", "AU", "DE"]
+SHIPPING_METHODS = ["BUDGET", "BUDGET", "STANDARD", "EXPRESS", "PRIORITY"]
+STATUSES = ["PAYMENT_COMPLETE", "PROCESSING", "PROCESSING", "EXPIRED", "EXPIRED", "PENDING", "ERROR"]
+
+
+def synthetic_orders(count, seed=7):
+    rng = random.Random(seed)
+    start = 1735689600  # 2025-01-01
+    orders = []
+    for index in range(count):
+        items = [
+            {
+                "id": poster_id,
+                "name": f"Poster {poster_id}",
+                "price": 24.0,
+                "quantity": rng.randint(1, 3),
+                "image": f"assets/poster{poster_id}.jpg"
+            }
+            for poster_id in rng.sample(POSTER_IDS, rng.randint(1, 3))
+        ]
+        orders.append({
+            "order_id": f"order-{index}",
+            "status": rng.choice(STATUSES),
+            "amount": sum(int(item["price"] * 100) * item["quantity"] for item in items) + 580,
+            "created_at": start + rng.randrange(180 * 24 * 60 * 60),
+            "items": json.dumps(items),
+            "shipping_details": {
+                "country": rng.choice(COUNTRIES),
+                "shippingMethod": rng.choice(SHIPPING_METHODS)
+            }
+        })
+    return orders
+
+
+def is_paid(order):
+    return order.get("status") in PAID_STATUSES or order.get("payment_status") == "paid"
+
+
+def naive_revenue_per_poster_per_week(orders):
+    result = {}
+    for order in orders:
+        if not is_paid(order):
+            continue
+        week = (int(order["created_at"]) - WEEK_ORIGIN) // WEEK_SECONDS
+        week_start = datetime.fromtimestamp(week * WEEK_SECONDS + WEEK_ORIGIN, tz=timezone.utc).strftime("%Y-%m-%d")
+        for item in json.loads(order["items"]):
+            key = (str(item["id"]), week_start)
+            result[key] = result.get(key, 0) + int(round(float(item["price"]) * 100)) * int(item["quantity"])
+    return result
+
+
+def naive_aov_per_shipping_method(orders):
+    totals = {}
+    counts = {}
+    for order in orders:
+        if not is_paid(order):
+            continue
+        method = order["shipping_details"]["shippingMethod"]
+        totals[method] = totals.get(method, 0) + int(order["amount"])
+        counts[method] = counts.get(method, 0) + 1
+    return {method: totals[method] / counts[method] for method in totals}
+
+
+def naive_revenue_per_country(orders):
+    totals = {}
+    for order in orders:
+        if is_paid(order):
+            country = order["shipping_details"]["country"]
+            totals[country] = totals.get(country, 0) + int(order["amount"])
+    return totals
+
+
+def naive_funnel(orders):
+    created = len(orders)
+    paid = sum(1 for order in orders if is_paid(order))
+    expired = sum(1 for order in orders if order.get("status") == "EXPIRED")
+    return {
+        "created": created,
+        "paid": paid,
+        "expired": expired,
+        "paid_rate": paid / created if created else 0.0,
+        "expired_rate": expired / created if created else 0.0
+    }
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orders", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    orders = synthetic_orders(args.orders)
+
+    load_time, columns = timed(lambda: OrderColumns(orders), 1)
+    print(f"{args.orders} orders, columnar load (one-off): {load_time * 1000:.1f} ms")
+    print(f"{'report':32} {'naive ms':>10} {'columnar ms':>12} {'speedup':>8}")
+
+    reports = [
+        ("revenue_per_poster_per_week", naive_revenue_per_poster_per_week, columns.revenue_per_poster_per_week),
+        ("aov_per_shipping_method", naive_aov_per_shipping_method, columns.aov_per_shipping_method),
+        ("revenue_per_country", naive_revenue_per_country, columns.revenue_per_country),
+        ("funnel", naive_funnel, columns.funnel)
+    ]
+
+    naive_total = 0.0
+    columnar_total = 0.0
+    for name, naive, columnar in reports:
+        naive_time, expected = timed(lambda: naive(orders), args.repeat)
+        columnar_time, actual = timed(columnar, args.repeat)
+        if expected != actual:
+            raise SystemExit(f"{name}: columnar result differs from the naive loop")
+        naive_total += naive_time
+        columnar_total += columnar_time
+        print(f"{name:32} {naive_time * 1000:10.2f} {columnar_time * 1000:12.2f} {naive_time / columnar_time:7.1f}x")
+
+    print(f"{'all reports':32} {naive_total * 1000:10.2f} {columnar_total * 1000:12.2f} {naive_total / columnar_total:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Contention benchmark for limited-edition stock reservations.
+
+A drop is simulated on moto (or AWS_ENDPOINT_URL): an edition of
+--edition-size prints is seeded, and --threads shoppers reserve random
+quantities (1 to --max-qty) through stock.reserve, each writing a PENDING
+order in the same transaction as checkout does, until the edition is sold
+out. This runs once per shard
+count in --shards, so a single counter can be compared with sharded ones.
+
+Afterwards the run is checked for oversell: no shard may be below zero,
+the prints recorded on the orders must add up to exactly the edition, and
+so must the orders' lines. With --release, order_cleanup then expires every
+order (they are written already past their expiry) and the stock must be
+back to the full edition, twice over to show a repeated run gives nothing
+back again.
+
+The orders and stock tables are created as in the local stack, except that
+the orders table has no stream: nothing consumes it here. On moto, whose
+transactions are not atomic across threads and copy every table they
+touch, requests are applied one at a time, so the numbers show how many
+transactions a reservation takes and our own overhead rather than
+DynamoDB's per-partition limits; for those, point AWS_ENDPOINT_URL at
+DynamoDB Local. --dynamodb-latency adds a delay per call, outside that
+lock, so requests overlap as they would over a network.
+
+Usage:
+    python tools/bench_stock.py --edition-size 1000 --threads 64 --shards 1 8
+    python tools/bench_stock.py --dynamodb-latency 5 --release
+"""
+import os
+import time
+import uuid
+import random
+import argparse
+import threading
+import statistics
+
+import backend_env  # noqa: F401
+from local_stack import TABLES, invoke_handler
+
+ORDERS_TABLE = "SteepleCo-Orders"
+STOCK_TABLE = "SteepleCo-Stock"
+
+
+class Drop:
+    """Shoppers reserving one SKU until it is sold out, and what they got"""
+
+    def __init__(self, sku, orders_table_name, max_qty):
+        self.sku = sku
+        self.orders_table_name = orders_table_name
+        self.max_qty = max_qty
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.order_ids = []
+        self.prints = 0
+        self.sold_out = 0
+        self.contention = 0
+
+    def order_request(self, qty):
+        from order_store import put_order_request
+
+        # Already past expiry, so order_cleanup can expire it in --release
+        created_at = int(time.time()) - 3600
+        order_item = {
+            "order_id": str(uuid.uuid4()),
+            "status": "PENDING",
+            "items": [{"sku": self.sku, "qty": qty, "cents": 50}],
+            "amount": 50 * qty,
+            "created_at": created_at,
+            "updated_at": created_at,
+            "expires_at": created_at + 900
+        }
+
+        def build(reservations):
+            order_item["stock_reservations"] = reservations
+            return put_order_request(self.orders_table_name, order_item, condition="attribute_not_exists(order_id)")
+        build.order_id = order_item["order_id"]
+        return build
+
+    def shopper(self, seed):
+        import stock
+
+        rng = random.Random(seed)
+        while True:
+            qty = rng.randint(1, self.max_qty)
+            started = time.perf_counter()
+            order_request = self.order_request(qty)
+            try:
+                stock.reserve({self.sku: qty}, order_request)
+            except stock.SoldOut as e:
+                with self.lock:
+                    self.sold_out += 1
+                if not e.available:
+                    return
+                continue
+            except stock.StockContention:
+                with self.lock:
+                    self.contention += 1
+                continue
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.latencies.append(elapsed)
+                self.order_ids.append(order_request.order_id)
+                self.prints += qty
+
+    def run(self, threads):
+        workers = [threading.Thread(target=self.shopper, args=(seed,)) for seed in range(threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return time.perf_counter() - started
+
+
+def serialize_moto():
+    """Apply moto's requests one at a time, making each as atomic as it is in DynamoDB"""
+    from moto.core.botocore_stubber import BotocoreStubber
+
+    lock = threading.Lock()
+    process_request = BotocoreStubber.process_request
+
+    def locked(self, request):
+        with lock:
+            return process_request(self, request)
+    BotocoreStubber.process_request = locked
+
+
+def start_dynamodb(latency_ms):
+    os.environ.update({
+        "AWS_ACCESS_KEY_ID": os.environ.get("AWS_ACCESS_KEY_ID", "testing"),
+        "AWS_SECRET_ACCESS_KEY": os.environ.get("AWS_SECRET_ACCESS_KEY", "testing"),
+        "ORDERS_TABLE": ORDERS_TABLE,
+        "STOCK_TABLE": STOCK_TABLE,
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING")
+    })
+    if not os.environ.get("AWS_ENDPOINT_URL"):
+        from moto import mock_aws
+        mock_aws().start()
+        serialize_moto()
+
+    import boto3
+    if latency_ms:
+        boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register("before-send.dynamodb", lambda **kwargs: time.sleep(latency_ms / 1000.0))
+    dynamodb = boto3.client("dynamodb")
+    existing = set(dynamodb.list_tables()["TableNames"])
+    for table in TABLES:
+        if table["TableName"] in (ORDERS_TABLE, STOCK_TABLE) and table["TableName"] not in existing:
+            definition = {name: value for name, value in table.items() if name != "StreamSpecification"}
+            dynamodb.create_table(BillingMode="PAY_PER_REQUEST", **definition)
+
+    import tracing
+    tracing.set_sink(lambda line: None)
+
+
+def recorded_prints(orders_table, sku):
+    """(prints on the orders' lines, prints in their reservations, orders) for one SKU"""
+    from order_store import unpack_order
+
+    lines = reserved = count = 0
+    kwargs = {}
+    while True:
+        response = orders_table.scan(**kwargs)
+        for order in map(unpack_order, response.get("Items", [])):
+            order_lines = [line for line in order.get("items") or [] if line["sku"] == sku]
+            if not order_lines:
+                continue
+            count += 1
+            lines += sum(int(line["qty"]) for line in order_lines)
+            reserved += sum(int(r["qty"]) for r in order.get("stock_reservations") or [] if r["sku"] == sku)
+        if "LastEvaluatedKey" not in response:
+            return lines, reserved, count
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+def bench(shards, args):
+    import boto3
+    import stock
+
+    sku = f"bench-drop-{shards}"
+    stock.STOCK_SHARDS = shards
+    stock.seed(sku, args.edition_size, shards)
+
+    transactions = [0]
+    transactions_lock = threading.Lock()
+
+    def count_transaction(**kwargs):
+        with transactions_lock:
+            transactions[0] += 1
+
+    events = stock.dynamodb.meta.client.meta.events
+    events.register("before-call.dynamodb.TransactWriteItems", count_transaction)
+    try:
+        drop = Drop(sku, ORDERS_TABLE, args.max_qty)
+        elapsed = drop.run(args.threads)
+    finally:
+        events.unregister("before-call.dynamodb.TransactWriteItems", count_transaction)
+
+    orders_table = boto3.resource("dynamodb").Table(ORDERS_TABLE)
+    levels = stock.shard_levels(sku)
+    lines, reserved, orders = recorded_prints(orders_table, sku)
+    reservations = len(drop.latencies)
+
+    print(f"\n{shards} shard(s), {args.threads} threads, edition of {args.edition_size}")
+    print(f"  {reservations} reservations ({drop.prints} prints) in {elapsed:.2f}s: "
+          f"{reservations / elapsed:.0f} reservations/s, {drop.prints / elapsed:.0f} prints/s")
+    print(f"  latency p50 {percentile(drop.latencies, 0.5) * 1000:.1f} ms, "
+          f"p99 {percentile(drop.latencies, 0.99) * 1000:.1f} ms, "
+          f"mean {statistics.mean(drop.latencies or [0]) * 1000:.1f} ms")
+    print(f"  {transactions[0] / max(reservations, 1):.2f} transactions per reservation, "
+          f"{drop.sold_out} sold-out answers, {drop.contention} gave up on contention")
+    print(f"  left per shard: {dict(sorted(levels.items()))}")
+
+    problems = []
+    if any(level < 0 for level in levels.values()):
+        problems.append("a shard went below zero")
+    if sum(levels.values()) != 0:
+        problems.append(f"{sum(levels.values())} prints left unsold")
+    if not lines == reserved == drop.prints == args.edition_size:
+        problems.append(f"edition {args.edition_size}, shoppers got {drop.prints}, "
+                        f"orders have {lines} on their lines and {reserved} reserved")
+    if orders != reservations:
+        problems.append(f"{reservations} reservations but {orders} orders")
+
+    if args.release:
+        for attempt in ("first", "repeated"):
+            invoke_handler("order_cleanup", {}, 300)
+            left = sum(stock.shard_levels(sku).values())
+            print(f"  after the {attempt} cleanup run: {left} prints back in stock")
+            if left != args.edition_size:
+                problems.append(f"the {attempt} cleanup run left {left} of {args.edition_size} prints in stock")
+
+    print("  " + ("; ".join(problems) if problems else "no oversell"))
+
+    # moto copies the whole orders table in every transaction; start the
+    # next run without these
+    with orders_table.batch_writer() as batch:
+        for order_id in drop.order_ids:
+            batch.delete_item(Key={"order_id": order_id})
+    return not problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Limited-edition stock contention benchmark")
+    parser.add_argument("--edition-size", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=64, help="Concurrent shoppers")
+    parser.add_argument("--max-qty", type=int, default=3, help="Largest quantity a shopper asks for")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 8], help="Shard counts to compare")
+    parser.add_argument("--dynamodb-latency", type=float, default=0, help="Added latency per DynamoDB call (ms)")
+    parser.add_argument("--release", action="store_true",
+                        help="Expire every order with order_cleanup afterwards and check the stock comes back")
+    args = parser.parse_args()
+
+    start_dynamodb(args.dynamodb_latency)
+    results = [bench(shards, args) for shards in args.shards]
+    if not all(results):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Rank DynamoDB capacity consumption by code path.
+
+Reads the EMF records the handlers emit (tracing.py): the JSON lines written
+by `loadtest.py --metrics-out`, or a CloudWatch Logs export of the functions'
+log groups (non-EMF lines are skipped). Each record's capacity breakdown is
+summed per function, table, operation and call site. The ranking shows where
+request units go, how many each invocation spends, and an on-demand cost
+estimate per million invocations.
+
+Call sites are only present when the handlers ran with
+TRACING_CALL_SITES=true (the local stack sets it).
+
+Usage:
+    python tools/loadtest.py --users 20 --iterations 10 --metrics-out /tmp/emf.jsonl
+    python tools/capacity_report.py /tmp/emf.jsonl
+    python tools/capacity_report.py /tmp/emf.jsonl --by operation --top 10
+"""
+import json
+import argparse
+from collections import defaultdict
+
+# Operations billed as read request units; everything else is a write
+READ_OPERATIONS = {"GetItem", "BatchGetItem", "Query", "Scan", "TransactGetItems"}
+
+# On-demand prices in USD per million request units (us-west-2)
+READ_PRICE_PER_MILLION = 0.125
+WRITE_PRICE_PER_MILLION = 0.625
+
+GROUPINGS = {
+    "site": ("function", "table", "operation", "site"),
+    "operation": ("function", "table", "operation"),
+    "table": ("table", "operation"),
+    "function": ("function",)
+}
+
+
+def read_records(paths):
+    """Yield EMF records from JSON-lines files, skipping anything else"""
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                start = line.find("{")
+                if start < 0:
+                    continue
+                try:
+                    record = json.loads(line[start:])
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and "_aws" in record and "Function" in record:
+                    yield record
+
+
+def aggregate(records, by, read_price, write_price):
+    keys = GROUPINGS[by]
+    invocations = defaultdict(int)
+    rows = {}
+
+    for record in records:
+        function = record["Function"]
+        invocations[function] += 1
+        for entry in record.get("capacity", []):
+            values = {"function": function, "table": entry.get("table"),
+                      "operation": entry.get("operation"), "site": entry.get("site") or "(unknown)"}
+            key = tuple(values[name] for name in keys)
+            row = rows.setdefault(key, dict({name: values[name] for name in keys},
+                                            units=0.0, calls=0, cost=0.0, functions=set()))
+            units = float(entry.get("units") or 0)
+            price = read_price if entry.get("operation") in READ_OPERATIONS else write_price
+            row["units"] += units
+            row["calls"] += int(entry.get("calls") or 0)
+            row["cost"] += units * price / 1e6
+            row["functions"].add(function)
+
+    total_units = sum(row["units"] for row in rows.values()) or 1.0
+    ranked = sorted(rows.values(), key=lambda row: row["cost"], reverse=True)
+    for row in ranked:
+        functions = row.pop("functions")
+        calls_made_by = sum(invocations[function] for function in functions)
+        row["share"] = row["units"] / total_units
+        row["units_per_invocation"] = row["units"] / calls_made_by
+        row["usd_per_million_invocations"] = row["cost"] / calls_made_by * 1e6
+        del row["cost"]
+    return {"invocations": dict(invocations), "total_units": round(total_units, 2), "rows": ranked}
+
+
+def print_report(report, by, top):
+    invocations = ", ".join(f"{name}={count}" for name, count in sorted(report["invocations"].items()))
+    print(f"{report['total_units']} capacity units over {sum(report['invocations'].values())} invocations "
+          f"({invocations})\n")
+
+    label = " / ".join(GROUPINGS[by])
+    rows = report["rows"][:top] if top else report["rows"]
+    width = max([len(label)] + [len(" / ".join(str(row[name]) for name in GROUPINGS[by])) for row in rows])
+    print(f"{label:{width}} {'units':>9} {'share':>6} {'calls':>7} {'units/inv':>10} {'$/1M inv':>9}")
+    for row in rows:
+        name = " / ".join(str(row[key]) for key in GROUPINGS[by])
+        print(f"{name:{width}} {row['units']:9.1f} {row['share']:6.1%} {row['calls']:7} "
+              f"{row['units_per_invocation']:10.2f} {row['usd_per_million_invocations']:9.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank DynamoDB capacity consumption by code path")
+    parser.add_argument("files", nargs="+", help="EMF JSON-lines files (loadtest --metrics-out, log exports)")
+    parser.add_argument("--by", choices=sorted(GROUPINGS), default="site", help="Grouping (default: site)")
+    parser.add_argument("--top", type=int, default=0, help="Only show the N costliest rows")
+    parser.add_argument("--read-price", type=float, default=READ_PRICE_PER_MILLION,
+                        help="USD per million read request units")
+    parser.add_argument("--write-price", type=float, default=WRITE_PRICE_PER_MILLION,
+                        help="USD per million write request units")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    report = aggregate(read_records(args.files), args.by, args.read_price, args.write_price)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, args.by, args.top)
+
+
+if __name__ == "__main__":
+    main()
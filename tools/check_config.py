@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Checks backend/config.py against Secrets Manager and Parameter Store on moto.
+
+Each check builds its own ConfigCache over a fresh secret and parameter path
+and exercises one of the paths the Lambdas depend on:
+
+    values       the secret, SSM SecureStrings (decrypted) and the
+                 environment, in that order of precedence
+    ttl          a rotated secret is served from the cache until the TTL
+                 passes, then picked up by the background reload without the
+                 read that triggered it waiting
+    max-stale    a cache older than max_stale is reloaded before the read
+    failure      a failed fetch keeps the last good values and is not retried
+                 before retry_after
+    refresh      refresh() reloads at once, and calls closer together than
+                 CONFIG_REFRESH_MIN_SECONDS reuse that load
+
+The exit status is 1 if any check fails.
+
+Usage:
+    python tools/check_config.py
+    python tools/check_config.py -k ttl -k refresh
+"""
+import os
+import json
+import time
+import uuid
+import argparse
+
+import backend_env  # noqa: F401
+
+CHECKS = []
+
+
+def check(name):
+    def register(function):
+        CHECKS.append((name, function))
+        return function
+    return register
+
+
+def expect(problems, what, actual, expected):
+    if actual != expected:
+        problems.append(f"{what}: got {actual!r}, expected {expected!r}")
+
+
+def wait_for(condition, timeout=5.0):
+    """Poll condition until it is true or timeout passes; its last result"""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+
+class Store:
+    """A secret and a parameter path of their own, for one check"""
+
+    def __init__(self):
+        import boto3
+
+        self.secrets = boto3.client("secretsmanager")
+        self.ssm = boto3.client("ssm")
+        self.secret_id = f"check-config/{uuid.uuid4()}"
+        self.parameter_path = f"/check-config/{uuid.uuid4()}"
+
+    def put_secret(self, **values):
+        try:
+            self.secrets.put_secret_value(SecretId=self.secret_id, SecretString=json.dumps(values))
+        except self.secrets.exceptions.ResourceNotFoundException:
+            self.secrets.create_secret(Name=self.secret_id, SecretString=json.dumps(values))
+
+    def delete_secret(self):
+        self.secrets.delete_secret(SecretId=self.secret_id, ForceDeleteWithoutRecovery=True)
+
+    def put_parameter(self, name, value, secure=False):
+        self.ssm.put_parameter(Name=f"{self.parameter_path}/{name}", Value=value, Overwrite=True,
+                               Type="SecureString" if secure else "String")
+
+    def cache(self, secret=True, parameters=False, **kwargs):
+        from config import ConfigCache
+
+        return ConfigCache(self.secret_id if secret else None, self.parameter_path if parameters else None, **kwargs)
+
+
+@check("values")
+def check_values(problems):
+    store = Store()
+    store.put_secret(STRIPE_SECRET_KEY="sk_from_secret")
+    store.put_parameter("STRIPE_SECRET_KEY", "sk_from_ssm", secure=True)
+    store.put_parameter("PRODIGI_SANDBOX_API_KEY", "prodigi_from_ssm", secure=True)
+    store.put_parameter("nested/SETTING", "nested")
+    os.environ["CHECK_CONFIG_FROM_ENV"] = "from_env"
+    os.environ["PRODIGI_SANDBOX_API_KEY"] = "prodigi_from_env"
+
+    cache = store.cache(parameters=True)
+    expect(problems, "secret over SSM", cache.get("STRIPE_SECRET_KEY"), "sk_from_secret")
+    expect(problems, "decrypted SSM over the environment", cache.get("PRODIGI_SANDBOX_API_KEY"), "prodigi_from_ssm")
+    expect(problems, "SSM name below the path", cache.get("nested/SETTING"), "nested")
+    expect(problems, "environment fallback", cache.get("CHECK_CONFIG_FROM_ENV"), "from_env")
+    expect(problems, "default", cache.get("CHECK_CONFIG_UNSET", "default"), "default")
+
+    from config import ConfigError
+    try:
+        cache.require("CHECK_CONFIG_UNSET")
+        problems.append("require() of a missing setting did not raise ConfigError")
+    except ConfigError:
+        pass
+
+
+@check("ttl")
+def check_ttl(problems):
+    store = Store()
+    store.put_secret(STRIPE_SECRET_KEY="sk_old")
+    cache = store.cache(ttl=0.5, max_stale=60)
+    expect(problems, "first read", cache.get("STRIPE_SECRET_KEY"), "sk_old")
+
+    store.put_secret(STRIPE_SECRET_KEY="sk_rotated")
+    expect(problems, "read within the TTL", cache.get("STRIPE_SECRET_KEY"), "sk_old")
+
+    time.sleep(0.6)
+    loaded_at = cache._loaded_at
+    # The read past the TTL starts the reload and is answered from the cache
+    expect(problems, "read that starts the reload", cache.get("STRIPE_SECRET_KEY"), "sk_old")
+    if not wait_for(lambda: cache._loaded_at != loaded_at):
+        problems.append("the background reload never finished")
+    expect(problems, "read after the reload", cache.get("STRIPE_SECRET_KEY"), "sk_rotated")
+
+
+@check("max-stale")
+def check_max_stale(problems):
+    store = Store()
+    store.put_secret(STRIPE_SECRET_KEY="sk_old")
+    cache = store.cache(ttl=0.1, max_stale=0.3)
+    cache.get("STRIPE_SECRET_KEY")
+
+    store.put_secret(STRIPE_SECRET_KEY="sk_rotated")
+    time.sleep(0.4)
+    expect(problems, "read past max_stale", cache.get("STRIPE_SECRET_KEY"), "sk_rotated")
+
+
+@check("failure")
+def check_failure(problems):
+    store = Store()
+    store.put_secret(STRIPE_SECRET_KEY="sk_good")
+    cache = store.cache(ttl=0.1, max_stale=0.2, retry_after=0.5)
+    cache.get("STRIPE_SECRET_KEY")
+
+    store.delete_secret()
+    time.sleep(0.3)
+    expect(problems, "read when the fetch fails", cache.get("STRIPE_SECRET_KEY"), "sk_good")
+    if cache._failed_at is None:
+        problems.append("the failed fetch was not recorded")
+
+    store.put_secret(STRIPE_SECRET_KEY="sk_restored")
+    expect(problems, "read within retry_after", cache.get("STRIPE_SECRET_KEY"), "sk_good")
+    time.sleep(0.6)
+    expect(problems, "read after retry_after", cache.get("STRIPE_SECRET_KEY"), "sk_restored")
+
+
+@check("refresh")
+def check_refresh(problems):
+    import config
+
+    store = Store()
+    store.put_secret(STRIPE_SECRET_KEY="sk_old")
+    cache = store.cache(ttl=300, max_stale=3600)
+    cache.get("STRIPE_SECRET_KEY")
+
+    store.put_secret(STRIPE_SECRET_KEY="sk_rotated")
+    config.CONFIG_REFRESH_MIN_SECONDS = 0.3
+    time.sleep(0.4)
+    expect(problems, "refresh()", cache.refresh(), True)
+    expect(problems, "read after refresh()", cache.get("STRIPE_SECRET_KEY"), "sk_rotated")
+
+    store.put_secret(STRIPE_SECRET_KEY="sk_again")
+    expect(problems, "refresh() right after a load", cache.refresh(), False)
+    expect(problems, "read after the skipped refresh()", cache.get("STRIPE_SECRET_KEY"), "sk_rotated")
+
+    expect(problems, "refresh() without a secret or path", store.cache(secret=False).refresh(), False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check backend/config.py against moto")
+    parser.add_argument("-k", dest="names", action="append", help="Only run checks whose name contains this")
+    args = parser.parse_args()
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    from moto import mock_aws
+
+    import tracing
+    tracing.set_sink(lambda line: None)
+
+    failed = 0
+    for name, function in CHECKS:
+        if args.names and not any(part in name for part in args.names):
+            continue
+        problems = []
+        with mock_aws():
+            function(problems)
+        print(f"{name:<10} " + ("ok" if not problems else "FAILED"))
+        for problem in problems:
+            print(f"    {problem}")
+        failed += bool(problems)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
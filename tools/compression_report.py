@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Item-size and capacity-unit report for order attribute compression.
+
+Generates synthetic orders and sizes each one the way DynamoDB bills it, in
+three storage layouts:
+
+    legacy      items as json.dumps of the full client cart (pre compact lines)
+    native      compact order lines, no compression
+    compressed  compact order lines with order_store.pack_order applied
+
+For each layout it prints the item-size distribution and the write (1 KB) and
+read (4 KB) capacity units needed to put and get every order once.
+
+Usage:
+    python tools/compression_report.py --orders 10000 --threshold 256 --threshold 512
+"""
+import json
+import math
+import random
+import argparse
+from decimal import Decimal
+
+import backend_env  # noqa: F401
+import order_store
+from boto3.dynamodb.types import Binary
+from catalog import POSTERS
+
+SIZE_BUCKETS = [256, 512, 1024, 2048, 4096, 8192, 16384]
+
+
+def value_size(value):
+    """Approximate DynamoDB size of an attribute value in bytes"""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (int, float, Decimal)):
+        digits = len(str(abs(Decimal(str(value)))).replace(".", "").lstrip("0")) or 1
+        return math.ceil(digits / 2) + 1
+    if isinstance(value, Binary):
+        return len(value.value)
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, dict):
+        return 3 + sum(1 + len(k.encode("utf-8")) + value_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 3 + sum(1 + value_size(v) for v in value)
+    if isinstance(value, set):
+        return sum(value_size(v) for v in value)
+    raise TypeError(f"Cannot size {type(value).__name__}")
+
+
+def item_size(item):
+    return sum(len(name.encode("utf-8")) + value_size(value) for name, value in item.items())
+
+
+def prodigi_error_body(rng, item_count):
+    """Something shaped like a Prodigi validation failure"""
+    failures = {
+        f"items[{index}].attributes": [{
+            "code": "ValidationFailed",
+            "value": {"color": "white"},
+            "message": "The attribute 'color' is not valid for SKU GLOBAL-FAP-12X18"
+        }]
+        for index in range(item_count)
+    }
+    body = {
+        "statusCode": 400,
+        "outcome": "ValidationFailed",
+        "traceParent": "00-%032x-%016x-01" % (rng.getrandbits(128), rng.getrandbits(64)),
+        "failures": failures,
+        "data": {"order": {"shippingMethod": "Budget", "items": item_count}}
+    }
+    return f"Prodigi API error: {json.dumps(body)}"
+
+
+def synthetic_orders(count, seed=11):
+    rng = random.Random(seed)
+    skus = list(POSTERS)
+    for index in range(count):
+        cart = []
+        for sku in rng.sample(skus, rng.choice([1, 1, 1, 2, 2, 3, 5])):
+            poster = POSTERS[sku]
+            cart.append({
+                "id": int(sku),
+                "name": poster["name"],
+                "description": "A museum-quality giclee print on archival matte paper " * rng.randint(1, 2),
+                "price": poster["price_cents"] / 100,
+                "image": poster["image"],
+                "quantity": rng.randint(1, 3)
+            })
+
+        order = {
+            "order_id": "%08x-%04x-4%03x-a%03x-%012x" % (
+                rng.getrandbits(32), rng.getrandbits(16), rng.getrandbits(12), rng.getrandbits(12), rng.getrandbits(48)
+            ),
+            "job_id": "%032x" % rng.getrandbits(128),
+            "client_id": "client_%013x" % rng.getrandbits(52),
+            "status": rng.choice(["PROCESSING", "PROCESSING", "EXPIRED", "PAYMENT_COMPLETE", "ERROR"]),
+            "customer_email": f"customer{index}@example.com",
+            "amount": 580 + sum(int(item["price"] * 100) * item["quantity"] for item in cart),
+            "created_at": 1735689600 + index * 60,
+            "updated_at": 1735689600 + index * 60 + 30,
+            "expires_at": 1735689600 + index * 60 + 900,
+            "payment_intent_id": "pi_%024x" % rng.getrandbits(96),
+            "shipping_details": {
+                "shippingMethod": rng.choice(["BUDGET", "STANDARD", "EXPRESS", "PRIORITY"]),
+                "firstName": "Alexandra",
+                "lastName": "Montgomery-Smith",
+                "address1": f"{rng.randint(1, 9999)} North Longfellow Avenue",
+                "address2": rng.choice(["", "Apartment 12B", "Suite 400"]),
+                "city": "Salt Lake City",
+                "state": "UT",
+                "postalCode": "84101",
+                "country": "US",
+                "phone": "+1 801 555 0100"
+            }
+        }
+        if order["status"] == "ERROR":
+            order["error_message"] = prodigi_error_body(rng, len(cart))
+        yield order, cart
+
+
+def layouts(order, cart):
+    legacy = dict(order, items=json.dumps(cart))
+    native = dict(order, items=[
+        {"sku": str(item["id"]), "qty": item["quantity"], "cents": int(round(item["price"] * 100))}
+        for item in cart
+    ])
+    return legacy, native, order_store.pack_order(native)
+
+
+def summarize(name, sizes):
+    wcu = sum(math.ceil(size / 1024) for size in sizes)
+    rcu = sum(math.ceil(size / 4096) for size in sizes)
+    ordered = sorted(sizes)
+    p50 = ordered[len(ordered) // 2]
+    p99 = ordered[int(len(ordered) * 0.99)]
+    print(f"  {name:11} avg {sum(sizes) / len(sizes):7.0f} B  p50 {p50:6} B  p99 {p99:6} B  max {ordered[-1]:6} B  "
+          f"WCU {wcu:7}  RCU {rcu:6}")
+
+    edges = [0] + SIZE_BUCKETS + [float("inf")]
+    histogram = []
+    for low, high in zip(edges, edges[1:]):
+        count = sum(1 for size in sizes if low <= size < high)
+        label = f"<{high}" if high != float("inf") else f">={low}"
+        histogram.append(f"{label}:{count}")
+    print(f"  {'':11} {'  '.join(histogram)}")
+    return wcu, rcu
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Order item size and capacity unit report")
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--threshold", type=int, action="append",
+                        help="Compression threshold in bytes (repeatable); defaults to the configured one")
+    args = parser.parse_args()
+
+    orders = list(synthetic_orders(args.orders))
+    thresholds = args.threshold or [order_store.COMPRESSION_THRESHOLD]
+
+    for threshold in thresholds:
+        order_store.COMPRESSION_THRESHOLD = threshold
+        sized = [tuple(item_size(item) for item in layouts(order, cart)) for order, cart in orders]
+
+        print(f"{args.orders} synthetic orders, compression threshold {threshold} B")
+        legacy_wcu, legacy_rcu = summarize("legacy", [row[0] for row in sized])
+        native_wcu, native_rcu = summarize("native", [row[1] for row in sized])
+        packed_wcu, packed_rcu = summarize("compressed", [row[2] for row in sized])
+        print(f"  savings vs legacy: WCU {1 - packed_wcu / legacy_wcu:.1%}, RCU {1 - packed_rcu / legacy_rcu:.1%}; "
+              f"vs native: WCU {1 - packed_wcu / native_wcu:.1%}, RCU {1 - packed_rcu / native_rcu:.1%}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test for the checkout flow against the local stack.
+
+Each virtual user repeats the path a shopper's browser takes:
+
+    POST /checkout            create the order and PaymentIntent
+    (Stripe)                  confirm the PaymentIntent at the mock Stripe
+    POST /webhook             deliver the signed payment_intent.succeeded event
+    POST /payment-success     the frontend's confirmation call
+    GET  /payment-status      poll until the order reports success
+
+and the report gives p50/p95/p99 latency, error counts and throughput per
+endpoint. Stripe and Prodigi latency and error rates can be dialled up to see
+how the handlers behave when a dependency degrades. Against the local stack
+the orders' stage timestamps are summarised too (see stage_latency.py).
+
+With --drop-webhooks a fraction of the flows never deliver their webhook
+(as if the endpoint were down); the Stripe reconciler is then run against
+the mock Stripe and its counts reported, so the replayed orders show up as
+reaching fulfillment.
+
+The local stack never sends Prodigi callbacks, so every order Prodigi
+accepts stays in fulfillment. With --reconcile-prodigi the mock Prodigi
+completes them all and the Prodigi reconciler is run to catch up on those
+missed callbacks.
+
+Each virtual user calls from its own address (X-Forwarded-For, which the
+local stack passes on as the sourceIp the rate limiter keys on). With
+--abusive-clients that many extra threads poll /payment-status in a tight
+loop, like a stuck poll loop across many tabs; their requests are reported
+separately, so the real shoppers' latency can be compared with and without
+them.
+
+Usage:
+    python tools/loadtest.py --users 20 --iterations 10
+    python tools/loadtest.py --users 20 --duration 60 --stripe-latency 300 --prodigi-error-rate 0.05
+    python tools/loadtest.py --users 5 --iterations 4 --drop-webhooks 0.5
+    python tools/loadtest.py --users 5 --iterations 4 --reconcile-prodigi
+    python tools/loadtest.py --users 10 --iterations 5 --abusive-clients 20
+    python tools/loadtest.py --api-url https://xxxx.execute-api.us-west-2.amazonaws.com/prod ...
+"""
+import os
+import hmac
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+from collections import defaultdict
+
+import boto3
+import requests
+
+import backend_env  # noqa: F401
+from local_stack import LocalStack
+from stage_latency import print_stage_report, scan_orders, stage_report
+from mock_services import FaultProfile
+from catalog import POSTERS
+
+SHIPPING_METHODS = ["BUDGET", "STANDARD", "EXPRESS", "PRIORITY"]
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Recorder:
+    """Thread-safe latency and status collection per endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.status_codes = defaultdict(lambda: defaultdict(int))
+        self.flows = {"completed": 0, "failed": 0}
+        self.dropped_webhooks = 0
+        self.flow_latencies = []
+
+    def record(self, endpoint, elapsed_ms, status_code):
+        with self.lock:
+            self.samples[endpoint].append(elapsed_ms)
+            self.status_codes[endpoint][status_code] += 1
+            if status_code >= 400:
+                self.errors[endpoint] += 1
+
+    def dropped_webhook(self):
+        with self.lock:
+            self.dropped_webhooks += 1
+
+    def flow(self, ok, elapsed_ms):
+        with self.lock:
+            self.flows["completed" if ok else "failed"] += 1
+            if ok:
+                self.flow_latencies.append(elapsed_ms)
+
+    def summary(self, wall_seconds):
+        endpoints = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            ordered = sorted(samples)
+            endpoints[endpoint] = {
+                "requests": len(ordered),
+                "errors": self.errors[endpoint],
+                "status_codes": dict(self.status_codes[endpoint]),
+                "throughput_rps": round(len(ordered) / wall_seconds, 2),
+                "mean_ms": round(sum(ordered) / len(ordered), 2),
+                "p50_ms": round(percentile(ordered, 0.50), 2),
+                "p95_ms": round(percentile(ordered, 0.95), 2),
+                "p99_ms": round(percentile(ordered, 0.99), 2),
+                "max_ms": round(ordered[-1], 2)
+            }
+        flows = sorted(self.flow_latencies)
+        return {
+            "wall_seconds": round(wall_seconds, 2),
+            "flows": dict(self.flows, throughput_per_second=round(self.flows["completed"] / wall_seconds, 2),
+                          p50_ms=round(percentile(flows, 0.50), 2), p95_ms=round(percentile(flows, 0.95), 2),
+                          p99_ms=round(percentile(flows, 0.99), 2), dropped_webhooks=self.dropped_webhooks),
+            "endpoints": endpoints
+        }
+
+
+def sign_webhook(payload, secret, timestamp=None):
+    """Build a Stripe-Signature header the way Stripe signs webhook deliveries"""
+    timestamp = timestamp or int(time.time())
+    signature = hmac.new(secret.encode("utf-8"), f"{timestamp}.{payload}".encode("utf-8"), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def random_cart(rng):
+    cart = []
+    for sku in rng.sample(list(POSTERS), rng.choice([1, 1, 2, 3])):
+        poster = POSTERS[sku]
+        cart.append({
+            "id": int(sku),
+            "name": poster["name"],
+            "price": poster["price_cents"] / 100,
+            "image": poster["image"],
+            "quantity": rng.randint(1, 3)
+        })
+    return cart
+
+
+def random_shipping(rng, index):
+    return {
+        "shippingMethod": rng.choice(SHIPPING_METHODS),
+        "firstName": "Load",
+        "lastName": f"Tester{index}",
+        "address1": f"{rng.randint(1, 9999)} Main Street",
+        "address2": "",
+        "city": "Salt Lake City",
+        "state": "UT",
+        "postalCode": "84101",
+        "country": "US",
+        "phone": "+1 801 555 0100"
+    }
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, index, args, stack_urls, webhook_secret, recorder, stop_at):
+        super().__init__(daemon=True)
+        self.index = index
+        self.args = args
+        self.api_url, self.stripe_url = stack_urls
+        self.webhook_secret = webhook_secret
+        self.recorder = recorder
+        self.stop_at = stop_at
+        self.rng = random.Random(args.seed + index)
+        self.session = requests.Session()
+        self.session.headers["X-Forwarded-For"] = f"10.0.{index // 250}.{index % 250 + 1}"
+
+    def call(self, endpoint, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, timeout=self.args.request_timeout, **kwargs)
+            status_code = response.status_code
+        except requests.RequestException:
+            response, status_code = None, 599
+        self.recorder.record(endpoint, (time.perf_counter() - start) * 1000, status_code)
+        return response
+
+    def run_flow(self):
+        client_id = f"client_{uuid.uuid4().hex[:13]}"
+        response = self.call("POST /checkout", "POST", f"{self.api_url}/checkout", json={
+            "items": random_cart(self.rng),
+            "customerEmail": f"load{self.index}@example.com",
+            "clientId": client_id,
+            "shippingDetails": random_shipping(self.rng, self.index)
+        })
+        if response is None or response.status_code != 200:
+            return False
+        checkout = response.json()
+        intent_id = checkout["clientSecret"].split("_secret_")[0]
+
+        # The browser confirms the card with Stripe.js; Stripe then calls the webhook
+        response = self.call("Stripe confirm", "POST", f"{self.stripe_url}/v1/payment_intents/{intent_id}/confirm")
+        if response is None or response.status_code != 200:
+            return False
+        intent = dict(response.json())
+        intent.pop("latest_event", None)
+
+        if self.rng.random() < self.args.drop_webhooks:
+            # Stripe's delivery never arrives, and the shopper closes the page
+            self.recorder.dropped_webhook()
+            return True
+
+        payload = json.dumps({
+            "id": f"evt_{uuid.uuid4().hex[:24]}",
+            "object": "event",
+            "type": "payment_intent.succeeded",
+            "created": int(time.time()),
+            "data": {"object": intent}
+        })
+        response = self.call("POST /webhook", "POST", f"{self.api_url}/webhook", data=payload, headers={
+            "Content-Type": "application/json",
+            "Stripe-Signature": sign_webhook(payload, self.webhook_secret)
+        })
+        if response is None or response.status_code != 200:
+            return False
+
+        self.call("POST /payment-success", "POST", f"{self.api_url}/payment-success", json={
+            "orderId": checkout["orderId"],
+            "jobId": checkout["jobId"],
+            "clientId": client_id
+        })
+
+        for _ in range(self.args.max_polls):
+            response = self.call("GET /payment-status", "GET", f"{self.api_url}/payment-status",
+                                 params={"clientId": client_id})
+            if response is not None and response.status_code == 200 and response.json().get("success"):
+                return True
+            time.sleep(self.args.poll_interval)
+        return False
+
+    def run(self):
+        iteration = 0
+        while True:
+            if self.args.duration:
+                if time.monotonic() >= self.stop_at:
+                    break
+            elif iteration >= self.args.iterations:
+                break
+            iteration += 1
+
+            start = time.perf_counter()
+            ok = self.run_flow()
+            self.recorder.flow(ok, (time.perf_counter() - start) * 1000)
+            if self.args.think_time:
+                time.sleep(self.rng.uniform(0, self.args.think_time))
+
+
+class AbusiveClient(threading.Thread):
+    """Polls /payment-status back to back with one client ID until told to stop"""
+
+    def __init__(self, index, args, api_url, recorder, stop):
+        super().__init__(daemon=True)
+        self.args = args
+        self.api_url = api_url
+        self.recorder = recorder
+        self.stop = stop
+        self.client_id = f"client_stuck{index}"
+        self.session = requests.Session()
+        self.session.headers["X-Forwarded-For"] = f"10.1.{index // 250}.{index % 250 + 1}"
+
+    def run(self):
+        while not self.stop.is_set():
+            start = time.perf_counter()
+            try:
+                status_code = self.session.get(f"{self.api_url}/payment-status", params={"clientId": self.client_id},
+                                               timeout=self.args.request_timeout).status_code
+            except requests.RequestException:
+                status_code = 599
+            self.recorder.record("GET /payment-status (abusive)", (time.perf_counter() - start) * 1000, status_code)
+
+
+def print_report(summary):
+    flows = summary["flows"]
+    print(f"\n{flows['completed']} flows completed, {flows['failed']} failed in {summary['wall_seconds']}s "
+          f"({flows['throughput_per_second']}/s); flow p50 {flows['p50_ms']}ms p95 {flows['p95_ms']}ms "
+          f"p99 {flows['p99_ms']}ms\n")
+    print(f"{'endpoint':24} {'reqs':>6} {'errs':>5} {'rps':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for endpoint, stats in summary["endpoints"].items():
+        print(f"{endpoint:24} {stats['requests']:6} {stats['errors']:5} {stats['throughput_rps']:7} "
+              f"{stats['p50_ms']:8} {stats['p95_ms']:8} {stats['p99_ms']:8} {stats['max_ms']:8}")
+
+
+def run(args, api_url, stripe_url, webhook_secret):
+    recorder = Recorder()
+    stop_at = time.monotonic() + (args.duration or 0)
+    users = [
+        VirtualUser(index, args, (api_url, stripe_url), webhook_secret, recorder, stop_at)
+        for index in range(args.users)
+    ]
+
+    stop_abusers = threading.Event()
+    abusers = [AbusiveClient(index, args, api_url, recorder, stop_abusers) for index in range(args.abusive_clients)]
+    for abuser in abusers:
+        abuser.start()
+
+    start = time.perf_counter()
+    for user in users:
+        user.start()
+        if args.ramp_up:
+            time.sleep(args.ramp_up / args.users)
+    for user in users:
+        user.join()
+    stop_abusers.set()
+    return recorder.summary(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local end-to-end checkout load test")
+    parser.add_argument("--users", type=int, default=10, help="Concurrent virtual users")
+    parser.add_argument("--iterations", type=int, default=5, help="Flows per user (ignored with --duration)")
+    parser.add_argument("--duration", type=float, default=0, help="Run for this many seconds instead")
+    parser.add_argument("--ramp-up", type=float, default=0, help="Seconds over which to start the users")
+    parser.add_argument("--think-time", type=float, default=0, help="Max random pause between flows (s)")
+    parser.add_argument("--poll-interval", type=float, default=0.25)
+    parser.add_argument("--max-polls", type=int, default=40)
+    parser.add_argument("--request-timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--drop-webhooks", type=float, default=0,
+                        help="Fraction of flows whose webhook is never delivered (local stack: then reconciled)")
+    parser.add_argument("--abusive-clients", type=int, default=0,
+                        help="Extra threads polling /payment-status as fast as they can")
+    parser.add_argument("--reconcile-prodigi", action="store_true",
+                        help="Local stack: complete every Prodigi order, then run the Prodigi reconciler")
+
+    parser.add_argument("--stripe-latency", type=float, default=0, help="Mock Stripe latency (ms)")
+    parser.add_argument("--stripe-jitter", type=float, default=0, help="Mock Stripe extra random latency (ms)")
+    parser.add_argument("--stripe-error-rate", type=float, default=0, help="Fraction of Stripe calls failing")
+    parser.add_argument("--prodigi-latency", type=float, default=0, help="Mock Prodigi latency (ms)")
+    parser.add_argument("--prodigi-jitter", type=float, default=0, help="Mock Prodigi extra random latency (ms)")
+    parser.add_argument("--prodigi-error-rate", type=float, default=0, help="Fraction of Prodigi calls failing")
+    parser.add_argument("--dynamodb-latency", type=float, default=0, help="Added latency per DynamoDB call (ms)")
+
+    parser.add_argument("--api-url", help="Test a deployed API instead of the local stack "
+                                          "(needs --stripe-url and --webhook-secret)")
+    parser.add_argument("--stripe-url")
+    parser.add_argument("--webhook-secret")
+    parser.add_argument("--output", help="Write the summary as JSON to this file")
+    parser.add_argument("--profile-dir", help="Write sampled handler profiles here (see tools/profiles.py)")
+    parser.add_argument("--profile-rate", type=float, default=1.0, help="Fraction of invocations profiled")
+    parser.add_argument("--shared-cache", help="SHARED_CACHE_URL for the local handlers: memory or redis://...")
+    parser.add_argument("--metrics-out", help="Append the handlers' EMF records (JSON lines) to this file")
+    args = parser.parse_args()
+
+    if args.api_url:
+        summary = run(args, args.api_url.rstrip("/"), args.stripe_url, args.webhook_secret)
+    else:
+        if args.reconcile_prodigi:
+            # Every order is overdue as far as the reconciler is concerned
+            os.environ["RECONCILE_MIN_AGE_SECONDS"] = "0"
+        if args.drop_webhooks:
+            # Likewise every dropped payment
+            os.environ["STRIPE_RECONCILE_MIN_AGE_SECONDS"] = "0"
+        stack = LocalStack(
+            stripe_faults=FaultProfile(args.stripe_latency, args.stripe_jitter, args.stripe_error_rate, args.seed),
+            prodigi_faults=FaultProfile(args.prodigi_latency, args.prodigi_jitter, args.prodigi_error_rate, args.seed),
+            dynamodb_latency_ms=args.dynamodb_latency,
+            metrics_path=args.metrics_out,
+            profile_dir=args.profile_dir,
+            profile_rate=args.profile_rate,
+            shared_cache=args.shared_cache
+        )
+        with stack:
+            summary = run(args, stack.api_url, stack.stripe.url, stack.WEBHOOK_SECRET)
+            stack.drain()
+            if args.drop_webhooks:
+                summary["reconciled"] = stack.invoke("SteepleCo-StripeReconciler")
+                stack.drain()
+            if args.reconcile_prodigi:
+                stack.prodigi.complete_after = 0
+                summary["prodigi_reconciled"] = stack.invoke("SteepleCo-ProdigiReconciler")
+            summary["mocks"] = {
+                "stripe_requests": stack.stripe.request_count,
+                "prodigi_requests": stack.prodigi.request_count,
+                "prodigi_orders": len(stack.prodigi.orders),
+                "prodigi_duplicate_submissions": stack.prodigi.duplicate_submissions,
+                "stream_records_delivered": stack.pump.delivered if stack.pump else None,
+                "stream_records_failed": stack.pump.failed if stack.pump else None
+            }
+            summary["stages"] = stage_report(scan_orders(boto3.resource("dynamodb").Table("SteepleCo-Orders"), 0))
+
+    print_report(summary)
+    if "mocks" in summary:
+        print("\n" + "  ".join(f"{name}={value}" for name, value in summary["mocks"].items()))
+    if "reconciled" in summary:
+        print(f"webhooks dropped={summary['flows']['dropped_webhooks']}  reconciler: "
+              + "  ".join(f"{name}={value}" for name, value in summary["reconciled"].items()))
+    if "prodigi_reconciled" in summary:
+        print("prodigi reconciler: "
+              + "  ".join(f"{name}={value}" for name, value in summary["prodigi_reconciled"].items()))
+    if summary.get("stages"):
+        print()
+        print_stage_report(summary["stages"])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"\nWrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,503 @@
+"""
+Runs the backend handlers locally the way BackendStack wires them in AWS.
+
+- AWS services (DynamoDB, DynamoDB Streams, SES, S3) are moto's in-memory
+  backends, or any endpoint given through AWS_ENDPOINT_URL (e.g. DynamoDB
+  Local).
+- Stripe and Prodigi calls go to the mock servers in mock_services.py.
+- A threaded HTTP server turns requests into API Gateway proxy events for
+  the same routes the stack defines.
+- A stream pump delivers DynamoDB stream records to the stream consumers,
+  applying the same filters as their event sources in the stack, and
+  redelivers the records a consumer reports as failed.
+
+Keep TABLES, ROUTES, FUNCTIONS and STREAM_CONSUMERS in step with
+infrastructure/backend_stack.py.
+"""
+import os
+import json
+import time
+import uuid
+import base64
+import logging
+import importlib
+import threading
+from urllib.parse import urlparse, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import backend_env  # noqa: F401
+
+logger = logging.getLogger("local_stack")
+
+TABLES = [
+    {
+        "TableName": "SteepleCo-Orders",
+        "KeySchema": [{"AttributeName": "order_id", "KeyType": "HASH"}],
+        "AttributeDefinitions": [
+            {"AttributeName": "order_id", "AttributeType": "S"},
+            {"AttributeName": "fulfillment_shard", "AttributeType": "N"},
+            {"AttributeName": "in_fulfillment_since", "AttributeType": "N"},
+            {"AttributeName": "status", "AttributeType": "S"},
+            {"AttributeName": "updated_at", "AttributeType": "N"}
+        ],
+        "GlobalSecondaryIndexes": [{
+            "IndexName": "InFulfillment",
+            "KeySchema": [
+                {"AttributeName": "fulfillment_shard", "KeyType": "HASH"},
+                {"AttributeName": "in_fulfillment_since", "KeyType": "RANGE"}
+            ],
+            "Projection": {
+                "ProjectionType": "INCLUDE",
+                "NonKeyAttributes": ["prodigi_order_id", "shipping_status"]
+            }
+        }, {
+            "IndexName": "ByStatus",
+            "KeySchema": [
+                {"AttributeName": "status", "KeyType": "HASH"},
+                {"AttributeName": "updated_at", "KeyType": "RANGE"}
+            ],
+            "Projection": {
+                "ProjectionType": "INCLUDE",
+                "NonKeyAttributes": ["error_message", "prodigi_order_id"]
+            }
+        }],
+        "StreamSpecification": {"StreamEnabled": True, "StreamViewType": "NEW_AND_OLD_IMAGES"}
+    },
+    {
+        "TableName": "SteepleCo-StatusEvents",
+        "KeySchema": [
+            {"AttributeName": "client_id", "KeyType": "HASH"},
+            {"AttributeName": "event_time", "KeyType": "RANGE"}
+        ],
+        "AttributeDefinitions": [
+            {"AttributeName": "client_id", "AttributeType": "S"},
+            {"AttributeName": "event_time", "AttributeType": "N"}
+        ]
+    },
+    {
+        "TableName": "SteepleCo-RateLimits",
+        "KeySchema": [{"AttributeName": "bucket_key", "KeyType": "HASH"}],
+        "AttributeDefinitions": [{"AttributeName": "bucket_key", "AttributeType": "S"}]
+    },
+    {
+        "TableName": "SteepleCo-Stock",
+        "KeySchema": [
+            {"AttributeName": "sku", "KeyType": "HASH"},
+            {"AttributeName": "shard", "KeyType": "RANGE"}
+        ],
+        "AttributeDefinitions": [
+            {"AttributeName": "sku", "AttributeType": "S"},
+            {"AttributeName": "shard", "AttributeType": "N"}
+        ]
+    },
+    {
+        "TableName": "SteepleCo-Checkpoints",
+        "KeySchema": [{"AttributeName": "job", "KeyType": "HASH"}],
+        "AttributeDefinitions": [{"AttributeName": "job", "AttributeType": "S"}]
+    },
+    {
+        "TableName": "SteepleCo-SalesAggregates",
+        "KeySchema": [
+            {"AttributeName": "aggregate_key", "KeyType": "HASH"},
+            {"AttributeName": "shard", "KeyType": "RANGE"}
+        ],
+        "AttributeDefinitions": [
+            {"AttributeName": "aggregate_key", "AttributeType": "S"},
+            {"AttributeName": "shard", "AttributeType": "N"}
+        ]
+    }
+]
+
+# (method, path) -> (handler module, Lambda timeout in seconds)
+ROUTES = {
+    ("POST", "/checkout"): ("checkout_session", 10),
+    ("POST", "/webhook"): ("stripe_webhook", 30),
+    ("GET", "/stripe-test"): ("stripe_test", 10),
+    ("POST", "/prodigi-webhook"): ("prodigi_webhook", 10),
+    ("GET", "/order-status"): ("order_status", 10),
+    ("GET", "/sales-report"): ("sales_report", 10),
+    ("POST", "/payment-success"): ("payment_success", 20),
+    ("GET", "/payment-status"): ("payment_status", 10)
+}
+
+# Function name -> (handler module, Lambda timeout in seconds)
+FUNCTIONS = {
+    "SteepleCo-ProdigiOrder": ("prodigi_order", 30),
+    "SteepleCo-OrderCleanup": ("order_cleanup", 300),
+    "SteepleCo-OrderArchive": ("order_archive", 300),
+    "SteepleCo-StripeReconciler": ("stripe_reconciler", 300),
+    "SteepleCo-ProdigiReconciler": ("prodigi_reconciler", 300)
+}
+
+
+def payment_transition(record):
+    """The stack's filter for consumers of orders becoming PAYMENT_COMPLETE"""
+    images = record.get("dynamodb", {})
+    return (record.get("eventName") == "MODIFY"
+            and images.get("NewImage", {}).get("status", {}).get("S") == "PAYMENT_COMPLETE"
+            and images.get("OldImage", {}).get("status", {}).get("S") != "PAYMENT_COMPLETE")
+
+
+# (table, handler module, record filter) for each stream subscription
+STREAM_CONSUMERS = [
+    ("SteepleCo-Orders", "sales_aggregator", payment_transition),
+    ("SteepleCo-Orders", "order_fulfillment", payment_transition),
+    ("SteepleCo-Orders", "order_notifications", payment_transition)
+]
+
+# Attempts per record, as retry_attempts on the stack's event sources
+STREAM_RETRIES = 5
+
+
+class LambdaContext:
+    """The parts of the Lambda context object the handlers use"""
+
+    def __init__(self, function_name, timeout_seconds):
+        self.function_name = function_name
+        self.function_version = "$LATEST"
+        self.invoked_function_arn = f"arn:aws:lambda:us-west-2:000000000000:function:{function_name}"
+        self.memory_limit_in_mb = 128
+        self.aws_request_id = str(uuid.uuid4())
+        self.log_group_name = f"/aws/lambda/{function_name}"
+        self.log_stream_name = "local"
+        self._deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+def function_name_for(module_name):
+    return "SteepleCo-" + "".join(part.capitalize() for part in module_name.split("_"))
+
+
+def invoke_handler(module_name, event, timeout_seconds):
+    module = importlib.import_module(module_name)
+    context = LambdaContext(function_name_for(module_name), timeout_seconds)
+    return module.handler(event, context)
+
+
+def api_gateway_event(method, path, query, headers, body, source_ip):
+    """Build the REST API proxy event API Gateway sends to a LambdaIntegration"""
+    is_base64 = False
+    if body is not None:
+        try:
+            body = body.decode("utf-8")
+        except UnicodeDecodeError:
+            body = base64.b64encode(body).decode("ascii")
+            is_base64 = True
+
+    return {
+        "resource": path,
+        "path": path,
+        "httpMethod": method,
+        "headers": headers,
+        "multiValueHeaders": {name: [value] for name, value in headers.items()},
+        "queryStringParameters": dict(query) or None,
+        "multiValueQueryStringParameters": {name: [value] for name, value in query} or None,
+        "pathParameters": None,
+        "stageVariables": None,
+        "requestContext": {
+            "resourcePath": path,
+            "httpMethod": method,
+            "path": f"/prod{path}",
+            "stage": "prod",
+            "requestId": str(uuid.uuid4()),
+            "requestTimeEpoch": int(time.time() * 1000),
+            "identity": {"sourceIp": source_ip, "userAgent": headers.get("User-Agent")}
+        },
+        "body": body,
+        "isBase64Encoded": is_base64
+    }
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self, method):
+        parsed = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        route = ROUTES.get((method, parsed.path))
+
+        if route is None and method == "OPTIONS":
+            route = next((r for (m, p), r in ROUTES.items() if p == parsed.path), None)
+
+        if route is None:
+            result = {"statusCode": 403, "body": json.dumps({"message": "Missing Authentication Token"})}
+        else:
+            # Load generators name the address each virtual user stands for,
+            # which API Gateway would see as the caller's sourceIp
+            source_ip = self.headers.get("X-Forwarded-For", self.client_address[0]).split(",")[0].strip()
+            event = api_gateway_event(
+                method, parsed.path, parse_qsl(parsed.query), dict(self.headers.items()), body, source_ip
+            )
+            try:
+                result = invoke_handler(route[0], event, route[1])
+            except Exception as e:
+                logger.exception(f"Unhandled error in {route[0]}")
+                result = {"statusCode": 502, "body": json.dumps({"message": f"Internal server error: {e}"})}
+
+        data = (result.get("body") or "").encode("utf-8")
+        self.send_response(int(result.get("statusCode", 200)))
+        for name, value in (result.get("headers") or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_OPTIONS(self):
+        self._handle("OPTIONS")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StreamPump:
+    """
+    Polls DynamoDB Streams and delivers batches to stream consumers, each
+    consumer on its own thread as each is its own event source mapping
+    """
+
+    def __init__(self, interval=0.1):
+        import boto3
+        self.dynamodb = boto3.client("dynamodb")
+        self.streams = boto3.client("dynamodbstreams")
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.delivered = 0
+        self.failed = 0
+        # Consumers that found records on their last poll
+        self.busy = set()
+
+    def _iterators(self, table_name):
+        stream_arn = self.dynamodb.describe_table(TableName=table_name)["Table"]["LatestStreamArn"]
+        shards = self.streams.describe_stream(StreamArn=stream_arn)["StreamDescription"]["Shards"]
+        return [
+            self.streams.get_shard_iterator(
+                StreamArn=stream_arn, ShardId=shard["ShardId"], ShardIteratorType="LATEST"
+            )["ShardIterator"]
+            for shard in shards
+        ]
+
+    def _deliver(self, module_name, records):
+        """Invoke the consumer, redelivering the records it reports as failed"""
+        for attempt in range(STREAM_RETRIES):
+            try:
+                result = invoke_handler(module_name, {"Records": records}, 30) or {}
+                failed = {failure["itemIdentifier"] for failure in result.get("batchItemFailures", [])}
+            except Exception:
+                logger.exception(f"Stream consumer {module_name} failed")
+                failed = {record["dynamodb"]["SequenceNumber"] for record in records}
+            with self.lock:
+                self.delivered += len(records) - len(failed)
+            records = [record for record in records if record["dynamodb"]["SequenceNumber"] in failed]
+            if not records:
+                return
+        logger.error(f"Stream consumer {module_name} gave up on {len(records)} records")
+        with self.lock:
+            self.failed += len(records)
+
+    def _run(self, table_name, module_name, record_filter):
+        iterators = self._iterators(table_name)
+        while not self.stopped.is_set():
+            found = False
+            for index, iterator in enumerate(iterators):
+                response = self.streams.get_records(ShardIterator=iterator, Limit=100)
+                iterators[index] = response.get("NextShardIterator", iterator)
+                if not response.get("Records"):
+                    continue
+                found = True
+                with self.lock:
+                    self.busy.add(module_name)
+                records = [record for record in response["Records"] if record_filter(record)]
+                for record in records:
+                    # boto3 parses it into a datetime; Lambda events carry epoch seconds
+                    created = record["dynamodb"].get("ApproximateCreationDateTime")
+                    if hasattr(created, "timestamp"):
+                        record["dynamodb"]["ApproximateCreationDateTime"] = created.timestamp()
+                if records:
+                    self._deliver(module_name, records)
+            if not found:
+                with self.lock:
+                    self.busy.discard(module_name)
+                self.stopped.wait(self.interval)
+
+    def start(self):
+        for table_name, module_name, record_filter in STREAM_CONSUMERS:
+            thread = threading.Thread(target=self._run, args=(table_name, module_name, record_filter), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def drain(self, timeout=30):
+        """Wait until every consumer has polled its stream empty twice in a row"""
+        deadline = time.monotonic() + timeout
+        quiet = 0
+        while quiet < 2 and time.monotonic() < deadline:
+            time.sleep(self.interval * 2)
+            with self.lock:
+                quiet = quiet + 1 if not self.busy else 0
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join(timeout=5)
+
+
+class LocalStack:
+    """
+    Wires everything together. Use as a context manager:
+
+        with LocalStack(stripe_faults=FaultProfile(latency_ms=80)) as stack:
+            requests.post(stack.api_url + "/checkout", json=...)
+    """
+
+    WEBHOOK_SECRET = "whsec_local_load_test"
+
+    def __init__(self, stripe_faults=None, prodigi_faults=None, dynamodb_latency_ms=0.0, archive_dir=None,
+                 metrics_path=None, profile_dir=None, profile_rate=1.0, shared_cache=None):
+        from mock_services import MockProdigi, MockStripe
+        self.stripe = MockStripe(stripe_faults)
+        self.prodigi = MockProdigi(prodigi_faults)
+        self.dynamodb_latency_ms = dynamodb_latency_ms
+        self.archive_dir = archive_dir
+        self.metrics_path = metrics_path
+        self.profile_dir = profile_dir
+        self.profile_rate = profile_rate
+        self.shared_cache = shared_cache
+        self.metrics_file = None
+        self.metrics_lock = threading.Lock()
+        self.api = None
+        self.pump = None
+        self._mock = None
+
+    @property
+    def api_url(self):
+        host, port = self.api.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _environment(self):
+        env = {
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "AWS_DEFAULT_REGION": "us-west-2",
+            "ORDERS_TABLE": "SteepleCo-Orders",
+            "STATUS_EVENTS_TABLE": "SteepleCo-StatusEvents",
+            "AGGREGATES_TABLE": "SteepleCo-SalesAggregates",
+            "CHECKPOINTS_TABLE": "SteepleCo-Checkpoints",
+            "RATE_LIMITS_TABLE": "SteepleCo-RateLimits",
+            "STOCK_TABLE": "SteepleCo-Stock",
+            "STRIPE_SECRET_KEY": "sk_test_local",
+            "STRIPE_WEBHOOK_SECRET": self.WEBHOOK_SECRET,
+            "PRODIGI_SANDBOX_API_KEY": "prodigi_local",
+            "PRODIGI_API_URL": f"{self.prodigi.url}/v4.0",
+            "SES_SENDER_EMAIL": "hello@hansenhome.ai",
+            # Attribute DynamoDB capacity to handler lines in the EMF records
+            "TRACING_CALL_SITES": "true"
+        }
+        if self.archive_dir:
+            env["ARCHIVE_DIR"] = self.archive_dir
+        if self.profile_dir:
+            env["PROFILE_DIR"] = self.profile_dir
+            env["PROFILE_SAMPLE_RATE"] = str(self.profile_rate)
+        if self.shared_cache:
+            # "memory" shares one dict between all handlers, as Redis would between containers
+            env["SHARED_CACHE_URL"] = self.shared_cache
+        # Handler logs go to stderr here; keep them to warnings unless asked
+        env["LOG_LEVEL"] = os.environ.get("LOG_LEVEL", "WARNING")
+        return env
+
+    def _add_dynamodb_latency(self):
+        import boto3
+
+        def delay(**kwargs):
+            time.sleep(self.dynamodb_latency_ms / 1000.0)
+
+        boto3.DEFAULT_SESSION or boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register("before-send.dynamodb", delay)
+
+    def _write_metrics(self, line):
+        """EMF records from every invocation go to metrics_path (or are dropped)"""
+        if self.metrics_path:
+            with self.metrics_lock:
+                if self.metrics_file is None:
+                    self.metrics_file = open(self.metrics_path, "a")
+                self.metrics_file.write(line + "\n")
+
+    def start(self):
+        self.stripe.start()
+        self.prodigi.start()
+        os.environ.update(self._environment())
+
+        if not os.environ.get("AWS_ENDPOINT_URL"):
+            from moto import mock_aws
+            self._mock = mock_aws()
+            self._mock.start()
+
+        import boto3
+        dynamodb = boto3.client("dynamodb")
+        existing = set(dynamodb.list_tables()["TableNames"])
+        for table in TABLES:
+            if table["TableName"] not in existing:
+                dynamodb.create_table(BillingMode="PAY_PER_REQUEST", **table)
+        boto3.client("ses").verify_email_identity(EmailAddress=os.environ["SES_SENDER_EMAIL"])
+
+        if self.dynamodb_latency_ms:
+            self._add_dynamodb_latency()
+
+        # Import every handler now, as a warm container would have
+        import stripe
+        import tracing
+        tracing.set_sink(self._write_metrics)
+        for module_name, _ in list(ROUTES.values()) + list(FUNCTIONS.values()):
+            importlib.import_module(module_name)
+        for _, module_name, _ in STREAM_CONSUMERS:
+            importlib.import_module(module_name)
+        stripe.api_base = self.stripe.url
+
+        self.api = ThreadingHTTPServer(("127.0.0.1", 0), _ApiHandler)
+        self.api.daemon_threads = True
+        threading.Thread(target=self.api.serve_forever, daemon=True).start()
+
+        if not os.environ.get("AWS_ENDPOINT_URL"):
+            self.pump = StreamPump().start()
+        return self
+
+    def invoke(self, function_name, event=None):
+        """Run a function that isn't behind the API (a scheduled job, say) and return its result"""
+        module_name, timeout = FUNCTIONS[function_name]
+        return invoke_handler(module_name, event or {}, timeout)
+
+    def drain(self, timeout=30):
+        """Wait until the stream consumers have caught up"""
+        if self.pump:
+            self.pump.drain(timeout)
+
+    def stop(self):
+        if self.pump:
+            self.pump.drain()
+            self.pump.stop()
+        if self.api:
+            self.api.shutdown()
+            self.api.server_close()
+        self.stripe.stop()
+        self.prodigi.stop()
+        if self._mock:
+            self._mock.stop()
+        if self.metrics_file:
+            self.metrics_file.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
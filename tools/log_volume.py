@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+CPU time and CloudWatch Logs volume per handler invocation.
+
+Runs each handler repeatedly with realistic API Gateway / invoke events and
+the AWS, Stripe and Prodigi clients replaced by the in-memory fakes from
+microbench.py. Log records go through a root handler formatted like the
+Lambda Python runtime's, into a byte counter, so the numbers are what
+CloudWatch Logs would ingest (and bill) per invocation. EMF records from
+tracing are counted separately.
+
+Usage:
+    python tools/log_volume.py --invocations 500 --save /tmp/logs-before.json
+    python tools/log_volume.py --invocations 500 --compare /tmp/logs-before.json
+    LOG_LEVEL=DEBUG python tools/log_volume.py
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import contextvars
+from types import SimpleNamespace
+
+from microbench import FakeTable, FakeClient, FakeHttpResponse, sample_order, webhook_payload, stream_event, sign
+from local_stack import LambdaContext, api_gateway_event
+from catalog import POSTERS
+import tracing
+
+SCENARIOS = []
+
+
+def scenario(name):
+    def register(setup):
+        SCENARIOS.append((name, setup))
+        return setup
+    return register
+
+
+class ByteCounter:
+    """A write-only stream that only counts what CloudWatch would receive"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.lines = 0
+
+    def write(self, text):
+        self.bytes += len(text.encode("utf-8"))
+        self.lines += text.count("\n")
+
+    def flush(self):
+        pass
+
+
+def lambda_runtime_handler(stream):
+    """The handler the Lambda Python runtime puts on the root logger"""
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(
+        "[%(levelname)s]\t%(asctime)s.%(msecs)03dZ\t00000000-0000-0000-0000-000000000000\t%(message)s\n",
+        "%Y-%m-%dT%H:%M:%S"
+    ))
+    return handler
+
+
+def http_event(method, path, query=None, body=None, headers=None):
+    headers = dict({
+        "Accept": "*/*",
+        "Content-Type": "application/json",
+        "Host": "abc123.execute-api.us-west-2.amazonaws.com",
+        "Origin": "https://hansenhomeai.github.io",
+        "Referer": "https://hansenhomeai.github.io/",
+        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 Safari/605.1.15",
+        "X-Forwarded-For": "203.0.113.10",
+        "X-Forwarded-Proto": "https"
+    }, **(headers or {}))
+    raw = body.encode("utf-8") if isinstance(body, str) else body
+    return api_gateway_event(method, path, list((query or {}).items()), headers, raw, "203.0.113.10")
+
+
+@scenario("checkout_session")
+def run_checkout():
+    import checkout_session
+    checkout_session.orders_table = FakeTable()
+    intent = SimpleNamespace(id="pi_3PqRsTuVwXyZ0123456789ab",
+                             client_secret="pi_3PqRsTuVwXyZ0123456789ab_secret_AbCdEfGhIjKlMnOp")
+    checkout_session.stripe.PaymentIntent.create = lambda **kwargs: intent
+    order = sample_order()
+    cart = [
+        {"id": int(sku), "name": poster["name"], "price": poster["price_cents"] / 100,
+         "image": poster["image"], "quantity": 1}
+        for sku, poster in list(POSTERS.items())[:3]
+    ]
+    event = http_event("POST", "/checkout", body=json.dumps({
+        "items": cart,
+        "customerEmail": order["customer_email"],
+        "clientId": order["client_id"],
+        "shippingDetails": order["shipping_details"]
+    }))
+    return event
+
+
+@scenario("stripe_webhook")
+def run_webhook():
+    import stripe_webhook
+    import status_events
+    # Awaiting the payment, so the event is applied rather than acknowledged
+    order = dict(sample_order(), status="PENDING")
+    stripe_webhook.table = FakeTable([order])
+    status_events.status_events_table = FakeTable()
+    payload = webhook_payload(order)
+    return http_event("POST", "/webhook", body=payload, headers={
+        "Stripe-Signature": sign(payload, os.environ["STRIPE_WEBHOOK_SECRET"]),
+        "User-Agent": "Stripe/1.0 (+https://stripe.com/docs/webhooks)"
+    })
+
+
+@scenario("prodigi_order")
+def run_prodigi_order():
+    import prodigi_order
+    order = sample_order()
+    prodigi_order.table = FakeTable([order])
+    created = FakeHttpResponse(200, {
+        "outcome": "Created",
+        "order": {"id": "ord_840241", "status": {"stage": "InProgress"}, "charges": [], "shipments": []}
+    })
+    prodigi_order.http.post = lambda url, **kwargs: created
+    intent = json.loads(webhook_payload(order))["data"]["object"]
+    return json.loads(json.dumps({"order_id": order["order_id"], "order_data": order, "payment_intent": intent},
+                                 default=str))
+
+
+@scenario("order_fulfillment")
+def run_order_fulfillment():
+    import prodigi_order
+    import order_fulfillment
+    order = sample_order()
+    order_fulfillment.table = prodigi_order.table = FakeTable([order])
+    created = FakeHttpResponse(200, {
+        "outcome": "Created",
+        "order": {"id": "ord_840241", "status": {"stage": "InProgress"}, "charges": [], "shipments": []}
+    })
+    prodigi_order.http.post = lambda url, **kwargs: created
+    return stream_event(order)
+
+
+@scenario("order_notifications")
+def run_order_notifications():
+    import order_notifications
+    order = sample_order()
+    order_notifications.table = FakeTable([order])
+    order_notifications.ses_client = FakeClient(send_email={"MessageId": "0100018f-bench"})
+    return stream_event(order)
+
+
+@scenario("payment_status")
+def run_payment_status():
+    import payment_status  # noqa: F401
+    import status_events
+    order = sample_order()
+
+    class EventsTable(FakeTable):
+        def query(self, **kwargs):
+            return {"Items": [{"client_id": order["client_id"], "order_id": order["order_id"],
+                               "status": "PAYMENT_COMPLETE", "timestamp": 1735689630}]}
+
+    status_events.status_events_table = EventsTable()
+    return http_event("GET", "/payment-status", query={"clientId": order["client_id"]})
+
+
+@scenario("order_status")
+def run_order_status():
+    import order_status
+    order = sample_order()
+    order_status.table = FakeTable([order])
+    return http_event("GET", "/order-status", query={"orderId": order["order_id"]})
+
+
+def measure(name, event, invocations, log_stream, emf_stream):
+    handler = sys.modules[name].handler
+    handler(event, LambdaContext(name, 30))  # cold start, not measured
+
+    log_before, lines_before, emf_before = log_stream.bytes, log_stream.lines, emf_stream.bytes
+    cpu_start = time.process_time()
+    for _ in range(invocations):
+        handler(event, LambdaContext(name, 30))
+    cpu = time.process_time() - cpu_start
+
+    return {
+        "invocations": invocations,
+        "cpu_us_per_invocation": round(cpu / invocations * 1e6, 1),
+        "log_bytes_per_invocation": round((log_stream.bytes - log_before) / invocations, 1),
+        "log_lines_per_invocation": round((log_stream.lines - lines_before) / invocations, 2),
+        "emf_bytes_per_invocation": round((emf_stream.bytes - emf_before) / invocations, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-invocation CPU time and log volume")
+    parser.add_argument("--invocations", type=int, default=300)
+    parser.add_argument("--save", help="Write results as JSON to this path")
+    parser.add_argument("--compare", help="Compare against a JSON file written by --save")
+    args = parser.parse_args()
+
+    log_stream = ByteCounter()
+    emf_stream = ByteCounter()
+    logging.getLogger().handlers = [lambda_runtime_handler(log_stream)]
+    tracing.set_sink(lambda line: emf_stream.write(line + "\n"))
+
+    results = {}
+    for name, setup in SCENARIOS:
+        results[name] = contextvars.Context().run(
+            lambda: measure(name, setup(), args.invocations, log_stream, emf_stream)
+        )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["handlers"]
+
+    print(f"LOG_LEVEL={os.environ.get('LOG_LEVEL', '(unset)')}")
+    print(f"{'handler':20} {'cpu us':>9} {'log bytes':>10} {'lines':>6} {'emf bytes':>10}")
+    for name, stats in results.items():
+        print(f"{name:20} {stats['cpu_us_per_invocation']:>9} {stats['log_bytes_per_invocation']:>10} "
+              f"{stats['log_lines_per_invocation']:>6} {stats['emf_bytes_per_invocation']:>10}")
+        before = (baseline or {}).get(name)
+        if before:
+            print(f"{'  vs baseline':20} {stats['cpu_us_per_invocation'] / before['cpu_us_per_invocation'] - 1:>+9.0%} "
+                  f"{stats['log_bytes_per_invocation'] / max(before['log_bytes_per_invocation'], 1) - 1:>+10.0%}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"log_level": os.environ.get("LOG_LEVEL"), "handlers": results}, f, indent=2)
+        print(f"\nSaved {args.save}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the handlers' hot paths.
+
+Each benchmark calls real backend code with its AWS, Stripe and Prodigi
+clients swapped for in-memory fakes, so the numbers measure our own
+Python (payload building, JSON encoding, signature checks, logging) rather
+than the network. Logging goes through a handler writing to a null stream,
+like the Lambda runtime's, so log formatting is part of the cost.
+
+Timings are taken in rounds: each round runs the benchmark enough times to
+last at least --min-time seconds, and the statistics are computed over the
+per-call time of each round.
+
+Usage:
+    python tools/microbench.py                          # run everything
+    python tools/microbench.py -k webhook -k decimal    # name filter
+    python tools/microbench.py --save tools/benchmarks/main.json
+    python tools/microbench.py --compare tools/benchmarks/main.json --max-regression 0.10
+
+With --compare the exit status is 1 when any benchmark's median is more than
+--max-regression slower than the baseline, so it can gate a deploy.
+"""
+import os
+import gc
+import sys
+import json
+import time
+import hmac
+import copy
+import hashlib
+import logging
+import platform
+import contextvars
+import argparse
+import statistics
+import subprocess
+from decimal import Decimal
+
+import backend_env  # noqa: F401
+
+os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_bench")
+os.environ.setdefault("STRIPE_WEBHOOK_SECRET", "whsec_bench")
+os.environ.setdefault("PRODIGI_SANDBOX_API_KEY", "prodigi_bench")
+
+import stripe  # noqa: E402
+import tracing  # noqa: E402
+
+BENCHMARKS = []
+
+
+def benchmark(name, group):
+    """Register a setup function; it returns the zero-argument callable to time"""
+    def register(setup):
+        BENCHMARKS.append((name, group, setup))
+        return setup
+    return register
+
+
+class FakeTable:
+    """In-memory stand-in for a boto3 DynamoDB Table"""
+
+    def __init__(self, items=None):
+        self.items = {item["order_id"]: item for item in (items or [])}
+
+    def get_item(self, Key, **kwargs):
+        item = self.items.get(Key["order_id"])
+        return {"Item": copy.deepcopy(item)} if item else {}
+
+    def put_item(self, Item, **kwargs):
+        return {}
+
+    def update_item(self, Key, **kwargs):
+        return {"Attributes": copy.deepcopy(self.items.get(Key.get("order_id"), {}))}
+
+    def query(self, **kwargs):
+        return {"Items": [], "Count": 0}
+
+
+class FakeClient:
+    """Accepts any boto3 client call and returns a canned response"""
+
+    def __init__(self, **responses):
+        self.responses = responses
+
+    def __getattr__(self, name):
+        response = self.responses.get(name, {})
+        return lambda **kwargs: response
+
+
+class FakeHttpResponse:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self._payload = payload
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def sample_order(order_id="0f8fad5b-d9cb-469f-a165-70867728950e", line_count=3):
+    """An order as a DynamoDB read returns it: numbers are Decimal"""
+    return {
+        "order_id": order_id,
+        "job_id": "9b2c5e1a4f0d4c7e8a3b6d2f1e0c9a8b",
+        "client_id": "client_18f2a3b4c5d6e",
+        "status": "PAYMENT_COMPLETE",
+        "customer_email": "alexandra@example.com",
+        "amount": Decimal("1730"),
+        "items": [
+            {"sku": str(sku), "qty": Decimal(qty), "cents": Decimal("50")}
+            for sku, qty in zip(range(1, line_count + 1), [2, 1, 3, 1, 2])
+        ],
+        "created_at": Decimal("1735689600"),
+        "updated_at": Decimal("1735689630"),
+        "expires_at": Decimal("1735690500"),
+        "payment_intent_id": "pi_3PqRsTuVwXyZ0123456789ab",
+        "shipping_details": {
+            "shippingMethod": "EXPRESS",
+            "firstName": "Alexandra",
+            "lastName": "Montgomery-Smith",
+            "address1": "1234 North Longfellow Avenue",
+            "address2": "Apartment 12B",
+            "city": "Salt Lake City",
+            "state": "UT",
+            "postalCode": "84101",
+            "country": "US",
+            "phone": "+1 801 555 0100"
+        }
+    }
+
+
+def webhook_payload(order):
+    return json.dumps({
+        "id": "evt_1PqRsTuVwXyZ0123456789ab",
+        "object": "event",
+        "api_version": "2025-03-31.basil",
+        "created": 1735689630,
+        "livemode": False,
+        "type": "payment_intent.succeeded",
+        "data": {"object": {
+            "id": order["payment_intent_id"],
+            "object": "payment_intent",
+            "amount": int(order["amount"]),
+            "currency": "usd",
+            "status": "succeeded",
+            "receipt_email": order["customer_email"],
+            "metadata": {"order_id": order["order_id"], "job_id": order["job_id"], "client_id": order["client_id"]}
+        }}
+    })
+
+
+def stream_event(order):
+    """The orders stream record of a webhook marking the order PAYMENT_COMPLETE"""
+    return {"Records": [{
+        "eventID": "c4ca4238a0b923820dcc509a6f75849b",
+        "eventName": "MODIFY",
+        "eventSource": "aws:dynamodb",
+        "dynamodb": {
+            "ApproximateCreationDateTime": 1735689631,
+            "Keys": {"order_id": {"S": order["order_id"]}},
+            "NewImage": {"order_id": {"S": order["order_id"]}, "status": {"S": "PAYMENT_COMPLETE"},
+                         "version": {"N": str(order.get("version", 0))}},
+            "OldImage": {"order_id": {"S": order["order_id"]}, "status": {"S": "PENDING"}},
+            "SequenceNumber": "4421584500000000017450439091",
+            "StreamViewType": "NEW_AND_OLD_IMAGES"
+        }
+    }]}
+
+
+def sign(payload, secret):
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode("utf-8"), f"{timestamp}.{payload}".encode("utf-8"), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+@benchmark("calculate_amount", "checkout")
+def bench_calculate_amount():
+    import checkout_session
+    lines = sample_order(line_count=5)["items"]
+    return lambda: checkout_session.calculate_amount(lines, "EXPRESS")
+
+
+@benchmark("compact_items", "checkout")
+def bench_compact_items():
+    from order_items import compact_items
+    from catalog import POSTERS
+    cart = [
+        {"id": int(sku), "name": poster["name"], "price": poster["price_cents"] / 100,
+         "image": poster["image"], "quantity": 2}
+        for sku, poster in POSTERS.items()
+    ]
+    return lambda: compact_items(cart)
+
+
+@benchmark("create_cors_response", "responses")
+def bench_create_cors_response():
+    import checkout_session
+    body = {
+        "clientSecret": "pi_3PqRsTuVwXyZ0123456789ab_secret_AbCdEfGhIjKlMnOpQrStUvWx",
+        "orderId": "0f8fad5b-d9cb-469f-a165-70867728950e",
+        "jobId": "9b2c5e1a4f0d4c7e8a3b6d2f1e0c9a8b",
+        "clientId": "client_18f2a3b4c5d6e"
+    }
+    return lambda: checkout_session.create_cors_response(200, body)
+
+
+@benchmark("order_status_response", "responses")
+def bench_order_status_response():
+    import order_status
+    from order_items import load_items
+    order = sample_order()
+    order["items"] = load_items(order)
+
+    def build():
+        return {
+            "statusCode": 200,
+            "headers": {
+                "Access-Control-Allow-Origin": "*",
+                "Access-Control-Allow-Headers": "*",
+                "Access-Control-Allow-Methods": "OPTIONS,GET"
+            },
+            "body": json.dumps(order, default=order_status.decimal_default)
+        }
+    return build
+
+
+def order_status_setup():
+    import order_status
+    order = sample_order()
+    order["version"] = Decimal(3)
+    order_status.table = FakeTable([order])
+    order_status.order_cache.clear()
+    return order_status, {"queryStringParameters": {"orderId": order["order_id"]}, "headers": {}}
+
+
+@benchmark("order_status (miss)", "order-status")
+def bench_order_status_miss():
+    order_status, event = order_status_setup()
+
+    def run():
+        order_status.order_cache.clear()
+        return order_status.handler(event, None)
+    return run
+
+
+@benchmark("order_status (cached)", "order-status")
+def bench_order_status_cached():
+    order_status, event = order_status_setup()
+    order_status.handler(event, None)
+    return lambda: order_status.handler(event, None)
+
+
+@benchmark("order_status (304)", "order-status")
+def bench_order_status_not_modified():
+    order_status, event = order_status_setup()
+    event["headers"] = {"If-None-Match": order_status.handler(event, None)["headers"]["ETag"]}
+    return lambda: order_status.handler(event, None)
+
+
+class FakeBucketTable:
+    """Admits every request, answering like DynamoDB with the bucket's new full-again time"""
+
+    def update_item(self, Key, ExpressionAttributeValues, **kwargs):
+        return {"Attributes": {"full_at": Decimal(ExpressionAttributeValues[":now"] + 1000)}}
+
+
+def rate_limit_event(client_id):
+    return {
+        "httpMethod": "GET",
+        "queryStringParameters": {"clientId": client_id},
+        "requestContext": {"identity": {"sourceIp": "203.0.113.7"}}
+    }
+
+
+@benchmark("rate_limit (admitted)", "rate-limit")
+def bench_rate_limit_admitted():
+    import rate_limit
+    rate_limit.table = FakeBucketTable()
+    rate_limit._known.clear()
+    event = rate_limit_event("client_bench")
+    return lambda: rate_limit.check("payment-status", event)
+
+
+@benchmark("rate_limit (rejected)", "rate-limit")
+def bench_rate_limit_rejected_locally():
+    import rate_limit
+    rate_limit._known.clear()
+    event = rate_limit_event("client_stuck")
+    # As if this container had just seen the bucket run dry
+    rate_limit._known.put("payment-status#client#client_stuck", int(time.time() * 1000) + 3600 * 1000)
+    return lambda: rate_limit.check("payment-status", event)
+
+
+@benchmark("decimal_default", "serialization")
+def bench_decimal_default():
+    import order_status
+    order = sample_order(line_count=5)
+    return lambda: json.dumps(order, default=order_status.decimal_default)
+
+
+@benchmark("DecimalEncoder", "serialization")
+def bench_decimal_encoder():
+    import stripe_webhook
+    order = sample_order(line_count=5)
+    return lambda: json.dumps(order, cls=stripe_webhook.DecimalEncoder)
+
+
+@benchmark("unpack_order", "serialization")
+def bench_unpack_order():
+    import order_store
+    packed = order_store.pack_order(sample_order(line_count=5))
+    return lambda: order_store.unpack_order(dict(packed))
+
+
+@benchmark("construct_event", "webhook")
+def bench_construct_event():
+    secret = os.environ["STRIPE_WEBHOOK_SECRET"]
+    payload = webhook_payload(sample_order())
+    header = sign(payload, secret)
+    return lambda: stripe.Webhook.construct_event(payload, header, secret)
+
+
+@benchmark("stripe_webhook.handler", "webhook")
+def bench_stripe_webhook_handler():
+    import stripe_webhook
+    import status_events
+    # Awaiting the payment, so the event is applied rather than acknowledged
+    order = dict(sample_order(), status="PENDING")
+    stripe_webhook.table = FakeTable([order])
+    status_events.status_events_table = FakeTable()
+
+    payload = webhook_payload(order)
+    event = {
+        "body": payload,
+        "headers": {"Stripe-Signature": sign(payload, os.environ["STRIPE_WEBHOOK_SECRET"])},
+        "isBase64Encoded": False
+    }
+    return lambda: stripe_webhook.handler(event, None)
+
+
+@benchmark("prodigi_order.handler", "prodigi")
+def bench_prodigi_order_handler():
+    import prodigi_order
+    order = sample_order()
+    prodigi_order.table = FakeTable([order])
+    created = FakeHttpResponse(200, {"outcome": "Created", "order": {"id": "ord_840241", "status": {"stage": "InProgress"}}})
+    prodigi_order.http.post = lambda url, **kwargs: created
+    event = {"order_id": order["order_id"], "order_data": order}
+    return lambda: prodigi_order.handler(event, None)
+
+
+@benchmark("order_fulfillment.handler", "prodigi")
+def bench_order_fulfillment_handler():
+    import prodigi_order
+    import order_fulfillment
+    order = sample_order()
+    order_fulfillment.table = prodigi_order.table = FakeTable([order])
+    created = FakeHttpResponse(200, {"outcome": "Created", "order": {"id": "ord_840241", "status": {"stage": "InProgress"}}})
+    prodigi_order.http.post = lambda url, **kwargs: created
+    event = stream_event(order)
+    return lambda: order_fulfillment.handler(event, None)
+
+
+@benchmark("span (no active trace)", "tracing")
+def bench_span_inactive():
+    def run():
+        with tracing.span("Prodigi", "POST /orders"):
+            pass
+    return run
+
+
+@benchmark("span (active trace)", "tracing")
+def bench_span_active():
+    trace = tracing.Trace("bench", None, False)
+    tracing._current_trace.set(trace)
+
+    def run():
+        with tracing.span("Prodigi", "POST /orders"):
+            pass
+        trace.spans.clear()
+    return run
+
+
+@benchmark("boto3 hooks (active trace)", "tracing")
+def bench_boto_hooks():
+    from types import SimpleNamespace
+    trace = tracing.Trace("bench", None, False)
+    tracing._current_trace.set(trace)
+    model = SimpleNamespace(name="GetItem", service_model=SimpleNamespace(service_id="DynamoDB"))
+    parsed = {"Item": {}, "ResponseMetadata": {}}
+
+    def run():
+        context = {}
+        tracing._before_boto_call(context=context, model=model)
+        tracing._after_boto_call(context=context, model=model, parsed=parsed)
+        trace.spans.clear()
+    return run
+
+
+@benchmark("trace.to_emf (12 spans)", "tracing")
+def bench_to_emf():
+    trace = tracing.Trace("stripe_webhook", "3c2d0f6e-bench", False)
+    for dependency, operation in [("DynamoDB", "GetItem"), ("DynamoDB", "UpdateItem"), ("DynamoDB", "PutItem"),
+                                  ("Lambda", "Invoke"), ("SES", "SendEmail"), ("Stripe", "GET /v1/events")] * 2:
+        trace.record(dependency, operation, time.perf_counter())
+    trace.annotations["order_id"] = "0f8fad5b-d9cb-469f-a165-70867728950e"
+    return lambda: json.dumps(trace.to_emf(), separators=(",", ":"))
+
+
+def calibrate(func, min_time):
+    """Find a loop count that makes one round last at least min_time seconds"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return number
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9) * 1.2))
+
+
+def measure(func, rounds, min_time, warmup):
+    for _ in range(warmup):
+        func()
+    number = calibrate(func, min_time)
+
+    per_call = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            per_call.append((time.perf_counter() - start) / number)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    median = statistics.median(per_call)
+    return {
+        "rounds": rounds,
+        "iterations": number,
+        "min_us": round(min(per_call) * 1e6, 3),
+        "max_us": round(max(per_call) * 1e6, 3),
+        "mean_us": round(statistics.mean(per_call) * 1e6, 3),
+        "median_us": round(median * 1e6, 3),
+        "stddev_us": round(statistics.stdev(per_call) * 1e6, 3) if rounds > 1 else 0.0,
+        "ops": round(1 / median, 1)
+    }
+
+
+def machine_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "commit": commit,
+        "datetime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    }
+
+
+def compare(results, baseline, max_regression):
+    """Print a comparison against a saved run; return the names that regressed"""
+    print(f"\nBaseline: {baseline['machine'].get('commit')} at {baseline['machine'].get('datetime')}")
+    if baseline["machine"].get("python") != platform.python_version():
+        print(f"  note: baseline was Python {baseline['machine'].get('python')}")
+
+    regressions = []
+    print(f"{'benchmark':28} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name, stats in results.items():
+        before = baseline["benchmarks"].get(name)
+        if not before:
+            print(f"{name:28} {'-':>12} {stats['median_us']:>10.2f}us {'new':>9}")
+            continue
+        change = stats["median_us"] / before["median_us"] - 1
+        flag = ""
+        if change > max_regression:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:28} {before['median_us']:>10.2f}us {stats['median_us']:>10.2f}us {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backend hot-path microbenchmarks")
+    parser.add_argument("-k", dest="filters", action="append", default=[],
+                        help="Only run benchmarks whose name or group contains this (repeatable)")
+    parser.add_argument("--rounds", type=int, default=15)
+    parser.add_argument("--min-time", type=float, default=0.02, help="Minimum seconds per round")
+    parser.add_argument("--warmup", type=int, default=20, help="Untimed calls before calibrating")
+    parser.add_argument("--save", help="Write results as JSON to this path")
+    parser.add_argument("--compare", help="Compare against a JSON file written by --save")
+    parser.add_argument("--max-regression", type=float, default=0.10,
+                        help="Allowed median slowdown against the baseline (0.10 = 10%%)")
+    parser.add_argument("--list", action="store_true", help="List benchmarks and exit")
+    args = parser.parse_args()
+
+    selected = [
+        (name, group, setup) for name, group, setup in BENCHMARKS
+        if not args.filters or any(f in name or f in group for f in args.filters)
+    ]
+    if args.list:
+        for name, group, _ in selected:
+            print(f"{group:14} {name}")
+        return 0
+
+    # The Lambda runtime attaches a handler to the root logger; emulate it
+    root = logging.getLogger()
+    root.handlers = [logging.StreamHandler(open(os.devnull, "w"))]
+    # Traced handlers still build their EMF record, but it goes nowhere
+    tracing.set_sink(lambda line: None)
+
+    results = {}
+    print(f"{'benchmark':28} {'group':14} {'median':>11} {'mean':>11} {'stddev':>10} {'ops/s':>11}")
+    for name, group, setup in selected:
+        # A fresh context per benchmark so a trace set up by one cannot leak into the next
+        stats = contextvars.Context().run(lambda: measure(setup(), args.rounds, args.min_time, args.warmup))
+        stats["group"] = group
+        results[name] = stats
+        print(f"{name:28} {group:14} {stats['median_us']:>9.2f}us {stats['mean_us']:>9.2f}us "
+              f"{stats['stddev_us']:>8.2f}us {stats['ops']:>11.1f}")
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({"machine": machine_info(), "benchmarks": results}, f, indent=2)
+        print(f"\nSaved {args.save}")
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed more than {args.max_regression:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+"""
+Local stand-ins for the Stripe and Prodigi HTTP APIs.
+
+Both servers keep state in memory, answer just enough of each API for the
+backend handlers, and can inject latency and error responses so load tests
+can see how the shop behaves when a dependency is slow or flaky.
+"""
+import re
+import json
+import time
+import uuid
+import random
+import threading
+from urllib.parse import urlparse, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FaultProfile:
+    """Latency and error injection settings for a mock server"""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def apply(self):
+        """Sleep for the configured latency; return True if this request should fail"""
+        with self.lock:
+            delay = self.latency_ms + self.random.uniform(0, self.jitter_ms)
+            fail = self.random.random() < self.error_rate
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        return fail
+
+
+class MockServer(ThreadingHTTPServer):
+    """Threaded HTTP server dispatching to (method, regex) routes"""
+
+    daemon_threads = True
+    routes = []
+
+    def __init__(self, faults=None, host="127.0.0.1", port=0):
+        self.faults = faults or FaultProfile()
+        self.lock = threading.Lock()
+        self.request_count = 0
+        super().__init__((host, port), _RequestHandler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def error_response(self):
+        return 500, {"error": "injected failure"}
+
+    def dispatch(self, method, path, query, body):
+        with self.lock:
+            self.request_count += 1
+        if self.faults.apply():
+            return self.error_response()
+
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                return getattr(self, name)(query, body, *match.groups())
+        return 404, {"error": f"No mock route for {method} {path}"}
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self, method):
+        parsed = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length) if length else b""
+        status, payload = self.server.dispatch(method, parsed.path, parse_qsl(parsed.query), raw_body)
+
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_stripe_form(pairs):
+    """Turn Stripe's bracketed form encoding (metadata[order_id]=...) into nested dicts"""
+    result = {}
+    for key, value in pairs:
+        parts = re.findall(r"[^\[\]]+", key)
+        target = result
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return result
+
+
+class MockStripe(MockServer):
+    """
+    Enough of the Stripe API for checkout, payment confirmation and event
+    replay: PaymentIntents (create, retrieve, confirm, list), Events (list)
+    and Account (retrieve).
+    """
+
+    routes = [
+        ("POST", r"/v1/payment_intents", "create_payment_intent"),
+        ("GET", r"/v1/payment_intents", "list_payment_intents"),
+        ("GET", r"/v1/payment_intents/([^/]+)", "retrieve_payment_intent"),
+        ("POST", r"/v1/payment_intents/([^/]+)/confirm", "confirm_payment_intent"),
+        ("GET", r"/v1/events", "list_events"),
+        ("GET", r"/v1/account", "retrieve_account")
+    ]
+
+    def __init__(self, faults=None, **kwargs):
+        self.payment_intents = {}
+        self.events = []
+        super().__init__(faults, **kwargs)
+
+    def error_response(self):
+        return 500, {"error": {"type": "api_error", "message": "Injected mock Stripe failure"}}
+
+    def create_payment_intent(self, query, body):
+        params = parse_stripe_form(parse_qsl(body.decode("utf-8")))
+        intent_id = f"pi_{uuid.uuid4().hex[:24]}"
+        intent = {
+            "id": intent_id,
+            "object": "payment_intent",
+            "amount": int(params.get("amount", 0)),
+            "currency": params.get("currency", "usd"),
+            "client_secret": f"{intent_id}_secret_{uuid.uuid4().hex[:24]}",
+            "created": int(time.time()),
+            "livemode": False,
+            "metadata": params.get("metadata", {}),
+            "receipt_email": params.get("receipt_email"),
+            "status": "requires_payment_method"
+        }
+        with self.lock:
+            self.payment_intents[intent_id] = intent
+        return 200, intent
+
+    def retrieve_payment_intent(self, query, body, intent_id):
+        intent = self.payment_intents.get(intent_id)
+        if not intent:
+            return 404, {"error": {"type": "invalid_request_error", "message": f"No such payment_intent: {intent_id}"}}
+        return 200, intent
+
+    def confirm_payment_intent(self, query, body, intent_id):
+        """Mark a PaymentIntent paid and record the payment_intent.succeeded event"""
+        with self.lock:
+            intent = self.payment_intents.get(intent_id)
+            if not intent:
+                return 404, {"error": {"type": "invalid_request_error", "message": f"No such payment_intent: {intent_id}"}}
+            intent["status"] = "succeeded"
+            event = self.record_event("payment_intent.succeeded", intent)
+        return 200, dict(intent, latest_event=event["id"])
+
+    def record_event(self, event_type, obj):
+        event = {
+            "id": f"evt_{uuid.uuid4().hex[:24]}",
+            "object": "event",
+            "type": event_type,
+            "created": int(time.time()),
+            "livemode": False,
+            "api_version": "2025-03-31.basil",
+            "data": {"object": dict(obj)}
+        }
+        self.events.append(event)
+        return event
+
+    def _page(self, objects, query, url):
+        """Apply Stripe list semantics: newest first, limit, starting_after, created[gt|gte|lte]"""
+        params = dict(query)
+        limit = min(int(params.get("limit", 10)), 100)
+        created_gt = params.get("created[gt]")
+        created_gte = params.get("created[gte]")
+        created_lte = params.get("created[lte]")
+        event_type = params.get("type")
+
+        matching = sorted(objects, key=lambda obj: obj["created"], reverse=True)
+        if created_gt is not None:
+            matching = [obj for obj in matching if obj["created"] > int(created_gt)]
+        if created_gte is not None:
+            matching = [obj for obj in matching if obj["created"] >= int(created_gte)]
+        if created_lte is not None:
+            matching = [obj for obj in matching if obj["created"] <= int(created_lte)]
+        if event_type:
+            matching = [obj for obj in matching if obj.get("type") == event_type]
+
+        starting_after = params.get("starting_after")
+        if starting_after:
+            ids = [obj["id"] for obj in matching]
+            matching = matching[ids.index(starting_after) + 1:] if starting_after in ids else []
+
+        return 200, {
+            "object": "list",
+            "url": url,
+            "data": matching[:limit],
+            "has_more": len(matching) > limit
+        }
+
+    def list_payment_intents(self, query, body):
+        with self.lock:
+            intents = list(self.payment_intents.values())
+        return self._page(intents, query, "/v1/payment_intents")
+
+    def list_events(self, query, body):
+        with self.lock:
+            events = list(self.events)
+        return self._page(events, query, "/v1/events")
+
+    def retrieve_account(self, query, body):
+        return 200, {
+            "id": "acct_local",
+            "object": "account",
+            "charges_enabled": True,
+            "details_submitted": False,
+            "settings": {"dashboard": {"display_name": "SteepleCo (mock)"}}
+        }
+
+
+class MockProdigi(MockServer):
+    """
+    Prodigi v4 orders API: create (idempotent on idempotencyKey) and retrieve.
+    Orders advance InProgress -> Complete after `complete_after` seconds.
+    """
+
+    routes = [
+        ("POST", r"/v4\.0/orders", "create_order"),
+        ("GET", r"/v4\.0/orders/([^/]+)", "get_order")
+    ]
+
+    def __init__(self, faults=None, complete_after=30.0, **kwargs):
+        self.orders = {}
+        self.by_idempotency_key = {}
+        self.complete_after = complete_after
+        self.duplicate_submissions = 0
+        super().__init__(faults, **kwargs)
+
+    def error_response(self):
+        return 503, {"outcome": "ServiceUnavailable", "traceParent": uuid.uuid4().hex}
+
+    def _view(self, order):
+        stage = "Complete" if time.time() - order["created_at"] >= self.complete_after else "InProgress"
+        return dict(order["order"], status={"stage": stage})
+
+    def create_order(self, query, body):
+        payload = json.loads(body or b"{}")
+        key = payload.get("idempotencyKey")
+        with self.lock:
+            if key and key in self.by_idempotency_key:
+                self.duplicate_submissions += 1
+                existing = self.orders[self.by_idempotency_key[key]]
+                return 200, {"outcome": "Created", "order": self._view(existing)}
+
+            order_id = f"ord_{uuid.uuid4().hex[:12]}"
+            order = {
+                "created_at": time.time(),
+                "order": {
+                    "id": order_id,
+                    "merchantReference": key,
+                    "shippingMethod": payload.get("shippingMethod"),
+                    "recipient": payload.get("recipient"),
+                    "items": payload.get("items", [])
+                }
+            }
+            self.orders[order_id] = order
+            if key:
+                self.by_idempotency_key[key] = order_id
+        return 200, {"outcome": "Created", "order": self._view(order)}
+
+    def get_order(self, query, body, order_id):
+        order = self.orders.get(order_id)
+        if not order:
+            return 404, {"outcome": "NotFound"}
+        return 200, {"outcome": "Ok", "order": self._view(order)}
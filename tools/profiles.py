@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+List and merge the sampled handler profiles written by backend/profiling.py.
+
+    list     one line per profile: function, request id, duration, samples,
+             peak memory
+    merge    folded stacks ("frame;frame;frame count" lines) summed over the
+             selected profiles, ready for flamegraph.pl or speedscope
+    memory   allocation sites summed over the selected profiles
+
+Profiles can be filtered by function, day and duration, so a p99 spike can
+be looked at on its own (--min-duration-ms).
+
+Usage:
+    python tools/profiles.py list --bucket steepleco-profiles --function stripe_webhook
+    python tools/profiles.py merge --dir /tmp/profiles --min-duration-ms 500 > slow.folded
+    flamegraph.pl slow.folded > slow.svg
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+from collections import Counter
+
+import backend_env  # noqa: F401
+
+
+def local_profiles(root, prefix):
+    base = os.path.join(root, *prefix.split("/"))
+    for directory, _, files in os.walk(base):
+        for name in sorted(files):
+            if name.endswith(".json.gz"):
+                with open(os.path.join(directory, name), "rb") as f:
+                    yield f.read()
+
+
+def s3_profiles(bucket, prefix):
+    import boto3
+    s3 = boto3.client("s3")
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(".json.gz"):
+                yield s3.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read()
+
+
+def load_profiles(args):
+    from profiling import PROFILE_PREFIX
+    prefix = PROFILE_PREFIX + "/"
+    if args.function:
+        prefix += args.function + "/"
+        if args.day:
+            prefix += args.day + "/"
+    blobs = local_profiles(args.dir, prefix) if args.dir else s3_profiles(args.bucket, prefix)
+
+    for blob in blobs:
+        profile = json.loads(gzip.decompress(blob))
+        if args.day and time_day(profile) != args.day:
+            continue
+        if profile.get("duration_ms", 0) < args.min_duration_ms:
+            continue
+        yield profile
+
+
+def time_day(profile):
+    return time.strftime("%Y-%m-%d", time.gmtime(profile.get("timestamp", 0)))
+
+
+def list_profiles(profiles):
+    print(f"{'function':18} {'request id':38} {'ms':>9} {'samples':>8} {'peak KiB':>9}  cold  order")
+    for profile in sorted(profiles, key=lambda p: p.get("duration_ms", 0), reverse=True):
+        memory = profile.get("memory") or {}
+        peak = f"{memory['peak_bytes'] / 1024:.0f}" if memory else "-"
+        print(f"{profile['function']:18} {profile['request_id']:38} {profile['duration_ms']:9.1f} "
+              f"{sum(profile['samples'].values()):8} {peak:>9}  {str(profile.get('cold_start'))[:5]:5} "
+              f"{(profile.get('annotations') or {}).get('order_id') or ''}")
+
+
+def merge_stacks(profiles, prefix_function=False):
+    stacks = Counter()
+    count = 0
+    for profile in profiles:
+        count += 1
+        for stack, samples in profile["samples"].items():
+            stacks[f"{profile['function']};{stack}" if prefix_function else stack] += samples
+    return stacks, count
+
+
+def merge_memory(profiles):
+    sites = {}
+    peaks = []
+    for profile in profiles:
+        memory = profile.get("memory")
+        if not memory:
+            continue
+        peaks.append(memory["peak_bytes"])
+        for site in memory["top"]:
+            totals = sites.setdefault(site["location"], [0, 0, 0])
+            totals[0] += site["size_bytes"]
+            totals[1] += site["count"]
+            totals[2] += 1
+    return sites, peaks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List and merge sampled handler profiles")
+    parser.add_argument("command", choices=["list", "merge", "memory"])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dir", help="Local PROFILE_DIR")
+    source.add_argument("--bucket", help="PROFILE_BUCKET")
+    parser.add_argument("--function", help="Only this handler module, e.g. stripe_webhook")
+    parser.add_argument("--day", help="Only profiles from this UTC day (YYYY-MM-DD)")
+    parser.add_argument("--min-duration-ms", type=float, default=0, help="Only invocations at least this slow")
+    parser.add_argument("--by-function", action="store_true",
+                        help="merge: put the function name at the root of every stack")
+    parser.add_argument("--output", help="merge: write folded stacks here instead of stdout")
+    args = parser.parse_args()
+
+    profiles = load_profiles(args)
+
+    if args.command == "list":
+        list_profiles(list(profiles))
+
+    elif args.command == "merge":
+        stacks, count = merge_stacks(profiles, args.by_function)
+        out = open(args.output, "w") if args.output else sys.stdout
+        for stack, samples in stacks.most_common():
+            out.write(f"{stack} {samples}\n")
+        if args.output:
+            out.close()
+        print(f"Merged {count} profiles, {sum(stacks.values())} samples, {len(stacks)} distinct stacks",
+              file=sys.stderr)
+
+    else:
+        sites, peaks = merge_memory(profiles)
+        if not peaks:
+            print("No memory data in the selected profiles")
+            return
+        peaks.sort()
+        print(f"{len(peaks)} profiles; peak traced memory p50 {peaks[len(peaks) // 2] / 1024:.0f} KiB, "
+              f"max {peaks[-1] / 1024:.0f} KiB\n")
+        print(f"{'allocation site':60} {'KiB':>10} {'blocks':>8} {'profiles':>8}")
+        for location, (size, blocks, seen) in sorted(sites.items(), key=lambda item: item[1][0], reverse=True)[:30]:
+            print(f"{location:60} {size / 1024:10.1f} {blocks:8} {seen:8}")
+
+
+if __name__ == "__main__":
+    main()
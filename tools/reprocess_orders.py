@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Re-submit ERROR and stuck orders to Prodigi in bulk.
+
+Orders are selected from the orders table's ByStatus index (status, then
+updated_at), optionally narrowed to a time range and to error messages
+matching a regular expression, so nothing is scanned. Each selected order is
+handed to the Prodigi order function, which reads the order, takes its
+fulfillment lease and submits it; an order that was submitted meanwhile
+comes back as already submitted and is left alone.
+
+Submissions run on --workers threads, started no faster than --rate per
+second across all of them. Progress and throughput are printed as results
+come in. With --checkpoint the outcome of every order is written to a JSON
+file as it completes; running again with the same file skips the orders
+that were submitted or already submitted, and retries the rest.
+
+By default the deployed SteepleCo-ProdigiOrder function is invoked; with
+--in-process the handler runs here with this shell's environment (e.g.
+ORDERS_TABLE, CONFIG_SECRET_ID or PRODIGI_SANDBOX_API_KEY).
+
+Usage:
+    python tools/reprocess_orders.py --status ERROR --error-pattern "color" --dry-run
+    python tools/reprocess_orders.py --status ERROR --since 2024-05-01 --until 2024-05-02 \\
+        --workers 4 --rate 2 --checkpoint /tmp/reprocess-may1.json
+    python tools/reprocess_orders.py --status PAYMENT_COMPLETE --status PAID --older-than 3600
+"""
+import os
+import re
+import json
+import time
+import argparse
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import backend_env  # noqa: F401
+from order_store import STATUS_INDEX, unpack_value
+
+# Function outcomes that need no further attempt
+FINISHED_OUTCOMES = {"submitted", "already_submitted"}
+
+
+def parse_time(value):
+    """Epoch seconds from epoch seconds or an ISO date/time (UTC unless it says otherwise)"""
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return int(parsed.timestamp())
+
+
+def select_orders(table, statuses, since=None, until=None, error_pattern=None):
+    """Index entries for orders in the given statuses updated within [since, until], oldest first"""
+    from boto3.dynamodb.conditions import Key
+
+    pattern = re.compile(error_pattern) if error_pattern else None
+    selected = []
+    for status in statuses:
+        condition = Key("status").eq(status)
+        if since is not None and until is not None:
+            condition &= Key("updated_at").between(since, until)
+        elif since is not None:
+            condition &= Key("updated_at").gte(since)
+        elif until is not None:
+            condition &= Key("updated_at").lte(until)
+
+        kwargs = {"IndexName": STATUS_INDEX, "KeyConditionExpression": condition}
+        while True:
+            response = table.query(**kwargs)
+            for entry in response.get("Items", []):
+                error_message = unpack_value(entry.get("error_message")) or ""
+                if pattern and not pattern.search(str(error_message)):
+                    continue
+                selected.append({
+                    "order_id": entry["order_id"],
+                    "status": entry["status"],
+                    "updated_at": int(entry["updated_at"]),
+                    "error_message": str(error_message)
+                })
+            if "LastEvaluatedKey" not in response:
+                break
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    return sorted(selected, key=lambda entry: entry["updated_at"])
+
+
+class RateLimiter:
+    """Spaces out acquire() calls from any number of threads to at most `rate` per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Checkpoint:
+    """Outcome per order ID, rewritten atomically after every change"""
+
+    def __init__(self, path, selection):
+        self.path = path
+        self.lock = threading.Lock()
+        self.outcomes = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get("selection") != selection:
+                print(f"Note: {path} was written for a different selection; its finished orders are still skipped")
+            self.outcomes = saved.get("outcomes", {})
+        self.selection = selection
+
+    def finished(self, order_id):
+        return (self.outcomes.get(order_id) or {}).get("outcome") in FINISHED_OUTCOMES
+
+    def record(self, order_id, outcome, detail):
+        with self.lock:
+            self.outcomes[order_id] = {"outcome": outcome, "detail": detail, "at": int(time.time())}
+            if self.path:
+                temporary = self.path + ".tmp"
+                with open(temporary, "w") as f:
+                    json.dump({"selection": self.selection, "outcomes": self.outcomes}, f, indent=1)
+                os.replace(temporary, self.path)
+
+
+def lambda_submitter(function_name):
+    """Submit through the deployed Prodigi order function"""
+    import boto3
+    from botocore.config import Config
+
+    # The function may take its full 30 s timeout
+    client = boto3.client("lambda", config=Config(read_timeout=60, retries={"max_attempts": 0}))
+
+    def submit(order_id):
+        response = client.invoke(FunctionName=function_name, Payload=json.dumps({"order_id": order_id}))
+        payload = json.loads(response["Payload"].read() or b"{}")
+        if response.get("FunctionError"):
+            return {"statusCode": 500, "body": json.dumps({"error": payload.get("errorMessage")})}
+        return payload
+
+    return submit
+
+
+def in_process_submitter():
+    """Submit by running the Prodigi order handler in this process"""
+    import prodigi_order
+
+    def submit(order_id):
+        return prodigi_order.handler({"order_id": order_id}, None)
+
+    return submit
+
+
+def outcome_of(result):
+    """(outcome, detail) for the Prodigi order function's response"""
+    status_code = result.get("statusCode")
+    try:
+        body = json.loads(result.get("body") or "{}")
+    except (TypeError, ValueError):
+        body = {}
+    if status_code == 200:
+        return "submitted", body.get("prodigi_order_id")
+    if status_code == 409:
+        return "already_submitted", None
+    return "failed", f"{status_code}: {body.get('error') or body.get('message')}"
+
+
+def reprocess(orders, submit, checkpoint, workers, rate, progress_every=5.0):
+    limiter = RateLimiter(rate)
+    counts = {"submitted": 0, "already_submitted": 0, "failed": 0}
+    started = time.monotonic()
+    last_progress = started
+
+    def run(order):
+        limiter.acquire()
+        try:
+            return outcome_of(submit(order["order_id"]))
+        except Exception as e:
+            return "failed", str(e)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run, order): order for order in orders}
+        for done, future in enumerate(as_completed(futures), 1):
+            order = futures[future]
+            outcome, detail = future.result()
+            counts[outcome] += 1
+            checkpoint.record(order["order_id"], outcome, detail)
+            if outcome == "failed":
+                print(f"  {order['order_id']}: {detail}")
+
+            now = time.monotonic()
+            if now - last_progress >= progress_every or done == len(orders):
+                last_progress = now
+                elapsed = now - started
+                print(f"{done}/{len(orders)} done in {elapsed:.1f}s ({done / elapsed:.2f}/s)  "
+                      + "  ".join(f"{name}={value}" for name, value in counts.items()))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-submit ERROR and stuck orders to Prodigi")
+    parser.add_argument("--table", default=os.environ.get("ORDERS_TABLE", "SteepleCo-Orders"))
+    parser.add_argument("--status", action="append", help="Order status to select (repeatable; default ERROR)")
+    parser.add_argument("--since", help="Only orders last updated at or after this (epoch seconds or ISO time)")
+    parser.add_argument("--until", help="Only orders last updated at or before this")
+    parser.add_argument("--older-than", type=float, help="Only orders not updated for this many seconds")
+    parser.add_argument("--error-pattern", help="Only orders whose error_message matches this regex")
+    parser.add_argument("--limit", type=int, help="Process at most this many orders")
+    parser.add_argument("--workers", type=int, default=4, help="Submissions in flight at once")
+    parser.add_argument("--rate", type=float, default=2.0, help="Submissions started per second (0: unlimited)")
+    parser.add_argument("--checkpoint", help="JSON file recording each order's outcome, to resume from")
+    parser.add_argument("--function", default="SteepleCo-ProdigiOrder", help="Prodigi order function to invoke")
+    parser.add_argument("--in-process", action="store_true", help="Run the Prodigi order handler here instead")
+    parser.add_argument("--dry-run", action="store_true", help="List the selected orders without submitting")
+    args = parser.parse_args()
+
+    statuses = args.status or ["ERROR"]
+    since, until = parse_time(args.since), parse_time(args.until)
+    if args.older_than is not None:
+        cutoff = int(time.time() - args.older_than)
+        until = cutoff if until is None else min(until, cutoff)
+
+    import boto3
+    orders = select_orders(boto3.resource("dynamodb").Table(args.table), statuses, since, until, args.error_pattern)
+    selection = {"statuses": statuses, "since": since, "until": until, "error_pattern": args.error_pattern}
+    checkpoint = Checkpoint(args.checkpoint, selection)
+    pending = [order for order in orders if not checkpoint.finished(order["order_id"])]
+    finished = len(orders) - len(pending)
+    if args.limit is not None:
+        pending = pending[:args.limit]
+    print(f"Selected {len(orders)} orders, {finished} already finished, {len(pending)} to submit")
+
+    if args.dry_run:
+        for order in pending:
+            updated = datetime.fromtimestamp(order["updated_at"], timezone.utc).isoformat(timespec="seconds")
+            print(f"  {order['order_id']}  {order['status']:<16} {updated}  {order['error_message'][:80]}")
+        return
+    if not pending:
+        return
+
+    submit = in_process_submitter() if args.in_process else lambda_submitter(args.function)
+    counts = reprocess(pending, submit, checkpoint, args.workers, args.rate)
+    if args.checkpoint:
+        print(f"Outcomes written to {args.checkpoint}")
+    if counts["failed"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Columnar sales analytics over archived or exported orders.
+
+Orders are decoded once into NumPy columns (dictionary-encoded posters,
+countries, shipping methods and statuses; integer cents; epoch seconds), and
+every report is then a handful of vectorized operations instead of a Python
+loop that re-reads the `items` of every order. Both the compact order-line
+schema and legacy JSON-string items are accepted.
+
+Usage:
+    python tools/sales_analytics.py --archive-dir ./archive
+    python tools/sales_analytics.py --archive-bucket my-archive-bucket
+    python tools/sales_analytics.py orders-export.jsonl.gz
+"""
+import gzip
+import json
+import argparse
+from array import array
+from datetime import datetime, timezone
+
+import numpy as np
+
+import backend_env  # noqa: F401
+from order_items import order_lines
+
+# Statuses an order can only reach after the customer has paid
+PAID_STATUSES = {"PAYMENT_COMPLETE", "PAID", "PROCESSING"}
+WEEK_SECONDS = 7 * 24 * 60 * 60
+# 1970-01-05 was the first Monday after the epoch; weeks start on Mondays
+WEEK_ORIGIN = 4 * 24 * 60 * 60
+
+
+class Dictionary:
+    """Maps string values to dense integer codes"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __len__(self):
+        return len(self.values)
+
+
+class OrderColumns:
+    """Order and order-line columns built from plain order dicts"""
+
+    def __init__(self, orders):
+        self.statuses = Dictionary()
+        self.countries = Dictionary()
+        self.shipping_methods = Dictionary()
+        self.posters = Dictionary()
+
+        status = array("i")
+        country = array("i")
+        shipping = array("i")
+        paid = array("b")
+        created_at = array("q")
+        amount_cents = array("q")
+
+        line_order = array("i")
+        line_poster = array("i")
+        line_quantity = array("i")
+        line_cents = array("q")
+
+        seen = set()
+        for order in orders:
+            # Archive runs that were retried can contain the same order twice
+            order_id = order.get("order_id")
+            if order_id in seen:
+                continue
+            seen.add(order_id)
+
+            index = len(status)
+            shipping_details = order.get("shipping_details") or {}
+            order_status = order.get("status", "UNKNOWN")
+
+            status.append(self.statuses.encode(order_status))
+            country.append(self.countries.encode(shipping_details.get("country", "??")))
+            shipping.append(self.shipping_methods.encode(shipping_details.get("shippingMethod", "BUDGET")))
+            paid.append(order_status in PAID_STATUSES or order.get("payment_status") == "paid")
+            created_at.append(int(order.get("created_at") or 0))
+            amount_cents.append(int(order.get("amount_paid") or order.get("amount") or 0))
+
+            try:
+                lines = order_lines(order)
+            except ValueError:
+                lines = []
+
+            for line in lines:
+                quantity = int(line["qty"])
+                line_order.append(index)
+                line_poster.append(self.posters.encode(str(line["sku"])))
+                line_quantity.append(quantity)
+                line_cents.append(int(line["cents"]) * quantity)
+
+        self.status = np.array(status, dtype=np.int32)
+        self.country = np.array(country, dtype=np.int32)
+        self.shipping = np.array(shipping, dtype=np.int32)
+        self.paid = np.array(paid, dtype=bool)
+        self.created_at = np.array(created_at, dtype=np.int64)
+        self.amount_cents = np.array(amount_cents, dtype=np.int64)
+
+        self.line_order = np.array(line_order, dtype=np.int32)
+        self.line_poster = np.array(line_poster, dtype=np.int32)
+        self.line_quantity = np.array(line_quantity, dtype=np.int32)
+        self.line_cents = np.array(line_cents, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.status)
+
+    def revenue_per_poster_per_week(self):
+        """{(poster_id, week_start): revenue_cents} over paid orders"""
+        paid_lines = self.paid[self.line_order]
+        posters = self.line_poster[paid_lines]
+        weeks = (self.created_at[self.line_order[paid_lines]] - WEEK_ORIGIN) // WEEK_SECONDS
+        cents = self.line_cents[paid_lines]
+        if len(weeks) == 0:
+            return {}
+
+        first_week = weeks.min()
+        week_count = int(weeks.max() - first_week + 1)
+        keys = posters.astype(np.int64) * week_count + (weeks - first_week)
+        totals = np.bincount(keys, weights=cents, minlength=len(self.posters) * week_count)
+
+        result = {}
+        for key in np.flatnonzero(totals):
+            poster, week = divmod(int(key), week_count)
+            week_start = datetime.fromtimestamp(
+                int(first_week + week) * WEEK_SECONDS + WEEK_ORIGIN, tz=timezone.utc
+            ).strftime("%Y-%m-%d")
+            result[(self.posters.values[poster], week_start)] = int(totals[key])
+        return result
+
+    def aov_per_shipping_method(self):
+        """{shipping_method: average paid order value in cents}"""
+        methods = self.shipping[self.paid]
+        counts = np.bincount(methods, minlength=len(self.shipping_methods))
+        totals = np.bincount(methods, weights=self.amount_cents[self.paid], minlength=len(self.shipping_methods))
+        return {
+            self.shipping_methods.values[code]: float(totals[code] / counts[code])
+            for code in np.flatnonzero(counts)
+        }
+
+    def revenue_per_country(self):
+        """{country_code: paid revenue in cents}"""
+        totals = np.bincount(
+            self.country[self.paid],
+            weights=self.amount_cents[self.paid],
+            minlength=len(self.countries)
+        )
+        return {self.countries.values[code]: int(totals[code]) for code in np.flatnonzero(totals)}
+
+    def funnel(self):
+        """Counts and rates for PENDING -> PAID and PENDING -> EXPIRED"""
+        created = len(self)
+        paid = int(self.paid.sum())
+        expired_code = self.statuses.codes.get("EXPIRED")
+        expired = int((self.status == expired_code).sum()) if expired_code is not None else 0
+        return {
+            "created": created,
+            "paid": paid,
+            "expired": expired,
+            "paid_rate": paid / created if created else 0.0,
+            "expired_rate": expired / created if created else 0.0
+        }
+
+
+def read_export(path):
+    """Yield orders from an exported .jsonl or .jsonl.gz file"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_archive(store):
+    """Yield every order in the order archive"""
+    from order_archive import SEGMENT_PREFIX, read_segment
+    for key in store.list(SEGMENT_PREFIX + "/"):
+        yield from read_segment(store, key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sales analytics over archived or exported orders")
+    parser.add_argument("exports", nargs="*", help="Exported .jsonl/.jsonl.gz order files")
+    parser.add_argument("--archive-dir", help="Read a local copy of the order archive")
+    parser.add_argument("--archive-bucket", help="Read the order archive from S3")
+    args = parser.parse_args()
+
+    from order_archive import LocalObjectStore, S3ObjectStore
+
+    def orders():
+        for path in args.exports:
+            yield from read_export(path)
+        if args.archive_dir:
+            yield from read_archive(LocalObjectStore(args.archive_dir))
+        if args.archive_bucket:
+            yield from read_archive(S3ObjectStore(args.archive_bucket))
+
+    columns = OrderColumns(orders())
+    report = {
+        "orders": len(columns),
+        "funnel": columns.funnel(),
+        "aov_per_shipping_method_cents": columns.aov_per_shipping_method(),
+        "revenue_per_country_cents": columns.revenue_per_country(),
+        "revenue_per_poster_per_week_cents": {
+            f"{poster}@{week}": cents
+            for (poster, week), cents in sorted(columns.revenue_per_poster_per_week().items())
+        }
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Put limited editions on sale, and show what is left of them.
+
+Every catalog entry with an edition_size is seeded into the stock table
+(STOCK_TABLE, default SteepleCo-Stock), spread over STOCK_SHARDS shards, unless it
+was seeded before; an edition already on sale is never reset. Stock levels
+per SKU and shard are printed afterwards.
+
+Usage:
+    python tools/seed_stock.py
+    python tools/seed_stock.py --sku 6 --edition-size 250
+    python tools/seed_stock.py --show
+"""
+import argparse
+
+import backend_env  # noqa: F401
+import stock
+from catalog import POSTERS
+
+
+def show(skus):
+    for sku in skus:
+        levels = stock.shard_levels(sku)
+        shards = "  ".join(f"{shard}:{available}" for shard, available in sorted(levels.items()))
+        print(f"  {sku:<8} {sum(levels.values()):>6} left   {shards or 'not seeded'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed limited-edition stock")
+    parser.add_argument("--sku", help="Seed only this SKU")
+    parser.add_argument("--edition-size", type=int, help="Prints in the edition (default: the catalog's)")
+    parser.add_argument("--show", action="store_true", help="Only show stock levels")
+    args = parser.parse_args()
+
+    editions = {sku: poster["edition_size"] for sku, poster in POSTERS.items() if poster.get("edition_size")}
+    if args.sku:
+        edition_size = args.edition_size or editions.get(args.sku)
+        if not edition_size:
+            parser.error(f"{args.sku} has no edition_size in the catalog; pass --edition-size")
+        editions = {args.sku: edition_size}
+    if not editions:
+        print("The catalog has no limited editions")
+        return
+
+    if not args.show:
+        for sku, edition_size in editions.items():
+            if stock.seed(sku, edition_size):
+                print(f"Seeded {sku} with {edition_size} prints over {stock.STOCK_SHARDS} shards")
+            else:
+                print(f"{sku} was seeded before; left as it is")
+    show(editions)
+
+
+if __name__ == "__main__":
+    main()
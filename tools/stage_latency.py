@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Stage-to-stage latency percentiles for recent orders.
+
+Every order carries a stage_timestamps map (see order_store.ORDER_STAGES)
+written by checkout, the Stripe webhook, the Prodigi order function and the
+Prodigi callback. This report turns those into:
+
+    stages      time between consecutive stages an order reached, e.g. how
+                long the orders stream took to deliver a paid order
+                (fulfillment_requested -> fulfillment_started) or how long
+                Prodigi took to ship
+    end to end  payment to Prodigi acceptance, payment to shipment, ...
+    waiting     orders that have not finished, grouped by the last stage
+                they reached, with how long they have been sitting there
+
+Usage:
+    python tools/stage_latency.py --days 7
+    python tools/stage_latency.py --table SteepleCo-Orders --days 1 --json
+    python tools/stage_latency.py --archive-dir ./archive
+"""
+import json
+import time
+import argparse
+
+import backend_env  # noqa: F401
+from order_store import ORDER_STAGES
+
+# Prodigi reports these (via prodigi_webhook.shipping_stage) after acceptance
+PRODIGI_STAGES = ("in_progress", "shipped", "complete")
+STAGE_ORDER = ORDER_STAGES + PRODIGI_STAGES
+FINAL_STAGES = {"complete", "cancelled", "prodigi_failed"}
+
+END_TO_END = [
+    ("created", "payment_succeeded"),
+    ("payment_succeeded", "prodigi_accepted"),
+    ("payment_succeeded", "shipped"),
+    ("payment_succeeded", "complete")
+]
+
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def format_ms(value):
+    if value < 1000:
+        return f"{value:.0f}ms"
+    if value < 120 * 1000:
+        return f"{value / 1000:.1f}s"
+    if value < 120 * 60 * 1000:
+        return f"{value / 60000:.1f}m"
+    return f"{value / 3600000:.1f}h"
+
+
+def order_stages(order):
+    """The order's stages as (stage, epoch ms), in lifecycle order"""
+    stamps = {stage: int(value) for stage, value in (order.get("stage_timestamps") or {}).items()}
+    known = [(stage, stamps[stage]) for stage in STAGE_ORDER if stage in stamps]
+    others = sorted((value, stage) for stage, value in stamps.items() if stage not in STAGE_ORDER)
+    return known, [(stage, value) for value, stage in others]
+
+
+def distribution(samples):
+    ordered = sorted(samples)
+    stats = {"count": len(ordered)}
+    for fraction in PERCENTILES:
+        stats[f"p{int(fraction * 100)}_ms"] = percentile(ordered, fraction)
+    stats["max_ms"] = ordered[-1] if ordered else 0
+    return stats
+
+
+def stage_report(orders, now_ms=None):
+    now_ms = now_ms or int(time.time() * 1000)
+    segments = {}
+    end_to_end = {f"{start} -> {end}": [] for start, end in END_TO_END}
+    waiting = {}
+    outcomes = {}
+    tracked = 0
+
+    for order in orders:
+        known, others = order_stages(order)
+        if not known:
+            continue
+        tracked += 1
+        stamps = dict(known)
+
+        for (start, started), (end, ended) in zip(known, known[1:]):
+            segments.setdefault(f"{start} -> {end}", []).append(ended - started)
+        for start, end in END_TO_END:
+            if start in stamps and end in stamps:
+                end_to_end[f"{start} -> {end}"].append(stamps[end] - stamps[start])
+
+        for stage, _ in others:
+            outcomes[stage] = outcomes.get(stage, 0) + 1
+        last_stage, last_at = max(known + others, key=lambda stage: stage[1])
+        if last_stage not in FINAL_STAGES:
+            waiting.setdefault(last_stage, []).append(now_ms - last_at)
+
+    # Segments in lifecycle order of their first stage
+    position = {stage: index for index, stage in enumerate(STAGE_ORDER)}
+    segment_names = sorted(segments, key=lambda name: [position[stage] for stage in name.split(" -> ")])
+
+    return {
+        "orders": tracked,
+        "stages": {name: distribution(segments[name]) for name in segment_names},
+        "end_to_end": {name: distribution(samples) for name, samples in end_to_end.items() if samples},
+        "waiting": {stage: distribution(ages) for stage, ages in
+                    sorted(waiting.items(), key=lambda entry: position.get(entry[0], len(position)))},
+        "other_stages": outcomes
+    }
+
+
+def print_stage_report(report):
+    print(f"{report['orders']} orders with stage timestamps")
+    columns = [f"p{int(fraction * 100)}_ms" for fraction in PERCENTILES] + ["max_ms"]
+    for title, rows in (("stages", report["stages"]), ("end to end", report["end_to_end"]),
+                        ("waiting since last stage", report["waiting"])):
+        if not rows:
+            continue
+        print(f"\n{title:48} {'count':>6} " + " ".join(f"{name[:-3]:>8}" for name in columns))
+        for name, stats in rows.items():
+            print(f"{name:48} {stats['count']:6} " + " ".join(f"{format_ms(stats[c]):>8}" for c in columns))
+    if report["other_stages"]:
+        print("\n" + "  ".join(f"{stage}={count}" for stage, count in sorted(report["other_stages"].items())))
+
+
+def scan_orders(table, since):
+    """Yield the stage timestamps of orders created since the given epoch second"""
+    kwargs = {
+        "ProjectionExpression": "order_id, created_at, stage_timestamps",
+        "FilterExpression": "created_at >= :since",
+        "ExpressionAttributeValues": {":since": since}
+    }
+    while True:
+        response = table.scan(**kwargs)
+        yield from response.get("Items", [])
+        if "LastEvaluatedKey" not in response:
+            return
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage latency percentiles for recent orders")
+    parser.add_argument("--table", default="SteepleCo-Orders", help="Orders table to scan")
+    parser.add_argument("--days", type=float, default=7, help="Only orders created in the last N days")
+    parser.add_argument("--archive-dir", help="Read a local copy of the order archive instead")
+    parser.add_argument("--archive-bucket", help="Read the order archive from S3 instead")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    if args.archive_dir or args.archive_bucket:
+        from order_archive import LocalObjectStore, S3ObjectStore
+        from sales_analytics import read_archive
+        store = LocalObjectStore(args.archive_dir) if args.archive_dir else S3ObjectStore(args.archive_bucket)
+        orders = read_archive(store)
+    else:
+        import boto3
+        orders = scan_orders(boto3.resource("dynamodb").Table(args.table), int(time.time() - args.days * 86400))
+
+    report = stage_report(orders)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_stage_report(report)
+
+
+if __name__ == "__main__":
+    main()